@@ -0,0 +1,4 @@
+"""Нагрузочные сценарии бота на синтетической переписке.
+
+Запуск: python -m bench.run --help
+"""
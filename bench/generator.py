@@ -0,0 +1,136 @@
+import random
+from datetime import datetime, timedelta
+from typing import Iterator, List, NamedTuple, Optional
+
+# Фразы по языкам: русский преобладает, как в реальных чатах бота
+PHRASES = {
+    "ru": [
+        "Кто-нибудь уже смотрел новый релиз {topic}?",
+        "Созвон по {topic} переносим на {day}, всем удобно?",
+        "Я закинул черновик по {topic} в общую папку, посмотрите до {day}",
+        "Мне кажется, с {topic} мы сильно недооценили сроки",
+        "Договорились: {topic} делаем сначала, остальное потом",
+        "А кто отвечает за {topic} на этой неделе?",
+        "Завтра не смогу, у меня {topic} весь день",
+        "Итог по {topic}: бюджет согласован, начинаем в {day}",
+    ],
+    "en": [
+        "Has anyone tried the new {topic} build yet?",
+        "Moving the {topic} sync to {day}, does that work for everyone?",
+        "Pushed a draft for {topic}, please review before {day}",
+        "I think we underestimated the {topic} timeline",
+    ],
+    "uk": [
+        "Хто вже дивився звіт по {topic}?",
+        "Переносимо зустріч щодо {topic} на {day}",
+    ],
+    "de": [
+        "Hat jemand schon die neue Version von {topic} getestet?",
+        "Das Meeting zu {topic} verschieben wir auf {day}",
+    ],
+}
+LANGUAGE_WEIGHTS = {"ru": 70, "en": 20, "uk": 5, "de": 5}
+
+TOPICS = [
+    "бэкенд", "мобильное приложение", "маркетинг", "отпуск", "онбординг",
+    "дизайн-ревью", "квартальный отчёт", "миграция БД", "найм", "API",
+]
+DAYS = ["понедельник", "вторник", "среду", "четверг", "пятницу", "Monday", "Friday"]
+
+# Шум, который отсекает prefilter
+NOISE = ["+1", "ок", "ага", "спасибо!", "👍", "😂😂", "lol", "да", "нет", "))"]
+
+LINKS = [
+    "https://github.com/example/repo/pull/{n}",
+    "https://docs.google.com/document/d/{n}/edit",
+    "https://habr.com/ru/articles/{n}/",
+]
+
+FIRST_NAMES = ["Анна", "Иван", "Мария", "Олег", "Kate", "John", "Дмитро", "Lena"]
+LAST_NAMES = ["Иванова", "Петров", "Смирнова", None, "Smith", None, "Коваль", None]
+
+
+class ChatMessage(NamedTuple):
+    """Входящее сообщение в том виде, в каком его получает db.save_message."""
+    chat_id: int
+    chat_title: str
+    user_id: int
+    first_name: str
+    last_name: Optional[str]
+    username: Optional[str]
+    text: str
+    timestamp: datetime
+
+
+class ChatTraffic:
+    """Детерминированный генератор переписки в нескольких чатах.
+
+    При одинаковом seed выдаёт одну и ту же последовательность
+    сообщений. Доли шума, повторов и ссылок задаются явно; длинные
+    сообщения собираются из нескольких фраз.
+    """
+
+    def __init__(self, chats: int = 10, users_per_chat: int = 8, seed: int = 1,
+                 noise: float = 0.15, duplicates: float = 0.05, links: float = 0.08,
+                 long_messages: float = 0.1, first_chat_id: int = -1001000000000):
+        self.rng = random.Random(seed)
+        self.chat_ids = [first_chat_id - i for i in range(chats)]
+        self.users_per_chat = users_per_chat
+        self.noise = noise
+        self.duplicates = duplicates
+        self.links = links
+        self.long_messages = long_messages
+        self._languages = list(LANGUAGE_WEIGHTS)
+        self._weights = list(LANGUAGE_WEIGHTS.values())
+        self._last_text = {}
+
+    def _phrase(self) -> str:
+        language = self.rng.choices(self._languages, self._weights)[0]
+        return self.rng.choice(PHRASES[language]).format(
+            topic=self.rng.choice(TOPICS), day=self.rng.choice(DAYS)
+        )
+
+    def text(self, chat_id: int) -> str:
+        rng = self.rng
+        roll = rng.random()
+        if roll < self.noise:
+            text = rng.choice(NOISE)
+        elif roll < self.noise + self.duplicates and chat_id in self._last_text:
+            text = self._last_text[chat_id]
+        else:
+            count = rng.randint(3, 8) if rng.random() < self.long_messages else 1
+            text = " ".join(self._phrase() for _ in range(count))
+            if rng.random() < self.links:
+                text += " " + rng.choice(LINKS).format(n=rng.randint(1000, 99999))
+        self._last_text[chat_id] = text
+        return text
+
+    def messages(self, count: int, start: Optional[datetime] = None,
+                 step: timedelta = timedelta(seconds=1)) -> Iterator[ChatMessage]:
+        """count сообщений вперемешку по всем чатам с шагом времени step."""
+        timestamp = start or datetime.now()
+        for _ in range(count):
+            yield self.message(self.rng.choice(self.chat_ids), timestamp)
+            timestamp += step
+
+    def message(self, chat_id: int, timestamp: datetime) -> ChatMessage:
+        user = self.rng.randrange(self.users_per_chat)
+        user_id = abs(chat_id) % 100000 * 100 + user
+        return ChatMessage(
+            chat_id, f"Чат {abs(chat_id) % 1000}", user_id,
+            FIRST_NAMES[user % len(FIRST_NAMES)], LAST_NAMES[user % len(LAST_NAMES)],
+            f"user{user_id}" if user % 3 else None,
+            self.text(chat_id), timestamp,
+        )
+
+    def history(self, chat_id: int, days: int, per_day: int,
+                end: Optional[datetime] = None) -> List[ChatMessage]:
+        """Переписка одного чата за days суток до end, равномерно по времени."""
+        end = end or datetime.now()
+        step = timedelta(days=1) / per_day
+        timestamp = end - timedelta(days=days)
+        result = []
+        while timestamp < end:
+            result.append(self.message(chat_id, timestamp))
+            timestamp += step
+        return result
@@ -0,0 +1,175 @@
+"""Запуск нагрузочных сценариев.
+
+    python -m bench.run --out results.json
+    python -m bench.run --scenarios ingest,digest --baseline results.json
+
+Бот работает против временной БД и локальных заглушек API нейросети
+и Telegram. Результаты пишутся в JSON; с --baseline метрики
+сравниваются с прошлым запуском, и при ухудшении больше чем на
+--tolerance процесс завершается с кодом 1.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from bench.generator import ChatTraffic
+from bench.stubs import FakeLLM, FakeTelegram
+
+
+def _configure(args: argparse.Namespace, workdir: str, llm: FakeLLM, telegram: FakeTelegram) -> None:
+    """Окружение бота; задаётся до импорта его модулей."""
+    from cryptography.fernet import Fernet
+
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["GPT_API_URL"] = llm.url
+    os.environ["TELEGRAM_API_URL"] = telegram.base_url
+    os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("GPT_API", "bench")
+    # Измеряем код бота, а не лимиты Bot API: их можно вернуть через окружение
+    os.environ.setdefault("SEND_GLOBAL_RATE", "1000")
+    os.environ.setdefault("SEND_GROUP_RATE_PER_MIN", "6000")
+    os.environ.setdefault("STREAM_EDIT_INTERVAL", "0.2")
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def _run(names: List[str], args: argparse.Namespace) -> Dict[str, dict]:
+    import command
+    import crypto
+    import db
+    import maintenance
+    from bench.scenarios import SCENARIOS
+
+    db.init_db()
+    await maintenance.load_dictionaries()
+    await db.message_buffer.start()
+    await command.sender.start()
+    await command.app.bot.initialize()
+    traffic = ChatTraffic(chats=args.chats, seed=args.seed)
+    results = {}
+    try:
+        for name in names:
+            logging.warning(f"Сценарий {name}...")
+            metrics = await SCENARIOS[name](
+                traffic, messages=args.messages, repeats=args.repeats,
+                chats=args.fanout_chats, workers=args.workers,
+                webhook_workers=args.webhook_workers,
+            )
+            results[name] = {key: metric._asdict() for key, metric in metrics.items()}
+    finally:
+        await command.app.bot.shutdown()
+        await command.sender.stop()
+        await db.message_buffer.stop()
+        db.pool.close()
+        crypto.shutdown()
+        await command.llm_client.aclose()
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Метрики, ухудшившиеся относительно baseline больше чем на tolerance."""
+    regressions = []
+    for scenario, metrics in results.items():
+        for name, metric in metrics.items():
+            old = baseline.get(scenario, {}).get(name)
+            if not old or not old["value"]:
+                continue
+            change = (metric["value"] - old["value"]) / abs(old["value"])
+            if metric["better"] == "higher":
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    f"{scenario}.{name}: {old['value']:.4g} -> {metric['value']:.4g} "
+                    f"{metric['unit']} (хуже на {change:.0%})"
+                )
+    return regressions
+
+
+def main(argv=None) -> int:
+    from bench.scenarios import SCENARIOS
+
+    parser = argparse.ArgumentParser(prog="python -m bench.run", description=__doc__.split("\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"через запятую из: {', '.join(SCENARIOS)}")
+    parser.add_argument("--out", help="куда записать результаты (JSON)")
+    parser.add_argument("--baseline", help="результаты прошлого запуска для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="допустимое ухудшение, доля (по умолчанию 0.1)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chats", type=int, default=20, help="чатов в синтетическом трафике")
+    parser.add_argument("--messages", type=int, default=20000, help="сообщений для ingest и db_size")
+    parser.add_argument("--repeats", type=int, default=20, help="повторов для перцентилей задержки")
+    parser.add_argument("--fanout-chats", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=8, help="обработчиков планировщика")
+    parser.add_argument("--webhook-workers", type=int, default=0,
+                        help="рабочих процессов webhook (по умолчанию — по числу ядер)")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="задержка заглушки нейросети, с")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    llm = FakeLLM(latency=args.llm_latency, error_rate=args.llm_error_rate, seed=args.seed).start()
+    telegram = FakeTelegram(latency=args.telegram_latency).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="digest-bench-") as workdir:
+            _configure(args, workdir, llm, telegram)
+            results = asyncio.run(_run(names, args))
+    finally:
+        llm.stop()
+        telegram.stop()
+
+    report = {
+        "meta": {
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "args": vars(args),
+            "llm_calls": dict(llm.calls),
+            "telegram_calls": dict(telegram.calls),
+        },
+        "results": results,
+    }
+    for scenario, metrics in results.items():
+        for name, metric in metrics.items():
+            print(f"{scenario:>8}  {name:<22} {metric['value']:>12.4f} {metric['unit']}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nУхудшения относительно " + args.baseline + ":", file=sys.stderr)
+            for line in regressions:
+                print("  " + line, file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+"""Сценарии нагрузки.
+
+Модули бота импортируются внутри функций: bench.run сначала
+настраивает окружение (адреса заглушек, временную БД), и только
+потом загружает код бота.
+"""
+import asyncio
+import os
+import signal
+import socket
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, NamedTuple
+
+from bench.generator import ChatTraffic
+
+
+class Metric(NamedTuple):
+    value: float
+    unit: str
+    # "lower" или "higher" — какое направление изменения считается улучшением
+    better: str
+
+
+Results = Dict[str, Metric]
+
+
+def percentile(values: List[float], q: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+class _Silent:
+    """Заменяет ProgressiveReply там, где отправка в чат не измеряется."""
+
+    async def update(self, text: str) -> None:
+        pass
+
+
+async def _ingest(messages) -> float:
+    """Пишет сообщения с их собственным временем через буфер записи."""
+    import db
+    import ingest
+
+    started = time.perf_counter()
+    for message in messages:
+        await db.message_buffer.put(ingest.PendingMessage(*message))
+    await db.message_buffer.flush()
+    return time.perf_counter() - started
+
+
+def _db_bytes() -> int:
+    import db
+
+    with db.pool.writer() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return sum(
+        os.path.getsize(db.DB_NAME + suffix)
+        for suffix in ("", "-wal")
+        if os.path.exists(db.DB_NAME + suffix)
+    )
+
+
+async def ingest_throughput(traffic: ChatTraffic, messages: int = 20000, **_) -> Results:
+    """Скорость приёма сообщений: буфер, шифрование, запись пачками."""
+    import db
+
+    batch = list(traffic.messages(messages))
+    # Отдельно — путь обработчика: db.save_message с текущим временем
+    started = time.perf_counter()
+    for message in batch[:messages // 10]:
+        await db.save_message(*message[:7])
+    await db.message_buffer.flush()
+    handler_elapsed = time.perf_counter() - started
+
+    elapsed = await _ingest(batch[messages // 10:])
+    return {
+        "msgs_per_s": Metric((messages - messages // 10) / elapsed, "msg/s", "higher"),
+        "save_message_per_s": Metric((messages // 10) / handler_elapsed, "msg/s", "higher"),
+    }
+
+
+async def db_growth(traffic: ChatTraffic, messages: int = 20000, **_) -> Results:
+    """Прирост файла БД на одно сообщение после checkpoint WAL."""
+    before = _db_bytes()
+    await _ingest(traffic.messages(messages))
+    after = _db_bytes()
+    return {
+        "bytes_per_message": Metric((after - before) / messages, "B/msg", "lower"),
+        "db_size": Metric(after, "B", "lower"),
+    }
+
+
+async def _latencies(repeats: int, func: Callable[[], Awaitable[None]],
+                     before: Callable[[], None]) -> List[float]:
+    result = []
+    for _ in range(repeats):
+        before()
+        started = time.perf_counter()
+        await func()
+        result.append(time.perf_counter() - started)
+    return result
+
+
+async def digest_latency(traffic: ChatTraffic, repeats: int = 20, **_) -> Results:
+    """/digest по последним 100 сообщениям и дайджест окна по суточным конспектам."""
+    import command
+    import db
+    import rolling
+
+    chat_id = traffic.chat_ids[0]
+    await _ingest(traffic.history(chat_id, days=1, per_day=500))
+
+    def cold():
+        db.hot_cache.clear()
+        command.digest_cache.clear()
+
+    async def recent():
+        latest_id = await db.get_latest_message_id(chat_id)
+        await command._build_recent_digest(chat_id, latest_id, _Silent())
+
+    cold_times = await _latencies(repeats, recent, cold)
+    hot_times = await _latencies(repeats, recent, command.digest_cache.clear)
+
+    # Неделя истории: первый проход строит суточные конспекты, следующие берут их из кэша
+    history_chat = traffic.chat_ids[1]
+    now = datetime.now()
+    await _ingest(traffic.history(history_chat, days=7, per_day=300, end=now))
+    since = now - timedelta(days=7)
+
+    async def window():
+        await rolling.build_window_digest(command.digest_engine, history_chat, since)
+
+    first = await _latencies(1, window, db.hot_cache.clear)
+    cached = await _latencies(repeats, window, db.hot_cache.clear)
+    return {
+        "recent_cold_p50": Metric(percentile(cold_times, 50), "s", "lower"),
+        "recent_cold_p99": Metric(percentile(cold_times, 99), "s", "lower"),
+        "recent_hot_p50": Metric(percentile(hot_times, 50), "s", "lower"),
+        "recent_hot_p99": Metric(percentile(hot_times, 99), "s", "lower"),
+        "window_first": Metric(first[0], "s", "lower"),
+        "window_cached_p50": Metric(percentile(cached, 50), "s", "lower"),
+        "window_cached_p99": Metric(percentile(cached, 99), "s", "lower"),
+    }
+
+
+async def scheduler_fanout(traffic: ChatTraffic, chats: int = 50, workers: int = 8,
+                           timeout: float = 300, **_) -> Results:
+    """Одновременный запуск дайджестов по расписанию в chats чатах."""
+    import command
+    import db
+    import scheduler
+
+    fanout = ChatTraffic(chats=chats, seed=traffic.rng.randrange(1 << 30),
+                         first_chat_id=traffic.chat_ids[-1] - 1000)
+    # Новые чаты получают еженедельное расписание с next_run = сейчас
+    await _ingest(traffic_per_chat(fanout, per_chat=60))
+    chat_ids = set(fanout.chat_ids)
+    due = 0
+    for chat_id, next_run in await db.get_all_schedules():
+        if scheduler.parse_next_run(next_run) > scheduler.utcnow():
+            continue
+        if chat_id in chat_ids:
+            due += 1
+        else:
+            # Чаты предыдущих сценариев в той же БД в замер не попадают
+            await db.update_next_run(chat_id)
+
+    digest_scheduler = scheduler.DigestScheduler(
+        command.generate_digest_for_chat, db.job_queue, workers=workers
+    )
+    started = time.perf_counter()
+    await digest_scheduler.start()
+    try:
+        while True:
+            finished = await db.pool.read(_count_finished_jobs, sorted(chat_ids))
+            if finished >= due:
+                break
+            if time.perf_counter() - started > timeout:
+                raise TimeoutError(f"За {timeout} с обработано {finished} из {due} дайджестов")
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        # Дождаться, пока окончательные тексты уйдут в Telegram
+        while len(command.sender):
+            await asyncio.sleep(0.05)
+        sent = time.perf_counter() - started
+    finally:
+        await digest_scheduler.stop()
+    return {
+        "digests": Metric(due, "chats", "higher"),
+        "fanout_seconds": Metric(elapsed, "s", "lower"),
+        "delivered_seconds": Metric(sent, "s", "lower"),
+        "digests_per_s": Metric(due / elapsed, "digest/s", "higher"),
+    }
+
+
+def _update(update_id: int, message) -> dict:
+    chat_id, title, user_id, first_name, last_name, username, text, timestamp = message
+    sender = {"id": user_id, "is_bot": False, "first_name": first_name}
+    if last_name:
+        sender["last_name"] = last_name
+    if username:
+        sender["username"] = username
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(timestamp.timestamp()), "text": text,
+        "chat": {"id": chat_id, "type": "supergroup", "title": title}, "from": sender,
+    }}
+
+
+def _count_finished_jobs(conn, chat_ids) -> int:
+    placeholders = ", ".join("?" * len(chat_ids))
+    return conn.execute(f"""
+        SELECT COUNT(*) FROM jobs
+        WHERE status IN ('done', 'dead') AND chat_id IN ({placeholders})
+    """, chat_ids).fetchone()[0]
+
+
+def _count_messages(conn) -> int:
+    return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+async def _webhook_run(traffic: ChatTraffic, messages: int, workers: int,
+                       connections: int, timeout: float) -> float:
+    """Прогон webhook с workers процессами; возвращает сообщений в секунду."""
+    import httpx
+
+    import db
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, WEBHOOK_URL=f"http://127.0.0.1:{port}/telegram",
+               WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(port),
+               WEBHOOK_WORKERS=str(workers), WEBHOOK_SECRET="bench")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(root, "main.py"), env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    updates = [_update(i + 1, message) for i, message in enumerate(traffic.messages(messages))]
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", headers={"X-Telegram-Bot-Api-Secret-Token": "bench"},
+            limits=httpx.Limits(max_connections=connections), timeout=60,
+        ) as client:
+            # Ждём, пока supervisor начнёт принимать и примет первое обновление
+            deadline = time.perf_counter() + timeout
+            while True:
+                try:
+                    if (await client.post("/telegram", json=updates[0])).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.perf_counter() > deadline:
+                    raise TimeoutError("webhook не запустился")
+                await asyncio.sleep(0.2)
+            expected = await db.pool.read(_count_messages) + len(updates) - 1
+            started = time.perf_counter()
+            queue = iter(updates[1:])
+
+            async def post_all():
+                for update in queue:
+                    response = await client.post("/telegram", json=update)
+                    response.raise_for_status()
+
+            await asyncio.gather(*(post_all() for _ in range(connections)))
+            while await db.pool.read(_count_messages) < expected:
+                if time.perf_counter() - started > timeout:
+                    raise TimeoutError("Не все сообщения записаны в БД")
+                await asyncio.sleep(0.05)
+            return (len(updates) - 1) / (time.perf_counter() - started)
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+        await process.wait()
+
+
+async def webhook_ingest(traffic: ChatTraffic, messages: int = 20000, webhook_workers: int = 0,
+                         connections: int = 40, timeout: float = 300, **_) -> Results:
+    """Приём обновлений через webhook: один рабочий процесс и по числу ядер."""
+    workers = webhook_workers or os.cpu_count() or 1
+    count = max(1000, messages // 4)
+    single = await _webhook_run(traffic, count, 1, connections, timeout)
+    results = {"msgs_per_s_1_worker": Metric(single, "msg/s", "higher")}
+    if workers > 1:
+        multi = await _webhook_run(traffic, count, workers, connections, timeout)
+        results["msgs_per_s"] = Metric(multi, "msg/s", "higher")
+        results["scaling"] = Metric(multi / single, "x", "higher")
+    return results
+
+
+def traffic_per_chat(traffic: ChatTraffic, per_chat: int):
+    now = datetime.now()
+    for chat_id in traffic.chat_ids:
+        for offset in range(per_chat):
+            yield traffic.message(chat_id, now - timedelta(minutes=per_chat - offset))
+
+
+SCENARIOS = {
+    "ingest": ingest_throughput,
+    "db_size": db_growth,
+    "digest": digest_latency,
+    "fanout": scheduler_fanout,
+    "webhook": webhook_ingest,
+}
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+
+# Обработчик получает (метод, путь, тело) и возвращает (статус, заголовки, тело);
+# тело может быть асинхронным генератором фрагментов для потоковых ответов
+Response = Tuple[int, Dict[str, str], object]
+Handler = Callable[[str, str, bytes], Awaitable[Response]]
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests",
+           503: "Service Unavailable"}
+
+
+class StubServer:
+    """Минимальный HTTP/1.1-сервер с keep-alive в отдельном потоке.
+
+    Работает в собственном event loop, чтобы задержки заглушки не
+    отнимали время у измеряемого кода. Поддерживает ответы с
+    Content-Length и потоковые (chunked) ответы.
+    """
+
+    def __init__(self, handler: Handler, host: str = "127.0.0.1"):
+        self.handler = handler
+        self.host = host
+        self.port: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> "StubServer":
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), daemon=True,
+                                        name=f"stub-{type(self).__name__}")
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def _run(self, ready: threading.Event) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._serve, self.host, 0, backlog=1024)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            self._loop.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response_headers, payload = await self.handler(method, path, body)
+                await self._respond(writer, status, response_headers, payload)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int,
+                       headers: Dict[str, str], payload) -> None:
+        head = f"HTTP/1.1 {status} {REASONS.get(status, 'Status')}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        if isinstance(payload, (bytes, str)):
+            data = payload.encode() if isinstance(payload, str) else payload
+            writer.write(f"{head}Content-Length: {len(data)}\r\n\r\n".encode() + data)
+            await writer.drain()
+            return
+        writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode())
+        async for chunk in payload:
+            data = chunk.encode()
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def _json(status: int, data, headers: Optional[Dict[str, str]] = None) -> Response:
+    headers = {"Content-Type": "application/json", **(headers or {})}
+    return status, headers, json.dumps(data, ensure_ascii=False)
+
+
+class FakeLLM(StubServer):
+    """Заглушка OpenAI-совместимого API gptunnel.
+
+    /v1/chat/completions отвечает через latency секунд (плюс случайный
+    разброс jitter), поддерживает stream=true (SSE). Доля error_rate
+    запросов завершается статусом 503, чтобы проверить повторы клиента.
+    """
+
+    def __init__(self, latency: float = 0.2, jitter: float = 0.05, error_rate: float = 0.0,
+                 answer_tokens: int = 200, chunk_tokens: int = 20, seed: int = 1,
+                 host: str = "127.0.0.1"):
+        super().__init__(self.handle, host)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.answer_tokens = answer_tokens
+        self.chunk_tokens = chunk_tokens
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+
+    def _answer(self, prompt: str) -> str:
+        lines = ["*Главное за период*", ""]
+        words = prompt.split()
+        for i in range(self.answer_tokens // 10):
+            sample = " ".join(words[i * 7 % max(1, len(words)):][:6]) or "обсуждение"
+            lines.append(f"- Пункт {i + 1}: {sample}")
+        return "\n".join(lines)
+
+    async def handle(self, method: str, path: str, body: bytes) -> Response:
+        self.calls[path] += 1
+        if path == "/v1/balance":
+            return _json(200, {"balance": 1000.0})
+        if path != "/v1/chat/completions":
+            return _json(404, {"error": "not found"})
+        await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        if self.rng.random() < self.error_rate:
+            self.calls["errors"] += 1
+            return _json(503, {"error": "overloaded"}, {"Retry-After": "0"})
+        request = json.loads(body)
+        prompt = "\n".join(message["content"] for message in request["messages"])
+        answer = self._answer(prompt)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(answer) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "total_cost": round((prompt_tokens * 0.15 + completion_tokens * 0.6) / 1e6, 8),
+        }
+        if not request.get("stream"):
+            return _json(200, {
+                "model": request["model"], "usage": usage,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}}],
+            })
+        return 200, {"Content-Type": "text/event-stream"}, self._stream(request["model"], answer, usage)
+
+    async def _stream(self, model: str, answer: str, usage: dict):
+        step = self.chunk_tokens * 4
+        for start in range(0, len(answer), step):
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": answer[start:start + step]}}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(0.005)
+        yield f"data: {json.dumps({'model': model, 'choices': [], 'usage': usage})}\n\n"
+        yield "data: [DONE]\n\n"
+
+
+class FakeTelegram(StubServer):
+    """Заглушка Bot API: getMe, sendMessage, editMessageText, deleteMessage
+    и setWebhook.
+
+    Адрес для ApplicationBuilder.base_url — url + "/bot". Если задан
+    flood_limit, чат, получивший больше flood_limit запросов за
+    секунду, получает 429 с retry_after, как настоящий Bot API.
+    """
+
+    def __init__(self, latency: float = 0.02, flood_limit: Optional[int] = None,
+                 host: str = "127.0.0.1"):
+        super().__init__(self.handle, host)
+        self.latency = latency
+        self.flood_limit = flood_limit
+        self.calls = Counter()
+        self.chats = Counter()
+        self._next_id = 1
+        self._window: Dict[object, Tuple[float, int]] = {}
+
+    @property
+    def base_url(self) -> str:
+        return self.url + "/bot"
+
+    @staticmethod
+    def _params(body: bytes) -> dict:
+        params = {}
+        for name, value in parse_qsl(body.decode()):
+            # Не строковые параметры библиотека передаёт как JSON
+            if name in ("chat_id", "message_id", "reply_markup", "entities", "link_preview_options"):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[name] = value
+        return params
+
+    def _flooded(self, chat_id) -> bool:
+        if self.flood_limit is None:
+            return False
+        now = time.monotonic()
+        started, count = self._window.get(chat_id, (now, 0))
+        if now - started >= 1:
+            started, count = now, 0
+        self._window[chat_id] = (started, count + 1)
+        return count + 1 > self.flood_limit
+
+    def _message(self, chat_id, message_id: int, text: str) -> dict:
+        chat_type = "private" if isinstance(chat_id, int) and chat_id > 0 else "supergroup"
+        return {
+            "message_id": message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": chat_type, "title": "bench"},
+        }
+
+    async def handle(self, method: str, path: str, body: bytes) -> Response:
+        name = path.rsplit("/", 1)[-1]
+        self.calls[name] += 1
+        params = self._params(body)
+        await asyncio.sleep(self.latency)
+        if name == "getMe":
+            return _json(200, {"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                "can_join_groups": True, "can_read_all_group_messages": True,
+                "supports_inline_queries": False,
+            }})
+        if name in ("setWebhook", "deleteWebhook"):
+            return _json(200, {"ok": True, "result": True})
+        chat_id = params.get("chat_id")
+        if self._flooded(chat_id):
+            self.calls["429"] += 1
+            return _json(429, {"ok": False, "error_code": 429,
+                               "description": "Too Many Requests: retry after 1",
+                               "parameters": {"retry_after": 1}})
+        self.chats[chat_id] += 1
+        if name == "sendMessage":
+            message_id, self._next_id = self._next_id, self._next_id + 1
+            return _json(200, {"ok": True, "result": self._message(chat_id, message_id, params.get("text", ""))})
+        if name == "editMessageText":
+            return _json(200, {"ok": True, "result": self._message(
+                chat_id, params.get("message_id"), params.get("text", ""))})
+        if name == "deleteMessage":
+            return _json(200, {"ok": True, "result": True})
+        return _json(404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"})
@@ -1,157 +1,196 @@
 import db
 import logging
-import sqlite3
-import crypto
-from md2tgmd import escape
 from datetime import datetime, timedelta
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.ext import ContextTypes
-import asyncio
 
 ##################################################################################################
 
-import requests as r
+import router
+import summarizer
+import rolling
+import singleflight
+import prefilter
+import streaming
+import outbox
+import retention
+import metrics
+import usage
+from functools import partial
 from os import getenv
 from dotenv import load_dotenv
-from telegram.helpers import escape_markdown
 
 load_dotenv()
-gpt_url="https://gptunnel.ru/v1/chat/completions"
+GPT_BASE_URL = getenv("GPT_API_URL", "https://gptunnel.ru")
 TOKEN=getenv("GPT_API")
 
-def get_completion(context, prompt, retry=0):
-    response = r.post(gpt_url,                      
-        headers={
-            "Authorization": TOKEN
-        },
-        json={
-            "model": "deepseek-3",
-            "max_tokens": 7500,
-            "temperature": 0.6,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": f"{context}",
-                },
-                {
-                    "role": "user",
-                    "content": f"{prompt}",
-                },
-            ],
-        }
-    )
-    print(response.json())
-    if response.status_code == 200:
-        return (
-            response.json()["choices"][0]["message"]["content"],
-            response.json()["usage"]["total_cost"]
-        )
-    else:
-        if retry < 5:
-            return get_completion(context, prompt, retry=retry + 1)
-        else:
-            return (f"Ошибка: {response.status_code} — {response.json()}", None)
-        
-def get_balance(retry=0):
-    response = r.get("https://gptunnel.ru/v1/balance",                      
-        headers={
-            "Authorization": TOKEN
-        }
-    )
-    if response.status_code == 200:
-        return response.json()["balance"]
-    else:
-        if retry < 5:
-            return get_balance(retry=retry + 1)
-        else:
-            return response.json()
-        
+# Провайдеры нейросети: по умолчанию основная модель и дешёвая для
+# небольших запросов на том же endpoint; LLM_PROVIDERS задаёт список
+# целиком (см. router.from_config)
+llm_client = router.from_config(
+    getenv("LLM_PROVIDERS", ""), GPT_BASE_URL, TOKEN, "deepseek-3",
+    cheap_model=getenv("LLM_CHEAP_MODEL", "gpt-4o-mini") or None,
+    max_concurrency=int(getenv("LLM_MAX_CONCURRENCY", "8")),
+    timeout=float(getenv("LLM_TIMEOUT", "120")),
+    # Повторы у одного провайдера короткие: дальше запрос уходит следующему
+    max_retries=int(getenv("LLM_MAX_RETRIES", "1")),
+    small_tokens=int(getenv("LLM_SMALL_PROMPT_TOKENS", "2000")),
+    hedge_max=float(getenv("LLM_HEDGE_MAX", "60")),
+)
+
+digest_engine = summarizer.DigestEngine(
+    llm_client,
+    chunk_tokens=int(getenv("DIGEST_CHUNK_TOKENS", "6000")),
+    parallelism=int(getenv("DIGEST_PARALLELISM", "4")),
+    max_tokens=db.usage_ledger.max_tokens,
+    input_tokens=db.usage_ledger.input_tokens,
+    prefilter=prefilter.prefilter,
+)
+
+# Сколько найденных сообщений берётся в дайджест по теме и показывает /search
+TOPIC_DIGEST_MESSAGES = int(getenv("TOPIC_DIGEST_MESSAGES", "300"))
+SEARCH_RESULTS = int(getenv("SEARCH_RESULTS", "20"))
+
+# Как часто обновлять сообщение с генерируемым дайджестом, секунд
+STREAM_EDIT_INTERVAL = float(getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Все сообщения с дайджестами уходят через общую очередь с лимитами Telegram
+sender = outbox.Outbox(
+    global_rate=float(getenv("SEND_GLOBAL_RATE", "30")),
+    group_rate=float(getenv("SEND_GROUP_RATE_PER_MIN", "20")) / 60,
+    private_rate=float(getenv("SEND_PRIVATE_RATE", "1")),
+    concurrency=int(getenv("SEND_CONCURRENCY", "8")),
+)
+
+digest_flight = singleflight.SingleFlight()
+digest_cache = singleflight.TTLCache(
+    maxsize=int(getenv("DIGEST_CACHE_SIZE", "1000")),
+    ttl=float(getenv("DIGEST_CACHE_TTL", "600")),
+)
+
+metrics.gauge("outbox_queue_depth", "Сообщений в очереди отправки", func=lambda: len(sender))
+metrics.gauge("digest_cache_size", "Дайджестов в кэше", func=lambda: len(digest_cache))
+
 ##################################################################################################
 from telegram.ext import ApplicationBuilder
 import os
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-async def generate_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Формирует дайджест за последние 100 сообщений"""
-    # 1. Получение сообщений из БД
-    conn = sqlite3.connect(db.DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT message FROM messages
-        WHERE chat_id = ?
-        ORDER BY timestamp DESC
-        LIMIT 100
-    """, (update.effective_chat.id,))
-    
-    encrypted_messages = [row[0] for row in cursor.fetchall()]
-    conn.close()
+# Другой адрес Bot API: локальный сервер или заглушка для нагрузочных тестов
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
 
-    if not encrypted_messages:
-        await update.message.reply_text("За последнюю неделю сообщений не найдено.")
-        return
-    
-    # 2. Дешифровка сообщений
-    messages = [crypto.decrypt_message(encrypted_message) for encrypted_message in encrypted_messages]
-    
-    # 3. Формирование промпта для GPT
-    system_message = (
-        "Ты ассистент для создания дайджестов чата. Проанализируй сообщения и создай структурированный дайджест:\n"
-        "1. Выдели основные темы и обсуждения\n"
-        "2. Кратко суммируй важные моменты\n"
-        "3. Сохрани нейтральный тон\n"
-        "4. Не добавляй информацию, которой нет в сообщениях\n"
-        "5. Используй markdown для форматирования, не используй # для заголовков\n"
-        "6. Используй эмодзи для визуала"
+def build_application():
+    builder = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    return builder.build()
+
+app = build_application()
+
+BUDGET_EXCEEDED_TEXT = "Лимит токенов нейросети для этого чата исчерпан. Попробуйте позже или обратитесь к администратору бота."
+
+async def _build_recent_digest(chat_id, latest_id, progress):
+    """Строит дайджест по последним 100 сообщениям и кладёт его в кэш."""
+    # 1. Последние сообщения: из кэша в памяти, при промахе — из БД
+    messages = await db.get_recent_texts(chat_id, 100)
+
+    # 2. Размер ответа и входа по объёму переписки и остатку лимита чата
+    sizing = await db.usage_ledger.plan(chat_id, sum(summarizer.estimate_tokens(m) for m in messages))
+
+    # 3. Отправка запросов к GPT, текст появляется в чате по мере генерации
+    logging.info(f"Начало генерации дайджеста для {len(messages)} сообщений")
+    result = await db.usage_ledger.track(
+        chat_id, "digest",
+        lambda: digest_engine.sized(*sizing).summarize(messages, on_progress=progress.update),
     )
-    
-    user_prompt = "Сообщения:\n" + "\n".join(
-        [f"{i+1}. {msg}" for i, msg in enumerate(messages)]
+    logging.info(f"Дайджест сгенерирован успешно. Стоимость: {result.cost}")
+    digest_cache.set((chat_id, latest_id), result.text)
+    return result.text
+
+async def _build_topic_digest(chat_id, latest_id, topic, messages, progress):
+    """Строит дайджест по сообщениям на тему topic и кладёт его в кэш."""
+    sizing = await db.usage_ledger.plan(chat_id, sum(summarizer.estimate_tokens(m) for m in messages), "topic")
+    logging.info(f"Начало генерации дайджеста по теме для {len(messages)} сообщений")
+    result = await db.usage_ledger.track(
+        chat_id, "topic",
+        lambda: digest_engine.sized(*sizing).summarize(messages, on_progress=progress.update, topic=topic),
     )
+    logging.info(f"Дайджест сгенерирован успешно. Стоимость: {result.cost}")
+    digest_cache.set((chat_id, latest_id, topic.lower()), result.text)
+    return result.text
 
-    # 4. Отправка запроса к GPT
-    await update.message.reply_text("Генерирую дайджест, подождите немного...")
-    logging.info(f"Начало генерации дайджеста для {len(messages)} сообщений")
-    
-    try:
-        # Вызываем синхронную функцию в отдельном потоке
-        digest, cost = await asyncio.to_thread(
-            get_completion,
-            context=system_message,
-            prompt=user_prompt
-        )
-        if cost is None:
-            await update.message.reply_text("Произошла ошибка при генерации дайджеста 202:\n")
+async def generate_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Формирует дайджест за последние 100 сообщений; /digest <тема> — по сообщениям на тему."""
+    chat_id = update.effective_chat.id
+    metrics.current_chat.set(chat_id)
+    latest_id = await db.get_latest_message_id(chat_id)
+    topic = " ".join(context.args or []).strip()
+
+    if latest_id is None:
+        await sender.send_text(context.bot, chat_id, "За последнюю неделю сообщений не найдено.",
+                               outbox.INTERACTIVE, parse_mode=None)
+        return
+
+    # Без новых сообщений отдаём готовый дайджест из кэша
+    key = (chat_id, latest_id, topic.lower()) if topic else (chat_id, latest_id)
+    digest = digest_cache.get(key)
+    if digest is not None:
+        await sender.send_text(context.bot, chat_id, digest, outbox.INTERACTIVE)
+        return
+
+    # Одновременные запросы из одного чата ждут одну генерацию и получают её результат
+    flight_key = (chat_id, topic.lower()) if topic else chat_id
+    if digest_flight.in_flight(flight_key):
+        try:
+            digest = await digest_flight.join(flight_key)
+        except Exception as e:
+            # Об ошибке (и об исчерпанном лимите) в этот чат уже сообщил
+            # запрос, начавший генерацию
+            logging.error(f"Ошибка генерации дайджеста: {str(e)}")
             return
-        logging.info(f"Дайджест сгенерирован успешно. Стоимость: {cost}")
-        
-        # 5. Отправка результата пользователю
-        for chunk in [digest[i:i+4000] for i in range(0, len(digest), 4000)]:
-            await update.message.reply_text(
-                chunk,
-                parse_mode="Markdown"
-            )
-            
+        await sender.send_text(context.bot, chat_id, digest, outbox.INTERACTIVE)
+        return
+
+    if topic:
+        # Сообщения на тему находятся по слепому индексу, расшифровываются только они
+        found = await db.search_messages(chat_id, topic, TOPIC_DIGEST_MESSAGES)
+        if not found:
+            text = (f"Сообщений по теме «{topic}» не найдено." if found is not None
+                    else "Укажите тему словами длиннее двух букв, например: /digest релиз")
+            await sender.send_text(context.bot, chat_id, text, outbox.INTERACTIVE, parse_mode=None)
+            return
+        build = partial(_build_topic_digest, chat_id, latest_id, topic, [row[3] for row in found])
+    else:
+        build = partial(_build_recent_digest, chat_id, latest_id)
+
+    progress = streaming.ProgressiveReply(
+        context.bot, chat_id, sender, outbox.INTERACTIVE, interval=STREAM_EDIT_INTERVAL
+    )
+    try:
+        await progress.begin("Генерирую дайджест, подождите немного...")
+        digest = await digest_flight.do(flight_key, lambda: build(progress))
+        # 4. Окончательный текст с разметкой
+        await progress.finish(digest)
+
+    except usage.BudgetExceeded:
+        await progress.fail(BUDGET_EXCEEDED_TEXT)
     except Exception as e:
         logging.error(f"Ошибка генерации дайджеста: {str(e)}")
-        await update.message.reply_text("Произошла ошибка при генерации дайджеста. Попробуйте позже.")
+        await progress.fail("Произошла ошибка при генерации дайджеста. Попробуйте позже.")
 
-async def generate_digest_for_chat(chat_id):
-    """Формирует дайджест за указанное пользователем время"""
+async def generate_digest_for_chat(chat_id, final_attempt=True):
+    """Формирует дайджест за указанное пользователем время.
+
+    Возвращает False, если генерацию стоит повторить; сообщение об ошибке
+    отправляется в чат только при последней попытке.
+    """
+    metrics.current_chat.set(chat_id)
     # 1. Получение сообщений из БД
-    conn = sqlite3.connect(db.DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT frequency FROM schedules WHERE chat_id = ?
-    """, (chat_id,))
-    result = cursor.fetchone()
-
-    if not result:
-        await app.bot.send_message(chat_id=chat_id, text="Не удалось определить частоту дайджеста.")
-        conn.close()
-        return
+    frequency = await db.get_frequency(chat_id)
+
+    if not frequency:
+        await sender.send_text(app.bot, chat_id, "Не удалось определить частоту дайджеста.", parse_mode=None)
+        return True
 
-    frequency = result[0]
     if frequency == "daily":
         delta = timedelta(days=1)
     elif frequency == "every_three_days":
@@ -159,77 +198,59 @@ async def generate_digest_for_chat(chat_id):
     elif frequency == "weekly":
         delta = timedelta(days=7)
     else:
-        await app.bot.send_message(chat_id=chat_id, text="Неверно указана частота в настройках.")
-        conn.close()
-        return
+        await sender.send_text(app.bot, chat_id, "Неверно указана частота в настройках.", parse_mode=None)
+        return True
     
     since = datetime.now() - delta
     
-    cursor.execute("""
-        SELECT message FROM messages
-        WHERE timestamp > ?
-        AND chat_id = ?
-        ORDER BY timestamp
-    """, (since, chat_id))
-    
-    encrypted_messages = [row[0] for row in cursor.fetchall()]
-    conn.close()
+    message_count = await db.count_messages_since(chat_id, since)
 
-    if not encrypted_messages:
+    if not message_count:
         # Отправляем сообщение в чат
-        await app.bot.send_message(chat_id=chat_id, text="За последнюю неделю сообщений не найдено.")
-        db.update_next_run(chat_id)
-        return
+        await sender.send_text(app.bot, chat_id, "За последнюю неделю сообщений не найдено.", parse_mode=None)
+        return True
     
-    # 2. Дешифровка сообщений
-    messages = [crypto.decrypt_message(encrypted_message) for encrypted_message in encrypted_messages]
-    
-    # 3. Формирование промпта для GPT
-    system_message = (
-        "Ты ассистент для создания дайджестов чата. Проанализируй сообщения создай структурированный дайджест:\n"
-        "1. Выдели основные темы и обсуждения\n"
-        "2. Кратко суммируй важные моменты\n"
-        "3. Сохрани нейтральный тон\n"
-        "4. Не добавляй информацию, которой нет в сообщениях\n"
-        "5. Используй markdown для форматирования, не используй # для заголовков\n"
-        "6. Используй эмодзи для визуала"
-    )
-    
-    user_prompt = "Сообщения:\n" + "\n".join(
-        [f"{i+1}. {msg}" for i, msg in enumerate(messages)]
-    )
+    # 2. Размер дайджеста по активности чата и остатку лимита; тексты ещё
+    # не загружены, поэтому объём переписки оценивается по числу сообщений
+    try:
+        sizing = await db.usage_ledger.plan(chat_id, message_count * usage.MESSAGE_TOKENS, "scheduled")
+    except usage.BudgetExceeded:
+        await sender.send_text(app.bot, chat_id, BUDGET_EXCEEDED_TEXT, parse_mode=None)
+        return True
+    engine = digest_engine.sized(*sizing)
 
-    # 4. Отправка запроса к GPT
-    await app.bot.send_message(chat_id=chat_id, text="Генерирую дайджест, подождите немного...")
-    logging.info(f"Начало генерации дайджеста для {len(messages)} сообщений")
+    # 3. Сборка дайджеста из закэшированных суточных конспектов и новых сообщений
+    logging.info(f"Начало генерации дайджеста для {message_count} сообщений")
+    progress = streaming.ProgressiveReply(app.bot, chat_id, sender, interval=STREAM_EDIT_INTERVAL)
     
     try:
-        # Вызываем синхронную функцию в отдельном потоке
-        digest, cost = await asyncio.to_thread(
-            get_completion,
-            context=system_message,
-            prompt=user_prompt
+        await progress.begin("Генерирую дайджест, подождите немного...")
+        result = await db.usage_ledger.track(
+            chat_id, "scheduled",
+            lambda: rolling.build_window_digest(engine, chat_id, since, on_progress=progress.update),
         )
-
-        if cost is None:
-            await app.bot.send_message("Произошла ошибка при генерации дайджеста 202:\n")
-            return
-        
-        logging.info(f"Дайджест сгенерирован успешно. Стоимость: {cost}")
-        
-        # 5. Отправка результата пользователю
-        for chunk in [digest[i:i+4000] for i in range(0, len(digest), 4000)]:
-            await app.bot.send_message(
-                chat_id=chat_id,
-                text=chunk,
-                parse_mode="Markdown"
-            )
-        # 6. Обновление следующей отправки
-        db.update_next_run(chat_id)
-            
+        digest, cost = result.text, result.cost
     except Exception as e:
         logging.error(f"Ошибка генерации дайджеста: {str(e)}")
-        await app.bot.send_message(chat_id=chat_id, text="Произошла ошибка при генерации дайджеста. Попробуйте позже.")
+        if final_attempt:
+            await progress.fail("Произошла ошибка при генерации дайджеста. Попробуйте позже.")
+            return True
+        await progress.discard()
+        return False
+
+    logging.info(f"Дайджест сгенерирован успешно. Стоимость: {cost}")
+    if not digest.strip():
+        # Во всех сутках окна не нашлось содержательных сообщений, а
+        # пустой текст Telegram не примет
+        digest = summarizer.EMPTY_DIGEST_TEXT
+
+    # 4. Окончательный текст с разметкой. Дайджест уже оплачен, поэтому
+    # ошибка доставки не повод генерировать его заново
+    try:
+        await progress.finish(digest)
+    except Exception as e:
+        logging.error(f"Не удалось отправить дайджест в чат {chat_id}: {e}")
+    return True
 
 async def schedule_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отображает меню для выбора частоты дайджеста."""
@@ -259,12 +280,96 @@ async def set_digest_frequency(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Некорректный выбор. Попробуйте снова.")
         return
 
-    db.set_schedule(user_id, chat_id, frequency_map[frequency])
+    await db.set_schedule(user_id, chat_id, frequency_map[frequency])
     await update.message.reply_text(
         f"Частота дайджеста установлена: {frequency}.", 
         reply_markup=ReplyKeyboardRemove()
     )
 
+async def set_retention(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/retention [дней] [архив] — показывает или меняет срок хранения сообщений."""
+    chat_id = update.effective_chat.id
+    settings = await db.get_chat_settings(chat_id)
+    days, archive = settings if settings else (None, 0)
+
+    if not context.args:
+        await update.message.reply_text(
+            f"Сообщения хранятся {retention.effective_days(days)} дн."
+            + (" Старые сообщения сжимаются в архивные конспекты." if archive else "")
+            + "\nИзменить: /retention <дней> [архив]"
+        )
+        return
+
+    # Сокращение срока безвозвратно удаляет историю чата — в группах это
+    # решают только администраторы
+    if update.effective_chat.type != "private":
+        member = await context.bot.get_chat_member(chat_id, update.effective_user.id)
+        if member.status not in ("administrator", "creator"):
+            await update.message.reply_text("Менять срок хранения сообщений могут только администраторы чата.")
+            return
+
+    try:
+        days = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("Укажите срок хранения числом дней, например: /retention 30")
+        return
+    if days < retention.MIN_RETENTION_DAYS:
+        await update.message.reply_text(
+            f"Срок хранения не может быть меньше {retention.MIN_RETENTION_DAYS} дн.: "
+            "иначе недельный дайджест останется без сообщений."
+        )
+        return
+    archive = len(context.args) > 1 and context.args[1].lower() in ("архив", "archive")
+
+    await db.set_retention(chat_id, days, archive)
+    await update.message.reply_text(
+        f"Срок хранения сообщений установлен: {days} дн."
+        + (" Старые сообщения будут сжиматься в архивные конспекты." if archive else "")
+    )
+
+async def show_usage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/usage — расход нейросети чатом и остаток лимита токенов."""
+    chat_id = update.effective_chat.id
+    ledger = db.usage_ledger
+    window = await ledger.totals(chat_id)
+    today = await ledger.totals(chat_id, days=1)
+    budget = await ledger.budget(chat_id)
+
+    lines = [
+        f"Расход нейросети за {ledger.window_days} дн.: {window.tokens} токенов, "
+        f"дайджестов {window.digests}, стоимость {window.cost:.2f}",
+        f"Сегодня: {today.tokens} токенов, дайджестов {today.digests}",
+    ]
+    if window.digests:
+        lines.append(f"Среднее время генерации: {window.latency / window.digests:.1f} с")
+    if budget:
+        lines.append(f"Лимит: {budget} токенов за {ledger.window_days} дн., осталось {max(0, budget - window.tokens)}")
+    else:
+        lines.append("Лимит токенов не установлен.")
+    await update.message.reply_text("\n".join(lines))
+
+async def search_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/search <слова> — последние сообщения чата, содержащие все слова."""
+    chat_id = update.effective_chat.id
+    query = " ".join(context.args or []).strip()
+    found = await db.search_messages(chat_id, query, SEARCH_RESULTS) if query else None
+    if found is None:
+        await update.message.reply_text("Укажите слова для поиска длиннее двух букв, например: /search релиз")
+        return
+    if not found:
+        await update.message.reply_text(f"По запросу «{query}» ничего не найдено.")
+        return
+
+    lines = [f"Найдено сообщений: {len(found)}"]
+    for _, timestamp, author, text in found:
+        if len(text) > 200:
+            text = text[:200] + "…"
+        lines.append(f"{timestamp:%d.%m %H:%M} {author}: {text}")
+    # Ограничение Telegram — 4096 символов, старые совпадения отбрасываются первыми
+    while len(lines) > 2 and sum(len(line) + 1 for line in lines) > 4000:
+        del lines[1]
+    await update.message.reply_text("\n".join(lines))
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type == "private":
         await update.message.reply_text(
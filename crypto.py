@@ -1,22 +1,337 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+import base64
+import hmac
+import logging
 import os
+import threading
+import zlib
+
+import metrics
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, без него сообщения сжимаются zlib
+    zstandard = None
+
+# Пачки больше этого размера обрабатываются параллельно в пуле
+PARALLEL_THRESHOLD = int(os.getenv("CRYPTO_PARALLEL_THRESHOLD", "2000"))
+CHUNK_SIZE = int(os.getenv("CRYPTO_CHUNK_SIZE", "1000"))
+POOL_KIND = os.getenv("CRYPTO_POOL", "thread")  # thread или process
+WORKERS = int(os.getenv("CRYPTO_WORKERS", str(os.cpu_count() or 2)))
+
+# Формат хранения: байт версии, за ним токен Fernet в двоичном виде.
+# Внутри токена первый байт — способ сжатия текста. Строки (TEXT) —
+# старый формат: base64-токен Fernet с несжатым текстом.
+FORMAT_V1 = 1
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+# Более короткие сообщения без словаря не сжимаются: выигрыша не будет
+MIN_COMPRESS_SIZE = 64
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+Stored = Union[str, bytes]
+
+CRYPTO_SECONDS = metrics.histogram("crypto_batch_seconds", "Время обработки пачки сообщений", ("op",))
+CRYPTO_ITEMS = metrics.counter("crypto_messages_total", "Обработано сообщений", ("op",))
+
+_executor: Optional[Executor] = None
+# Словари zstd по dict_id; active — словарь для сжатия новых сообщений
+_dictionaries: Dict[int, bytes] = {}
+_active_dictionary: Optional[int] = None
+_generation = 0
+_local = threading.local()
+# Источник словарей для дозагрузки: словарь, обученный другим процессом,
+# появляется в БД раньше, чем этот процесс о нём узнает
+_dictionary_loader: Optional[Callable[[], Tuple[Dict[int, bytes], Optional[int]]]] = None
+_reload_lock = threading.Lock()
+
+
+class UnknownDictionary(ValueError):
+    """Сообщение сжато словарём, которого нет среди подключённых."""
+
+    def __init__(self, dict_id: int):
+        super().__init__(dict_id)
+        self.dict_id = dict_id
+
+    def __str__(self) -> str:
+        return f"Неизвестный словарь сжатия {self.dict_id}"
+
+def _load_keys() -> List[str]:
+    """Основной ключ и старые ключи, которые ещё нужны для расшифровки."""
+    keys = [os.getenv('ENCRYPTION_KEY')]
+    keys += os.getenv('ENCRYPTION_OLD_KEYS', '').split(',')
+    return [key.strip() for key in keys if key and key.strip()]
 
 # Инициализация ключа шифрования
-def get_cipher():
-    """Возвращает объект шифра на основе ключа из .env файла."""
-    key = os.getenv('ENCRYPTION_KEY')
-    if not key:
+@lru_cache(maxsize=1)
+def get_cipher() -> MultiFernet:
+    """Возвращает объект шифра на основе ключей из .env файла.
+
+    Первым идёт основной ключ ENCRYPTION_KEY, за ним ENCRYPTION_OLD_KEYS.
+    """
+    keys = _load_keys()
+    if not keys:
         raise ValueError("Ключ шифрования отсутствует в .env файле")
-    return Fernet(key)
+    return MultiFernet([Fernet(key) for key in keys])
 
-def encrypt_message(message: str) -> str:
-    """Шифрует текстовое сообщение."""
-    cipher = get_cipher()
-    encrypted = cipher.encrypt(message.encode())
-    return encrypted.decode()
+@lru_cache(maxsize=1)
+def _primary_cipher() -> Fernet:
+    keys = _load_keys()
+    if not keys:
+        raise ValueError("Ключ шифрования отсутствует в .env файле")
+    return Fernet(keys[0])
+
+@lru_cache(maxsize=1)
+def _index_key() -> bytes:
+    """Ключ слепого индекса поиска.
+
+    SEARCH_INDEX_KEY или, если он не задан, ключ, выведенный из основного
+    ENCRYPTION_KEY; во втором случае ротация ключа перестраивает индекс.
+    """
+    key = os.getenv('SEARCH_INDEX_KEY')
+    if key:
+        return key.encode()
+    keys = _load_keys()
+    if not keys:
+        raise ValueError("Ключ шифрования отсутствует в .env файле")
+    return hmac.digest(base64.urlsafe_b64decode(keys[0]), b"search-index", "sha256")
+
+def reset_cipher() -> None:
+    """Сбрасывает закэшированные шифры, например после смены ключей."""
+    get_cipher.cache_clear()
+    _primary_cipher.cache_clear()
+    _index_key.cache_clear()
+    _blind_term.cache_clear()
+
+def has_old_keys() -> bool:
+    """Есть ли ключи, с которых нужно перешифровать данные."""
+    return len(_load_keys()) > 1
+
+def install_dictionaries(dictionaries: Dict[int, bytes], active: Optional[int] = None) -> None:
+    """Подключает словари zstd для сжатия (active) и распаковки (все)."""
+    global _executor
+    if dictionaries and zstandard is None:
+        raise RuntimeError("Для словарей сжатия нужен пакет zstandard")
+    _set_dictionaries(dictionaries, active)
+    # Процессы пула получают словари при запуске, пересоздаём пул
+    if isinstance(_executor, ProcessPoolExecutor):
+        _executor.shutdown(wait=True)
+        _executor = None
+
+def _set_dictionaries(dictionaries: Dict[int, bytes], active: Optional[int]) -> None:
+    global _dictionaries, _active_dictionary, _generation
+    _dictionaries = dict(dictionaries)
+    _active_dictionary = active if active in _dictionaries else None
+    _generation += 1
+
+def _init_worker(dictionaries: Dict[int, bytes], active: Optional[int]) -> None:
+    """Инициализатор процесса пула.
+
+    При fork процесс наследует объект пула родителя: останавливать его
+    здесь (как в install_dictionaries) нельзя — процесс зависнет.
+    """
+    global _executor
+    _executor = None
+    _set_dictionaries(dictionaries, active)
+
+def set_dictionary_loader(loader: Optional[Callable[[], Tuple[Dict[int, bytes], Optional[int]]]]) -> None:
+    """Задаёт функцию, возвращающую (словари, active) для дозагрузки."""
+    global _dictionary_loader
+    _dictionary_loader = loader
+
+def _reload_dictionaries(dict_id: int) -> bool:
+    """Дозагружает словари, если dict_id ещё не известен; True — словарь есть."""
+    with _reload_lock:
+        if dict_id in _dictionaries:
+            # Другой поток уже дозагрузил
+            return True
+        if _dictionary_loader is None:
+            return False
+        dictionaries, active = _dictionary_loader()
+        if dict_id not in dictionaries:
+            return False
+        install_dictionaries(dictionaries, active)
+        return True
 
-def decrypt_message(encrypted_message: str) -> str:
-    """Расшифровывает текстовое сообщение."""
+def active_dictionary() -> Optional[int]:
+    return _active_dictionary
+
+def _codecs() -> dict:
+    """Кэш компрессоров потока: объекты zstd нельзя делить между потоками."""
+    cache = getattr(_local, "codecs", None)
+    if cache is None or cache["generation"] != _generation:
+        cache = {"generation": _generation, "decompressors": {}}
+        if zstandard is not None:
+            if _active_dictionary is not None:
+                dictionary = zstandard.ZstdCompressionDict(_dictionaries[_active_dictionary])
+                cache["compressor"] = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary)
+            else:
+                cache["compressor"] = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        _local.codecs = cache
+    return cache
+
+def _compress(data: bytes) -> bytes:
+    if len(data) < MIN_COMPRESS_SIZE and _active_dictionary is None:
+        return bytes([CODEC_NONE]) + data
+    if zstandard is not None:
+        packed = bytes([CODEC_ZSTD]) + _codecs()["compressor"].compress(data)
+    else:
+        packed = bytes([CODEC_ZLIB]) + zlib.compress(data, ZLIB_LEVEL)
+    if len(packed) > len(data):
+        return bytes([CODEC_NONE]) + data
+    return packed
+
+def _decompress(packed: bytes) -> bytes:
+    codec, data = packed[0], packed[1:]
+    if codec == CODEC_NONE:
+        return data
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Сообщение сжато zstd, а пакет zstandard не установлен")
+        decompressors = _codecs()["decompressors"]
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id and dict_id not in _dictionaries:
+                raise UnknownDictionary(dict_id)
+            dictionary = zstandard.ZstdCompressionDict(_dictionaries[dict_id]) if dict_id else None
+            decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+            decompressors[dict_id] = decompressor
+        return decompressor.decompress(data)
+    raise ValueError(f"Неизвестный способ сжатия {codec}")
+
+def _to_token(stored: bytes) -> bytes:
+    if not stored or stored[0] != FORMAT_V1:
+        raise ValueError("Неизвестный формат зашифрованного сообщения")
+    return base64.urlsafe_b64encode(stored[1:])
+
+def _from_token(token: bytes) -> bytes:
+    return bytes([FORMAT_V1]) + base64.urlsafe_b64decode(token)
+
+def encrypt_message(message: str) -> bytes:
+    """Сжимает и шифрует текстовое сообщение для хранения в BLOB."""
+    return _from_token(_primary_cipher().encrypt(_compress(message.encode())))
+
+def decrypt_message(encrypted_message: Stored) -> str:
+    """Расшифровывает сообщение в новом (bytes) или старом (str) формате."""
     cipher = get_cipher()
-    decrypted = cipher.decrypt(encrypted_message.encode())
-    return decrypted.decode()
+    if isinstance(encrypted_message, str):
+        return cipher.decrypt(encrypted_message.encode()).decode()
+    return _decompress(cipher.decrypt(_to_token(encrypted_message))).decode()
+
+def rotate_message(encrypted_message: Stored) -> Optional[bytes]:
+    """Перешифровывает сообщение основным ключом в текущем формате.
+
+    Возвращает None, если сообщение уже в новом формате и зашифровано
+    основным ключом. Сообщения старого формата конвертируются всегда.
+    """
+    if isinstance(encrypted_message, str):
+        return encrypt_message(decrypt_message(encrypted_message))
+    token = _to_token(encrypted_message)
+    try:
+        _primary_cipher().decrypt(token)
+        return None
+    except InvalidToken:
+        return _from_token(get_cipher().rotate(token))
+
+def seal_dictionary(data: bytes) -> bytes:
+    """Шифрует словарь сжатия: он собран из текстов сообщений."""
+    return _primary_cipher().encrypt(data)
+
+def open_dictionary(sealed: bytes) -> bytes:
+    return get_cipher().decrypt(sealed)
+
+def rotate_dictionary(sealed: bytes) -> Optional[bytes]:
+    """Перешифровывает словарь основным ключом, None — если это не нужно."""
+    try:
+        _primary_cipher().decrypt(sealed)
+        return None
+    except InvalidToken:
+        return get_cipher().rotate(sealed)
+
+# Словарь чата повторяется, поэтому хэши частых слов кэшируются
+@lru_cache(maxsize=65536)
+def _blind_term(chat_id: int, word: str) -> int:
+    digest = hmac.digest(_index_key(), f"{chat_id}:{word}".encode(), "sha256")
+    return int.from_bytes(digest[:6], "big", signed=True)
+
+def blind_terms(chat_id: int, words: Iterable[str]) -> List[int]:
+    """HMAC-хэши слов чата для слепого индекса — 48-битные целые со знаком.
+
+    chat_id входит в хэш, поэтому одно и то же слово в разных чатах
+    даёт разные термы и частоты слов чатов нельзя сопоставить.
+    """
+    return [_blind_term(chat_id, word) for word in words]
+
+def index_key_check() -> bytes:
+    """Отпечаток ключа индекса: по нему видно, что ключ сменился."""
+    return hmac.digest(_index_key(), b"key-check", "sha256")[:16]
+
+def _encrypt_chunk(messages: List[str]) -> List[bytes]:
+    return [encrypt_message(message) for message in messages]
+
+def _decrypt_chunk(encrypted_messages: List[Stored]) -> List[str]:
+    return [decrypt_message(message) for message in encrypted_messages]
+
+def _rotate_chunk(encrypted_messages: List[Stored]) -> List[Optional[bytes]]:
+    return [rotate_message(message) for message in encrypted_messages]
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if POOL_KIND == "process":
+            _executor = ProcessPoolExecutor(
+                max_workers=WORKERS,
+                initializer=_init_worker,
+                initargs=(_dictionaries, _active_dictionary),
+            )
+        else:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="crypto")
+    return _executor
+
+def _map(func, items: list, op: str) -> list:
+    """Применяет func к пачке, при большом объёме — по частям в пуле."""
+    CRYPTO_ITEMS.inc(len(items), op=op)
+    with CRYPTO_SECONDS.time(op=op):
+        try:
+            return _apply(func, items)
+        except UnknownDictionary as e:
+            if not _reload_dictionaries(e.dict_id):
+                raise
+            logging.info(f"Дозагружен словарь сжатия {e.dict_id}")
+            return _apply(func, items)
+
+def _apply(func, items: list) -> list:
+    if len(items) < PARALLEL_THRESHOLD:
+        return func(items)
+    chunks = [items[i:i + CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+    result = []
+    for part in _get_executor().map(func, chunks):
+        result.extend(part)
+    return result
+
+def encrypt_many(messages: List[str]) -> List[bytes]:
+    """Шифрует пачку сообщений с сохранением порядка."""
+    return _map(_encrypt_chunk, messages, "encrypt")
+
+def decrypt_many(encrypted_messages: List[Stored]) -> List[str]:
+    """Расшифровывает пачку сообщений с сохранением порядка."""
+    return _map(_decrypt_chunk, encrypted_messages, "decrypt")
+
+def rotate_many(encrypted_messages: List[Stored]) -> List[Optional[bytes]]:
+    """Перешифровывает пачку основным ключом, см. rotate_message."""
+    return _map(_rotate_chunk, encrypted_messages, "rotate")
+
+def shutdown() -> None:
+    """Останавливает пул шифрования."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -1,136 +1,494 @@
 import sqlite3
+import asyncio
 import logging
+import os
 from datetime import datetime
 from telegram import Update
 from telegram.ext import ContextTypes
-from typing import Optional
+from typing import Callable, List, Optional
 import crypto
+import hotcache
+import ingest
+import jobs
+import metrics
+import migrations
+import search
+import usage
+from pool import ConnectionPool
 
 # База данных SQLite
-DB_NAME = "digestBot.db"
+DB_NAME = os.getenv("DB_PATH", "digestBot.db")
 
-def get_connection() -> sqlite3.Connection:
-    return sqlite3.connect(DB_NAME)
+pool = ConnectionPool(DB_NAME, readers=int(os.getenv("DB_READERS", "4")))
+
+# Очередь фоновых задач (дайджесты по расписанию)
+# В режиме webhook каждый рабочий процесс ведёт свой шард чатов, см. webhook.Supervisor
+job_queue = jobs.JobQueue(
+    pool,
+    lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", "900")),
+    shards=int(os.getenv("SHARD_COUNT", "1")),
+    shard=int(os.getenv("SHARD_INDEX", "0")),
+)
+
+# Последние сообщения чатов в открытом виде, см. hotcache.HotCache
+hot_cache = hotcache.HotCache(
+    window=int(os.getenv("HOT_CACHE_WINDOW", "200")),
+    max_bytes=int(os.getenv("HOT_CACHE_MAX_MB", "64")) * 1024 * 1024,
+)
+
+# Журнал расхода нейросети, лимиты токенов чатов и размер дайджестов
+usage_ledger = usage.UsageLedger(
+    pool,
+    default_budget=int(os.getenv("CHAT_TOKEN_BUDGET", "0")),
+    window_days=int(os.getenv("USAGE_WINDOW_DAYS", "30")),
+    max_tokens=int(os.getenv("DIGEST_MAX_TOKENS", "7500")),
+    min_tokens=int(os.getenv("DIGEST_MIN_TOKENS", "500")),
+    input_tokens=int(os.getenv("PREFILTER_TOKEN_BUDGET", "24000")),
+)
+
+# Слепой индекс поиска по ключевым словам, см. search.BlindIndex
+search_index = search.BlindIndex(pool)
+
+# Подписчики на изменения расписаний, вызываются как listener(chat_id, next_run);
+# next_run равен None, если его нужно перечитать из БД
+schedule_listeners: List[Callable[[int, Optional[str]], None]] = []
+
+def _notify_schedule(chat_id: int, next_run: Optional[str] = None) -> None:
+    for listener in schedule_listeners:
+        try:
+            listener(chat_id, next_run)
+        except Exception as e:
+            logging.error(f"Ошибка уведомления об изменении расписания: {e}")
 
 def init_db() -> None:
-    """Инициализация базы данных."""
-    with get_connection() as conn:
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                username TEXT
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chats (
-                id INTEGER PRIMARY KEY,
-                chat_title TEXT
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                user_id INTEGER,
-                message TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chat_id) REFERENCES chats (id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS schedules (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            chat_id INTEGER,
-            frequency TEXT DEFAULT 'weekly', -- daily, every_tree_days, weekly
-            next_run DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        """)
-
-def set_schedule(user_id: int, chat_id: int, frequency: str) -> None:
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 1 FROM schedules WHERE chat_id = ?
-        """, (chat_id,))
-        
-        if cursor.fetchone():
-            cursor.execute("""
-                UPDATE schedules 
-                SET user_id = ?, frequency = ?, next_run = datetime('now')
-                WHERE chat_id = ?
-            """, (user_id, frequency, chat_id))
-        else:
-            cursor.execute("""
-                INSERT INTO schedules (user_id, chat_id, frequency, next_run)
-                VALUES (?, ?, ?, datetime('now'))
-            """, (user_id, chat_id, frequency))
-    update_next_run(chat_id)
-
-def get_schedule(user_id: int) -> Optional[tuple]:
+    """Инициализация базы данных и применение миграций схемы."""
+    with pool.writer() as conn:
+        migrations.migrate(conn)
+
+def _set_schedule(conn: sqlite3.Connection, user_id: int, chat_id: int, frequency: str) -> Optional[str]:
+    conn.execute("""
+        INSERT INTO schedules (user_id, chat_id, frequency, next_run)
+        VALUES (?, ?, ?, datetime('now'))
+        ON CONFLICT (chat_id) DO UPDATE
+        SET user_id = excluded.user_id, frequency = excluded.frequency
+    """, (user_id, chat_id, frequency))
+    return _update_next_run(conn, chat_id)
+
+async def set_schedule(user_id: int, chat_id: int, frequency: str) -> None:
+    next_run = await pool.write(_set_schedule, user_id, chat_id, frequency)
+    _notify_schedule(chat_id, next_run)
+
+def _get_schedule(conn: sqlite3.Connection, chat_id: int) -> Optional[tuple]:
+    return conn.execute("""
+        SELECT frequency, next_run FROM schedules
+        WHERE chat_id = ?
+    """, (chat_id,)).fetchone()
+
+async def get_schedule(user_id: int) -> Optional[tuple]:
     """Получает расписание пользователя."""
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT frequency, next_run FROM schedules
-            WHERE chat_id = ?
-        """, (user_id,))
-        return cursor.fetchone()
-    
-def update_next_run(chat_id: int) -> None:
+    return await pool.read(_get_schedule, user_id)
+
+def _get_next_run(conn: sqlite3.Connection, chat_id: int) -> Optional[str]:
+    row = conn.execute("""
+        SELECT next_run FROM schedules WHERE chat_id = ?
+    """, (chat_id,)).fetchone()
+    return row[0] if row else None
+
+async def get_next_run(chat_id: int) -> Optional[str]:
+    """Время следующего дайджеста чата (UTC)."""
+    return await pool.read(_get_next_run, chat_id)
+
+def _get_all_schedules(conn: sqlite3.Connection) -> List[tuple]:
+    return conn.execute("SELECT chat_id, next_run FROM schedules").fetchall()
+
+async def get_all_schedules() -> List[tuple]:
+    """Пары (chat_id, next_run) всех расписаний."""
+    return await pool.read(_get_all_schedules)
+
+def _update_next_run(conn: sqlite3.Connection, chat_id: int) -> Optional[str]:
+    conn.execute("""
+        UPDATE schedules
+        SET next_run = CASE frequency
+            WHEN 'daily' THEN datetime('now', '+1 day')
+            WHEN 'every_three_days' THEN datetime('now', '+3 day')
+            WHEN 'weekly' THEN datetime('now', '+7 day')
+        END
+        WHERE chat_id = ?
+    """, (chat_id,))
+    return _get_next_run(conn, chat_id)
+
+async def update_next_run(chat_id: int) -> None:
     """Обновляет время следующего запуска для пользователя."""
-    with get_connection() as conn:
-        conn.cursor().execute("""
-            UPDATE schedules
-            SET next_run = CASE frequency
-                WHEN 'daily' THEN datetime('now', '+1 day')
-                WHEN 'every_three_days' THEN datetime('now', '+3 day')
-                WHEN 'weekly' THEN datetime('now', '+7 day')
-            END
-            WHERE chat_id = ?
-        """, (chat_id,))
-
-def add_user(user_id, first_name, last_name, username) -> None:
-    with get_connection() as conn:
-        conn.cursor().execute("""
-            INSERT OR IGNORE INTO users (id, first_name, last_name, username)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, first_name, last_name, username))
-
-def add_chat(chat_id, titile) -> None:
-    with get_connection() as conn:
-        conn.cursor().execute("""
-            INSERT OR IGNORE INTO chats (id, chat_title)
-            VALUES (?, ?)
-        """, (chat_id, titile))
-
-def add_first_schedule(user_id, chat_id) -> None:
-    with get_connection() as conn:
-        conn.cursor().execute("""
-            INSERT OR IGNORE INTO schedules (user_id, chat_id, frequency, next_run)
-            VALUES (?, ?, 'weekly', datetime('now'))
-        """, (user_id, chat_id))
+    next_run = await pool.write(_update_next_run, chat_id)
+    _notify_schedule(chat_id, next_run)
+
+def _enqueue_due_digest(conn: sqlite3.Connection, chat_id: int, due: str) -> tuple:
+    # Сдвиг расписания и постановка задачи — одна транзакция: задача
+    # не потеряется, а второй процесс с тем же due ничего не сделает
+    cursor = conn.execute("""
+        UPDATE schedules
+        SET next_run = CASE frequency
+            WHEN 'daily' THEN datetime('now', '+1 day')
+            WHEN 'every_three_days' THEN datetime('now', '+3 day')
+            WHEN 'weekly' THEN datetime('now', '+7 day')
+        END
+        WHERE chat_id = ? AND next_run = ?
+    """, (chat_id, due))
+    job_id = None
+    if cursor.rowcount:
+        job_id = jobs.enqueue(conn, "digest", chat_id, dedupe_key=f"digest:{chat_id}:{due}")
+    return job_id, _get_next_run(conn, chat_id)
+
+async def enqueue_due_digest(chat_id: int, due: str) -> tuple:
+    """Ставит наступивший дайджест в очередь задач и сдвигает next_run.
+
+    Возвращает (id задачи или None, новое значение next_run).
+    """
+    return await pool.write(_enqueue_due_digest, chat_id, due)
+
+def _get_frequency(conn: sqlite3.Connection, chat_id: int) -> Optional[str]:
+    row = conn.execute("""
+        SELECT frequency FROM schedules WHERE chat_id = ?
+    """, (chat_id,)).fetchone()
+    return row[0] if row else None
+
+async def get_frequency(chat_id: int) -> Optional[str]:
+    """Частота дайджеста для чата."""
+    return await pool.read(_get_frequency, chat_id)
+
+def _get_recent_messages(conn: sqlite3.Connection, chat_id: int, limit: int) -> List[str]:
+    cursor = conn.execute("""
+        SELECT message FROM messages
+        WHERE chat_id = ?
+        ORDER BY timestamp DESC
+        LIMIT ?
+    """, (chat_id, limit))
+    return [row[0] for row in cursor.fetchall()]
+
+async def get_recent_messages(chat_id: int, limit: int = 100) -> List[str]:
+    """Последние зашифрованные сообщения чата, от новых к старым."""
+    return await pool.read(_get_recent_messages, chat_id, limit)
+
+def _get_recent_rows(conn: sqlite3.Connection, chat_id: int, limit: int) -> List[tuple]:
+    return conn.execute("""
+        SELECT id, timestamp, message FROM messages
+        WHERE chat_id = ?
+        ORDER BY timestamp DESC
+        LIMIT ?
+    """, (chat_id, limit)).fetchall()
+
+def _decrypt_rows(rows: List[tuple]) -> List[tuple]:
+    texts = crypto.decrypt_many([row[2] for row in rows])
+    return [
+        (row[0], datetime.fromisoformat(row[1]) if isinstance(row[1], str) else row[1], text)
+        for row, text in zip(rows, texts)
+    ]
+
+async def get_recent_texts(chat_id: int, limit: int = 100) -> List[str]:
+    """Тексты последних сообщений чата, от новых к старым.
+
+    Берутся из hot_cache; при промахе читаются из БД и прогревают кэш.
+    """
+    texts = hot_cache.recent(chat_id, limit)
+    if texts is not None:
+        return texts
+    rows = await pool.read(_get_recent_rows, chat_id, limit)
+    rows = await asyncio.to_thread(_decrypt_rows, rows[::-1])
+    hot_cache.warm(chat_id, rows, exhaustive=len(rows) < limit)
+    return [row[2] for row in reversed(rows)]
+
+def _get_messages_since(conn: sqlite3.Connection, chat_id: int, since: datetime) -> List[str]:
+    cursor = conn.execute("""
+        SELECT message FROM messages
+        WHERE timestamp > ?
+        AND chat_id = ?
+        ORDER BY timestamp
+    """, (since, chat_id))
+    return [row[0] for row in cursor.fetchall()]
+
+async def get_messages_since(chat_id: int, since: datetime) -> List[str]:
+    """Зашифрованные сообщения чата начиная с момента since."""
+    return await pool.read(_get_messages_since, chat_id, since)
+
+def _get_latest_message_id(conn: sqlite3.Connection, chat_id: int) -> Optional[int]:
+    return conn.execute("""
+        SELECT MAX(id) FROM messages WHERE chat_id = ?
+    """, (chat_id,)).fetchone()[0]
+
+async def get_latest_message_id(chat_id: int) -> Optional[int]:
+    """id последнего сохранённого сообщения чата."""
+    latest_id = hot_cache.latest_id(chat_id)
+    if latest_id is not None:
+        return latest_id
+    return await pool.read(_get_latest_message_id, chat_id)
+
+def _count_messages_since(conn: sqlite3.Connection, chat_id: int, since: datetime) -> int:
+    return conn.execute("""
+        SELECT COUNT(*) FROM messages
+        WHERE timestamp > ?
+        AND chat_id = ?
+    """, (since, chat_id)).fetchone()[0]
+
+async def count_messages_since(chat_id: int, since: datetime) -> int:
+    """Количество сообщений чата начиная с момента since."""
+    return await pool.read(_count_messages_since, chat_id, since)
+
+def _get_message_rows(conn: sqlite3.Connection, chat_id: int,
+                      start: datetime, end: datetime) -> List[tuple]:
+    return conn.execute("""
+        SELECT id, message FROM messages
+        WHERE chat_id = ?
+        AND timestamp >= ? AND timestamp < ?
+        ORDER BY timestamp
+    """, (chat_id, start, end)).fetchall()
+
+async def get_message_rows(chat_id: int, start: datetime, end: datetime) -> List[tuple]:
+    """Пары (id, зашифрованное сообщение) за полуинтервал [start, end)."""
+    return await pool.read(_get_message_rows, chat_id, start, end)
+
+def _get_found_messages(conn: sqlite3.Connection, chat_id: int, ids: List[int]) -> List[tuple]:
+    placeholders = ", ".join("?" * len(ids))
+    return conn.execute(f"""
+        SELECT m.id, m.timestamp, m.message, u.first_name, u.username
+        FROM messages m
+        LEFT JOIN users u ON u.id = m.user_id
+        WHERE m.chat_id = ? AND m.id IN ({placeholders})
+        ORDER BY m.id
+    """, (chat_id, *ids)).fetchall()
+
+def _decrypt_found(rows: List[tuple], query_words: List[str]) -> List[tuple]:
+    texts = crypto.decrypt_many([row[2] for row in rows])
+    return [
+        (row[0], datetime.fromisoformat(row[1]) if isinstance(row[1], str) else row[1],
+         row[3] or row[4] or "", text)
+        for row, text in zip(rows, texts)
+        if search.matches(text, query_words)
+    ]
+
+async def search_messages(chat_id: int, query: str, limit: int = 20) -> Optional[List[tuple]]:
+    """Последние сообщения чата со всеми словами запроса, от старых к новым.
+
+    Возвращает кортежи (id, время, автор, текст) или None, если в запросе
+    нет слов, которые попадают в индекс. Расшифровываются только
+    сообщения, найденные по слепому индексу.
+    """
+    query_words = search.words(query)
+    if not query_words:
+        return None
+    ids = await search_index.find(chat_id, query_words, limit)
+    if not ids:
+        return []
+    rows = await pool.read(_get_found_messages, chat_id, ids)
+    return await asyncio.to_thread(_decrypt_found, rows, query_words)
+
+def _get_summaries(conn: sqlite3.Connection, chat_id: int, period: str,
+                   start: datetime, end: datetime) -> List[tuple]:
+    return conn.execute("""
+        SELECT period_start, summary, message_count FROM summaries
+        WHERE chat_id = ? AND period = ?
+        AND period_start >= ? AND period_end <= ?
+        ORDER BY period_start
+    """, (chat_id, period, start, end)).fetchall()
+
+async def get_summaries(chat_id: int, period: str, start: datetime, end: datetime) -> List[tuple]:
+    """Закэшированные конспекты периодов, целиком лежащих в [start, end)."""
+    return await pool.read(_get_summaries, chat_id, period, start, end)
+
+def _save_summary(conn: sqlite3.Connection, chat_id: int, period: str,
+                  start: datetime, end: datetime, first_id: int, last_id: int,
+                  message_count: int, summary: str, cost: Optional[float]) -> bool:
+    # Пока строился конспект, в период могли прийти новые сообщения
+    actual = conn.execute("""
+        SELECT COUNT(*), MIN(id), MAX(id) FROM messages
+        WHERE chat_id = ?
+        AND timestamp >= ? AND timestamp < ?
+    """, (chat_id, start, end)).fetchone()
+    if actual != (message_count, first_id, last_id):
+        return False
+    conn.execute("""
+        INSERT OR REPLACE INTO summaries
+            (chat_id, period, period_start, period_end, first_message_id,
+             last_message_id, message_count, summary, cost)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (chat_id, period, start, end, first_id, last_id, message_count, summary, cost))
+    return True
+
+async def save_summary(chat_id: int, period: str, start: datetime, end: datetime,
+                       first_id: int, last_id: int, message_count: int,
+                       summary: str, cost: Optional[float] = None) -> bool:
+    """Сохраняет конспект периода, если его сообщения не изменились."""
+    return await pool.write(_save_summary, chat_id, period, start, end,
+                            first_id, last_id, message_count, summary, cost)
+
+def _get_chat_settings(conn: sqlite3.Connection, chat_id: int) -> Optional[tuple]:
+    return conn.execute("""
+        SELECT retention_days, archive FROM chat_settings WHERE chat_id = ?
+    """, (chat_id,)).fetchone()
+
+async def get_chat_settings(chat_id: int) -> Optional[tuple]:
+    """(retention_days, archive) чата или None, если настройки не менялись."""
+    return await pool.read(_get_chat_settings, chat_id)
+
+def _set_retention(conn: sqlite3.Connection, chat_id: int,
+                   retention_days: Optional[int], archive: bool) -> None:
+    conn.execute("""
+        INSERT INTO chat_settings (chat_id, retention_days, archive)
+        VALUES (?, ?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            retention_days = excluded.retention_days,
+            archive = excluded.archive,
+            updated_at = CURRENT_TIMESTAMP
+    """, (chat_id, retention_days, int(archive)))
+
+async def set_retention(chat_id: int, retention_days: Optional[int], archive: bool = False) -> None:
+    """Задаёт срок хранения сообщений чата; None — срок по умолчанию."""
+    await pool.write(_set_retention, chat_id, retention_days, archive)
+
+def _add_user(conn: sqlite3.Connection, user_id, first_name, last_name, username) -> None:
+    conn.execute("""
+        INSERT OR IGNORE INTO users (id, first_name, last_name, username)
+        VALUES (?, ?, ?, ?)
+    """, (user_id, first_name, last_name, username))
+
+async def add_user(user_id, first_name, last_name, username) -> None:
+    await pool.write(_add_user, user_id, first_name, last_name, username)
+
+def _add_chat(conn: sqlite3.Connection, chat_id, titile) -> None:
+    conn.execute("""
+        INSERT OR IGNORE INTO chats (id, chat_title)
+        VALUES (?, ?)
+    """, (chat_id, titile))
+
+async def add_chat(chat_id, titile) -> None:
+    await pool.write(_add_chat, chat_id, titile)
+
+def _add_first_schedule(conn: sqlite3.Connection, user_id, chat_id) -> None:
+    conn.execute("""
+        INSERT OR IGNORE INTO schedules (user_id, chat_id, frequency, next_run)
+        VALUES (?, ?, 'weekly', datetime('now'))
+    """, (user_id, chat_id))
+
+async def add_first_schedule(user_id, chat_id) -> None:
+    await pool.write(_add_first_schedule, user_id, chat_id)
+    _notify_schedule(chat_id)
+
+def _encrypt_batch(batch: List[ingest.PendingMessage]) -> tuple:
+    """Зашифрованные строки пачки и термы слепого индекса каждого сообщения."""
+    encrypted = crypto.encrypt_many([item.text for item in batch])
+    rows = [
+        (item.chat_id, item.user_id, message, item.timestamp)
+        for item, message in zip(batch, encrypted)
+    ]
+    return rows, [search_index.terms(item.chat_id, item.text) for item in batch]
+
+def _write_batch(conn: sqlite3.Connection, batch: List[ingest.PendingMessage],
+                 rows: List[tuple], terms: List[List[int]]) -> tuple:
+    """Записывает пачку вместе с её термами поиска и возвращает чаты, для которых создано расписание."""
+    chats = {}
+    users = {}
+    first_schedules = {}
+    for item in batch:
+        chats.setdefault(item.chat_id, (item.chat_id, item.chat_title))
+        users.setdefault(item.user_id, (item.user_id, item.first_name, item.last_name, item.username))
+        first_schedules.setdefault(item.chat_id, (item.user_id, item.chat_id))
+
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT OR IGNORE INTO chats (id, chat_title)
+        VALUES (?, ?)
+    """, list(chats.values()))
+    cursor.executemany("""
+        INSERT OR IGNORE INTO users (id, first_name, last_name, username)
+        VALUES (?, ?, ?, ?)
+    """, list(users.values()))
+    cursor.executemany("""
+        INSERT INTO messages (chat_id, user_id, message, timestamp, indexed)
+        VALUES (?, ?, ?, ?, 1)
+    """, rows)
+    # Вставка идёт одной транзакцией единственного писателя, поэтому id
+    # пачки идут подряд и заканчиваются last_insert_rowid()
+    last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+    first_id = last_id - len(rows) + 1
+    cursor.executemany("""
+        INSERT OR IGNORE INTO message_terms (term, message_id)
+        VALUES (?, ?)
+    """, [
+        (term, first_id + offset)
+        for offset, item_terms in enumerate(terms)
+        for term in item_terms
+    ])
+    # Расписание по умолчанию для чатов, которые видим впервые
+    chat_ids = list(first_schedules)
+    placeholders = ", ".join("?" * len(chat_ids))
+    known = {
+        row[0] for row in cursor.execute(
+            f"SELECT chat_id FROM schedules WHERE chat_id IN ({placeholders})", chat_ids
+        )
+    }
+    new_chats = [chat_id for chat_id in chat_ids if chat_id not in known]
+    cursor.executemany("""
+        INSERT OR IGNORE INTO schedules (user_id, chat_id, frequency, next_run)
+        VALUES (?, ?, 'weekly', datetime('now'))
+    """, [first_schedules[chat_id] for chat_id in new_chats])
+    return new_chats, first_id
+
+INGEST_MESSAGES = metrics.counter("ingest_messages_total", "Записано входящих сообщений")
+INGEST_FLUSH_SECONDS = metrics.histogram("ingest_flush_seconds", "Время записи пачки сообщений")
+
+async def _flush_messages(batch: List[ingest.PendingMessage]) -> None:
+    """Шифрует пачку сообщений и записывает её одной транзакцией."""
+    with INGEST_FLUSH_SECONDS.time():
+        rows, terms = await asyncio.to_thread(_encrypt_batch, batch)
+        new_chats, first_id = await pool.write(_write_batch, batch, rows, terms)
+    INGEST_MESSAGES.inc(len(batch))
+    by_chat = {}
+    for offset, item in enumerate(batch):
+        by_chat.setdefault(item.chat_id, []).append((first_id + offset, item.timestamp, item.text))
+    for chat_id, chat_rows in by_chat.items():
+        hot_cache.append(chat_id, chat_rows)
+    for chat_id in new_chats:
+        _notify_schedule(chat_id)
+
+# Буфер отложенной записи входящих сообщений
+message_buffer = ingest.MessageBuffer(
+    _flush_messages,
+    max_size=int(os.getenv("INGEST_BATCH_SIZE", "500")),
+    max_delay=float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0")),
+)
+
+metrics.gauge("ingest_buffer_depth", "Сообщений в буфере записи", func=lambda: len(message_buffer))
+metrics.gauge("hot_cache_bytes", "Объём кэша последних сообщений", func=lambda: hot_cache.size)
+metrics.gauge("hot_cache_chats", "Чатов в кэше последних сообщений", func=lambda: len(hot_cache))
+metrics.gauge("hot_cache_hits", "Попадания в кэш последних сообщений", func=lambda: hot_cache.hits)
+metrics.gauge("hot_cache_misses", "Промахи кэша последних сообщений", func=lambda: hot_cache.misses)
+
+JOBS = metrics.gauge("jobs", "Задачи в очереди по статусам", ("status",))
+
+async def _collect_jobs() -> None:
+    for status, count in (await job_queue.counts()).items():
+        JOBS.set(count, status=status)
+
+metrics.registry.on_collect(_collect_jobs)
+
+USAGE_TODAY_TOKENS = metrics.gauge("usage_today_tokens", "Токенов израсходовано за сутки (UTC)")
+USAGE_TODAY_COST = metrics.gauge("usage_today_cost", "Стоимость запросов за сутки (UTC)")
+
+async def _collect_usage() -> None:
+    today = await usage_ledger.totals(days=1)
+    USAGE_TODAY_TOKENS.set(today.tokens)
+    USAGE_TODAY_COST.set(today.cost)
+
+metrics.registry.on_collect(_collect_usage)
 
 async def save_message(chat_id, chat_title, user_id, 
                        user_first_name, user_last_name, 
                        username, message) -> None:
-    """Сохраняет сообщение в базу данных."""
-    encrypted_message = crypto.encrypt_message(message)  # Шифруем текст
-    add_chat(chat_id, chat_title)  # Убедимся, что чат существует
-    add_user(user_id, user_first_name, user_last_name, username)  # Убедимся, что пользователь существует
-
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO messages (chat_id, user_id, message, timestamp)
-            VALUES (?, ?, ?, ?)
-        """, (chat_id, user_id, encrypted_message, datetime.now()))
+    """Ставит сообщение в очередь на запись в базу данных."""
+    await message_buffer.put(ingest.PendingMessage(
+        chat_id, chat_title, user_id,
+        user_first_name, user_last_name, username,
+        message, datetime.now()
+    ))
 
 
 async def collect_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -150,11 +508,4 @@ async def collect_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     await save_message(chat_id, chat_title, user_id, user_first_name, user_last_name, username, message)
 
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT chat_id FROM schedules")
-        existing_chat_ids = [row[0] for row in cursor.fetchall()]
-        if chat_id not in existing_chat_ids:
-            add_first_schedule(user_id, chat_id)
-
     logging.info(f"Сохранено сообщение: {user_first_name, user_last_name} -- {message}")
\ No newline at end of file
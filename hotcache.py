@@ -0,0 +1,159 @@
+import sys
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Iterable, List, Optional, Tuple
+
+# Примерный размер записи без текста: объект со слотами, int и datetime
+ENTRY_OVERHEAD = 160
+
+
+class _Entry:
+    __slots__ = ("id", "timestamp", "text")
+
+    def __init__(self, message_id: int, timestamp: datetime, text: str):
+        self.id = message_id
+        self.timestamp = timestamp
+        self.text = text
+
+    def size(self) -> int:
+        return ENTRY_OVERHEAD + sys.getsizeof(self.text)
+
+
+class _Window:
+    __slots__ = ("entries", "exhaustive", "size")
+
+    def __init__(self):
+        self.entries: Deque[_Entry] = deque()
+        # True — в окне все сообщения чата, а не только последние
+        self.exhaustive = False
+        self.size = 0
+
+
+class HotCache:
+    """Последние сообщения чатов в открытом виде.
+
+    Для каждого чата хранится окно из не более чем window последних
+    сообщений — непрерывный хвост переписки, каким он записан в БД.
+    Окно пополняется при записи пачки сообщений и прогревается из БД
+    при промахе. Суммарный объём ограничен max_bytes: при превышении
+    вытесняются окна чатов, к которым дольше всего не обращались.
+    Все методы вызываются из потока event loop.
+    """
+
+    def __init__(self, window: int = 200, max_bytes: int = 64 * 1024 * 1024):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._chats: "OrderedDict[int, _Window]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def _touch(self, chat_id: int) -> Optional[_Window]:
+        window = self._chats.get(chat_id)
+        if window is not None:
+            self._chats.move_to_end(chat_id)
+        return window
+
+    def _push(self, window: _Window, entry: _Entry) -> None:
+        window.entries.append(entry)
+        size = entry.size()
+        window.size += size
+        self.size += size
+        if len(window.entries) > self.window:
+            dropped = window.entries.popleft()
+            window.size -= dropped.size()
+            self.size -= dropped.size()
+            window.exhaustive = False
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and len(self._chats) > 1:
+            _, window = self._chats.popitem(last=False)
+            self.size -= window.size
+
+    def append(self, chat_id: int, rows: Iterable[Tuple[int, datetime, str]]) -> None:
+        """Добавляет только что записанные сообщения (id, время, текст)."""
+        window = self._touch(chat_id)
+        if window is None:
+            window = self._chats[chat_id] = _Window()
+        last_id = window.entries[-1].id if window.entries else 0
+        for message_id, timestamp, text in rows:
+            # Прогрев мог уже прочитать эти сообщения из БД
+            if message_id > last_id:
+                self._push(window, _Entry(message_id, timestamp, text))
+                last_id = message_id
+        self._evict()
+
+    def warm(self, chat_id: int, rows: List[Tuple[int, datetime, str]], exhaustive: bool) -> None:
+        """Заполняет окно строками из БД (от старых к новым).
+
+        Сообщения, записанные в окно после снимка БД, сохраняются.
+        """
+        window = self._touch(chat_id)
+        newer = []
+        if window is not None:
+            last_id = rows[-1][0] if rows else 0
+            newer = [entry for entry in window.entries if entry.id > last_id]
+            self.size -= window.size
+        window = self._chats[chat_id] = _Window()
+        window.exhaustive = exhaustive
+        for message_id, timestamp, text in rows:
+            self._push(window, _Entry(message_id, timestamp, text))
+        for entry in newer:
+            self._push(window, entry)
+        self._evict()
+
+    def recent(self, chat_id: int, limit: int) -> Optional[List[str]]:
+        """Тексты limit последних сообщений, от новых к старым, или None при промахе."""
+        window = self._touch(chat_id)
+        if window is None or (len(window.entries) < limit and not window.exhaustive):
+            self.misses += 1
+            return None
+        self.hits += 1
+        entries = window.entries
+        return [entries[-i].text for i in range(1, min(limit, len(entries)) + 1)]
+
+    def latest_id(self, chat_id: int) -> Optional[int]:
+        """id последнего сообщения чата, если окно чата в кэше и не пусто."""
+        window = self._touch(chat_id)
+        if window is None or not window.entries:
+            return None
+        return window.entries[-1].id
+
+    def range(self, chat_id: int, start: datetime, end: datetime) -> Optional[List[Tuple[int, str]]]:
+        """Пары (id, текст) за полуинтервал [start, end), если окно его покрывает."""
+        window = self._touch(chat_id)
+        if window is None or not (window.exhaustive or (
+            window.entries and window.entries[0].timestamp < start
+        )):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [
+            (entry.id, entry.text)
+            for entry in window.entries
+            if start <= entry.timestamp < end
+        ]
+
+    def trim(self, chat_id: int, before: datetime) -> None:
+        """Убирает сообщения старше before — вслед за удалением из БД."""
+        window = self._chats.get(chat_id)
+        if window is None:
+            return
+        while window.entries and window.entries[0].timestamp < before:
+            dropped = window.entries.popleft()
+            window.size -= dropped.size()
+            self.size -= dropped.size()
+            # Всё, что старше, из БД тоже удалено: окно содержит весь чат
+            window.exhaustive = True
+
+    def drop(self, chat_id: int) -> None:
+        window = self._chats.pop(chat_id, None)
+        if window is not None:
+            self.size -= window.size
+
+    def clear(self) -> None:
+        self._chats.clear()
+        self.size = 0
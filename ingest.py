@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, List, NamedTuple, Optional
+
+
+class PendingMessage(NamedTuple):
+    """Сообщение, принятое обработчиком, но ещё не записанное в БД."""
+    chat_id: int
+    chat_title: Optional[str]
+    user_id: int
+    first_name: Optional[str]
+    last_name: Optional[str]
+    username: Optional[str]
+    text: str
+    timestamp: datetime
+
+
+class MessageBuffer:
+    """Буфер отложенной записи: копит сообщения и сбрасывает их пачками.
+
+    Сброс выполняется функцией flush_func, когда в буфере набирается
+    max_size сообщений или проходит max_delay секунд с момента первого
+    несброшенного сообщения.
+    """
+
+    def __init__(self, flush_func: Callable[[List[PendingMessage]], Awaitable[None]],
+                 max_size: int = 500, max_delay: float = 1.0,
+                 max_pending: int = 20000):
+        self._flush_func = flush_func
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._items: List[PendingMessage] = []
+        self._has_items = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def start(self) -> None:
+        """Запускает фоновый цикл сброса."""
+        if self._task is None:
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, item: PendingMessage) -> None:
+        """Ставит сообщение в буфер, не дожидаясь записи на диск."""
+        if self._closed:
+            raise RuntimeError("Буфер сообщений уже остановлен")
+        self._items.append(item)
+        self._has_items.set()
+        if len(self._items) >= self.max_size:
+            self._full.set()
+        # Диск не успевает: притормаживаем обработчик до ближайшего сброса
+        if len(self._items) >= self.max_pending:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Записывает всё накопленное одной транзакцией."""
+        async with self._flush_lock:
+            batch, self._items = self._items, []
+            if not batch:
+                return 0
+            try:
+                await self._flush_func(batch)
+            except Exception as e:
+                logging.error(f"Ошибка записи пачки из {len(batch)} сообщений: {e}")
+                # Возвращаем пачку в начало буфера, чтобы не потерять сообщения
+                self._items = batch + self._items
+                self._has_items.set()
+                raise
+            logging.debug(f"Записано сообщений: {len(batch)}")
+            return len(batch)
+
+    async def _run(self) -> None:
+        while not self._closed:
+            await self._has_items.wait()
+            if len(self._items) < self.max_size and not self._closed:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._has_items.clear()
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.max_delay)
+
+    async def stop(self) -> None:
+        """Останавливает цикл и дописывает остаток буфера на диск.
+
+        Цикл не отменяется, а будится и доводит начатый сброс до конца:
+        отмена посреди записи потеряла бы уже изъятую из буфера пачку.
+        """
+        self._closed = True
+        if self._task is not None:
+            self._has_items.set()
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
@@ -0,0 +1,213 @@
+import logging
+import os
+import socket
+import sqlite3
+import uuid
+from typing import NamedTuple, Optional
+
+from pool import ConnectionPool
+
+# Идентификатор процесса, который берёт задачи из очереди
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    """Номер шарда чата; то же выражение используется в claim."""
+    return abs(chat_id) % shards
+
+
+class Job(NamedTuple):
+    """Задача, выданная обработчику вместе с арендой."""
+    id: int
+    kind: str
+    chat_id: Optional[int]
+    attempts: int
+    max_attempts: int
+    lease_token: str
+
+
+def enqueue(conn: sqlite3.Connection, kind: str, chat_id: Optional[int] = None,
+            dedupe_key: Optional[str] = None, delay: float = 0,
+            max_attempts: int = 5) -> Optional[int]:
+    """Добавляет задачу; при совпадении dedupe_key возвращает None."""
+    cursor = conn.execute("""
+        INSERT OR IGNORE INTO jobs (kind, chat_id, dedupe_key, max_attempts, run_at)
+        VALUES (?, ?, ?, ?, datetime('now', ?))
+    """, (kind, chat_id, dedupe_key, max_attempts, f"+{delay} seconds"))
+    return cursor.lastrowid if cursor.rowcount else None
+
+
+def claim(conn: sqlite3.Connection, worker: str, lease_seconds: float,
+          shards: int = 1, shard: int = 0) -> Optional[Job]:
+    """Атомарно берёт ближайшую готовую задачу в аренду.
+
+    Подходят ожидающие задачи с наступившим run_at и задачи, аренда
+    которых истекла (их обработчик, скорее всего, упал). Задачи чата,
+    по которому уже идёт работа, пропускаются, как и задачи чатов
+    чужого шарда (см. shard_of).
+    """
+    token = f"{worker}:{uuid.uuid4().hex}"
+    cursor = conn.execute("""
+        UPDATE jobs
+        SET status = 'running', lease_owner = ?,
+            lease_until = datetime('now', ?),
+            attempts = attempts + 1, updated_at = datetime('now')
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE run_at <= datetime('now')
+            AND (status = 'pending' OR (status = 'running' AND lease_until <= datetime('now')))
+            AND (chat_id IS NULL OR chat_id NOT IN (
+                SELECT chat_id FROM jobs
+                WHERE status = 'running' AND lease_until > datetime('now')
+                AND chat_id IS NOT NULL
+            ))
+            AND (chat_id IS NULL OR abs(chat_id) % ? = ?)
+            ORDER BY run_at
+            LIMIT 1
+        )
+    """, (token, f"+{lease_seconds} seconds", shards, shard))
+    if not cursor.rowcount:
+        return None
+    row = conn.execute("""
+        SELECT id, kind, chat_id, attempts, max_attempts FROM jobs
+        WHERE lease_owner = ?
+    """, (token,)).fetchone()
+    return Job(*row, lease_token=token)
+
+
+def extend(conn: sqlite3.Connection, job: Job, lease_seconds: float) -> bool:
+    """Продлевает аренду; False, если задачу уже забрал другой обработчик."""
+    cursor = conn.execute("""
+        UPDATE jobs SET lease_until = datetime('now', ?), updated_at = datetime('now')
+        WHERE id = ? AND lease_owner = ? AND status = 'running'
+    """, (f"+{lease_seconds} seconds", job.id, job.lease_token))
+    return cursor.rowcount > 0
+
+
+def complete(conn: sqlite3.Connection, job: Job) -> bool:
+    """Отмечает задачу выполненной. Повторный вызов ничего не меняет."""
+    cursor = conn.execute("""
+        UPDATE jobs
+        SET status = 'done', lease_owner = NULL, lease_until = NULL,
+            last_error = NULL, updated_at = datetime('now')
+        WHERE id = ? AND lease_owner = ? AND status = 'running'
+    """, (job.id, job.lease_token))
+    return cursor.rowcount > 0
+
+
+def fail(conn: sqlite3.Connection, job: Job, error: str, backoff: float) -> Optional[str]:
+    """Возвращает задачу в очередь с задержкой или переводит её в dead.
+
+    Возвращает новый статус задачи либо None, если аренда уже потеряна.
+    """
+    status = 'dead' if job.attempts >= job.max_attempts else 'pending'
+    cursor = conn.execute("""
+        UPDATE jobs
+        SET status = ?, lease_owner = NULL, lease_until = NULL, last_error = ?,
+            run_at = datetime('now', ?), updated_at = datetime('now')
+        WHERE id = ? AND lease_owner = ? AND status = 'running'
+    """, (status, error[:1000], f"+{backoff} seconds", job.id, job.lease_token))
+    return status if cursor.rowcount else None
+
+
+def recover(conn: sqlite3.Connection) -> int:
+    """Возвращает в очередь задачи с истёкшей арендой."""
+    cursor = conn.execute("""
+        UPDATE jobs
+        SET status = 'pending', lease_owner = NULL, lease_until = NULL,
+            updated_at = datetime('now')
+        WHERE status = 'running' AND lease_until <= datetime('now')
+    """)
+    return cursor.rowcount
+
+
+def seconds_until_next(conn: sqlite3.Connection, shards: int = 1, shard: int = 0) -> Optional[float]:
+    """Через сколько секунд наступит ближайшая отложенная задача своего шарда."""
+    row = conn.execute("""
+        SELECT (julianday(MIN(run_at)) - julianday('now')) * 86400
+        FROM jobs WHERE status = 'pending'
+        AND (chat_id IS NULL OR abs(chat_id) % ? = ?)
+    """, (shards, shard)).fetchone()
+    return row[0]
+
+
+def counts(conn: sqlite3.Connection) -> dict:
+    """Число задач по статусам."""
+    return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+def purge(conn: sqlite3.Connection, older_than_days: int = 7,
+          dead_older_than_days: Optional[int] = None) -> int:
+    """Удаляет давно выполненные задачи, а при dead_older_than_days — и мёртвые."""
+    cursor = conn.execute("""
+        DELETE FROM jobs
+        WHERE status = 'done' AND updated_at < datetime('now', ?)
+    """, (f"-{older_than_days} days",))
+    count = cursor.rowcount
+    if dead_older_than_days is not None:
+        cursor = conn.execute("""
+            DELETE FROM jobs
+            WHERE status = 'dead' AND updated_at < datetime('now', ?)
+        """, (f"-{dead_older_than_days} days",))
+        count += cursor.rowcount
+    return count
+
+
+class JobQueue:
+    """Асинхронная обёртка над таблицей jobs поверх пула соединений.
+
+    При shards > 1 процесс обрабатывает задачи только своих чатов —
+    тех, для которых shard_of(chat_id, shards) == shard.
+    """
+
+    def __init__(self, pool: ConnectionPool, worker: str = WORKER_ID,
+                 lease_seconds: float = 900.0, backoff_base: float = 60.0,
+                 backoff_max: float = 3600.0, shards: int = 1, shard: int = 0):
+        self.pool = pool
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.shards = shards
+        self.shard = shard
+
+    def owns(self, chat_id: int) -> bool:
+        """Относится ли чат к шарду этого процесса."""
+        return shard_of(chat_id, self.shards) == self.shard
+
+    async def enqueue(self, kind: str, chat_id: Optional[int] = None,
+                      dedupe_key: Optional[str] = None, delay: float = 0,
+                      max_attempts: int = 5) -> Optional[int]:
+        return await self.pool.write(enqueue, kind, chat_id, dedupe_key, delay, max_attempts)
+
+    async def claim(self) -> Optional[Job]:
+        return await self.pool.write(claim, self.worker, self.lease_seconds, self.shards, self.shard)
+
+    async def extend(self, job: Job) -> bool:
+        return await self.pool.write(extend, job, self.lease_seconds)
+
+    async def complete(self, job: Job) -> bool:
+        return await self.pool.write(complete, job)
+
+    async def fail(self, job: Job, error: str) -> Optional[str]:
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** (job.attempts - 1))
+        status = await self.pool.write(fail, job, error, backoff)
+        if status == 'dead':
+            logging.error(f"Задача {job.id} ({job.kind}) исчерпала попытки: {error}")
+        return status
+
+    async def recover(self) -> int:
+        count = await self.pool.write(recover)
+        if count:
+            logging.info(f"Возвращено в очередь задач с истёкшей арендой: {count}")
+        return count
+
+    async def seconds_until_next(self) -> Optional[float]:
+        return await self.pool.read(seconds_until_next, self.shards, self.shard)
+
+    async def counts(self) -> dict:
+        return await self.pool.read(counts)
+
+    async def purge(self, older_than_days: int = 7,
+                    dead_older_than_days: Optional[int] = None) -> int:
+        return await self.pool.write(purge, older_than_days, dead_older_than_days)
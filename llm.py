@@ -0,0 +1,279 @@
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+import httpx
+
+import metrics
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+LLM_REQUEST_SECONDS = metrics.histogram("llm_request_seconds", "Время HTTP-запроса к API нейросети", ("path", "status"))
+LLM_CALL_SECONDS = metrics.histogram("llm_call_seconds", "Время ответа API нейросети с учётом повторов", ("func", "model"))
+LLM_RETRIES = metrics.counter("llm_retries_total", "Повторы запросов к API нейросети", ("path",))
+LLM_TOKENS = metrics.counter("llm_tokens_total", "Израсходовано токенов", ("chat_id", "kind"))
+LLM_COST = metrics.counter("llm_cost_total", "Стоимость запросов (usage.total_cost)", ("chat_id",))
+
+
+class LLMError(Exception):
+    """Ошибка обращения к API нейросети."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Completion(NamedTuple):
+    """Ответ модели вместе со статистикой запроса."""
+    content: str
+    cost: Optional[float]
+    usage: dict
+    model: str
+    latency: float
+
+
+class UsageTally:
+    """Расход на несколько запросов к модели — например, на один дайджест.
+
+    Пока накопитель установлен в current_usage, каждый успешный
+    complete() добавляет в него свои токены и стоимость. Если API не
+    вернул usage, токены оцениваются по длине текста.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.models: Counter = Counter()
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def model(self) -> str:
+        """Модель, сгенерировавшая больше всего токенов."""
+        return self.models.most_common(1)[0][0] if self.models else ""
+
+    def add(self, usage: dict, model: str, prompt: str, content: str) -> None:
+        prompt_tokens = usage.get("prompt_tokens") or len(prompt) // 3 + 1
+        completion_tokens = usage.get("completion_tokens") or len(content) // 3 + 1
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cost += usage.get("total_cost") or 0.0
+        self.models[model] += completion_tokens
+
+
+# Накопитель расхода текущей задачи; дочерние задачи asyncio видят тот же объект
+current_usage: contextvars.ContextVar[Optional[UsageTally]] = contextvars.ContextVar("current_usage", default=None)
+
+
+class LLMClient:
+    """Асинхронный клиент OpenAI-совместимого API с пулом соединений.
+
+    Одновременно выполняется не больше max_concurrency запросов; при
+    сетевых ошибках и статусах из RETRY_STATUSES запрос повторяется с
+    экспоненциальной задержкой и случайным разбросом, заголовок
+    Retry-After имеет приоритет.
+    """
+
+    def __init__(self, base_url: str, token: Optional[str], model: str,
+                 max_concurrency: int = 8, timeout: float = 120.0,
+                 max_retries: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 30.0):
+        self.base_url = base_url
+        self.token = token
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": self.token or ""},
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+        return self._client
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> Optional[float]:
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    async def _read_stream(response: httpx.Response,
+                           on_progress: Callable[[str], Awaitable[None]]) -> dict:
+        """Читает SSE-поток и собирает его в ответ обычного формата."""
+        if response.headers.get("content-type", "").startswith("application/json"):
+            # Провайдер проигнорировал stream и вернул ответ целиком
+            await response.aread()
+            return response.json()
+        text = ""
+        usage, model = {}, None
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                chunk = json.loads(payload)
+            except ValueError:
+                continue
+            usage = chunk.get("usage") or usage
+            model = chunk.get("model") or model
+            delta = "".join(
+                (choice.get("delta") or {}).get("content") or ""
+                for choice in chunk.get("choices") or []
+            )
+            if delta:
+                text += delta
+                await on_progress(text)
+        return {
+            "choices": [{"message": {"content": text}}],
+            "usage": usage,
+            "model": model,
+        }
+
+    async def _request(self, method: str, path: str,
+                       on_progress: Optional[Callable[[str], Awaitable[None]]] = None,
+                       **kwargs) -> dict:
+        """Выполняет запрос с повторами и возвращает разобранный JSON.
+
+        С on_progress ответ читается потоком (SSE), а on_progress получает
+        накопленный текст после каждого фрагмента.
+        """
+        client = self._get_client()
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    if on_progress is None:
+                        response = await client.request(method, path, **kwargs)
+                    else:
+                        async with client.stream(method, path, **kwargs) as response:
+                            if response.status_code == 200:
+                                data = await self._read_stream(response, on_progress)
+                                LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, path=path, status=200)
+                                return data
+                            await response.aread()
+            except httpx.TransportError as e:
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, path=path, status="network")
+                error = LLMError(f"Сетевая ошибка: {e!r}")
+                delay = self._backoff(attempt)
+            else:
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, path=path, status=response.status_code)
+                if response.status_code == 200:
+                    try:
+                        return response.json()
+                    except ValueError:
+                        raise LLMError("Некорректный JSON в ответе", response.status_code)
+                error = LLMError(
+                    f"{response.status_code} — {response.text[:500]}",
+                    response.status_code
+                )
+                if response.status_code not in RETRY_STATUSES:
+                    raise error
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                delay = min(delay, self.backoff_max * 4)
+            if attempt == self.max_retries:
+                raise error
+            logging.warning(f"Запрос {path} не удался ({error}), повтор через {delay:.1f} с")
+            LLM_RETRIES.inc(path=path)
+            await asyncio.sleep(delay)
+        raise LLMError("Превышено число попыток")
+
+    async def complete(self, context: str, prompt: str, max_tokens: int = 7500,
+                       temperature: float = 0.6,
+                       on_progress: Optional[Callable[[str], Awaitable[None]]] = None) -> Completion:
+        """Запрашивает ответ модели на пару системное сообщение + промпт.
+
+        Если передан on_progress, ответ запрашивается потоком и
+        on_progress вызывается с уже полученной частью текста.
+        """
+        started = time.monotonic()
+        payload = {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": [
+                {"role": "system", "content": context},
+                {"role": "user", "content": prompt},
+            ],
+        }
+        if on_progress is not None:
+            payload["stream"] = True
+        with LLM_CALL_SECONDS.time(func="complete", model=self.model):
+            data = await self._request("POST", "/v1/chat/completions", on_progress=on_progress, json=payload)
+        try:
+            content = data["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            raise LLMError(f"Неожиданный формат ответа: {str(data)[:500]}")
+        usage = data.get("usage") or {}
+        logging.debug(f"Ответ модели {self.model}, использование: {usage}")
+        chat_id = metrics.current_chat.get()
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if usage.get(kind):
+                LLM_TOKENS.inc(usage[kind], chat_id=chat_id, kind=kind)
+        if usage.get("total_cost"):
+            LLM_COST.inc(usage["total_cost"], chat_id=chat_id)
+        model = data.get("model") or self.model
+        tally = current_usage.get()
+        if tally is not None:
+            tally.add(usage, model, context + prompt, content)
+        return Completion(
+            content=content,
+            cost=usage.get("total_cost"),
+            usage=usage,
+            model=model,
+            latency=time.monotonic() - started,
+        )
+
+    async def balance(self) -> float:
+        """Текущий баланс аккаунта."""
+        with LLM_CALL_SECONDS.time(func="balance", model=self.model):
+            data = await self._request("GET", "/v1/balance")
+        try:
+            return data["balance"]
+        except (KeyError, TypeError):
+            raise LLMError(f"Неожиданный формат ответа: {str(data)[:500]}")
+
+    async def aclose(self) -> None:
+        """Закрывает соединения пула."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -1,15 +1,16 @@
 # main.py
 import db
 import command
+import crypto
+import maintenance
+import metrics
+import webhook
 import logging
 import os
 from dotenv import load_dotenv
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ChatMemberHandler
-import schedule
-import time
-import threading
-import asyncio
-from queue import Queue
+from telegram.ext import CommandHandler, MessageHandler, filters, ChatMemberHandler
+from scheduler import DigestScheduler
+from retention import RetentionWorker
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -17,65 +18,96 @@ logging.basicConfig(level=logging.INFO)
 # Токены и ключи
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-CHATAI_API_KEY = os.getenv('CHATAI_API_KEY')
-CHATAI_API_URL = "https://api.gen-api.ru/api/v1/networks/gpt-4o-mini"
+# Адрес webhook; без него бот получает обновления через polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 
-app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-task_queue = Queue()
-
-def schedule_digest():
-    """Проверяет, нужно ли отправлять дайджесты и добавляет задачи в очередь."""
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, chat_id, next_run
-            FROM schedules
-            WHERE next_run <= datetime('now')
-        """)
-        tasks = cursor.fetchall()
-
-    for user_id, chat_id, next_run in tasks:
-        # Добавляем задачу в очередь
-        task_queue.put((command.generate_digest_for_chat, chat_id))
-        db.update_next_run(user_id)
-
-def run_scheduler():
-    """Цикл запуска задач планировщика."""
-    schedule.every(1).minutes.do(schedule_digest)
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
-
-async def process_tasks():
-    """Обрабатывает задачи из очереди в основном event loop."""
-    while True:
-        while not task_queue.empty():
-            func, *args = task_queue.get()
-            await func(*args)  # Выполняем асинхронную функцию
-        await asyncio.sleep(1)  # Небольшая задержка, чтобы не нагружать CPU
+app = command.build_application()
+digest_scheduler = DigestScheduler(
+    command.generate_digest_for_chat,
+    db.job_queue,
+    workers=int(os.getenv("DIGEST_WORKERS", "4")),
+)
+metrics.gauge("digest_running", "Дайджестов в работе", func=lambda: digest_scheduler.running)
+retention_worker = RetentionWorker(
+    db.pool,
+    db.job_queue,
+    engine=command.digest_engine,
+    interval=float(os.getenv("RETENTION_INTERVAL_HOURS", "6")) * 3600,
+    batch_size=int(os.getenv("RETENTION_BATCH_SIZE", "1000")),
+)
 
 async def post_init(application):
     """Функция, вызываемая после инициализации приложения."""
-    application.create_task(process_tasks())
+    # Словари сжатия нужны до первой записи и чтения сообщений
+    await maintenance.load_dictionaries()
+    await db.message_buffer.start()
+    await command.sender.start()
+    await digest_scheduler.start()
+    db.schedule_listeners.append(digest_scheduler.notify)
+    await retention_worker.start()
+    # Перешифровка старых сообщений после ротации ключей и перевод
+    # сообщений старого формата в сжатый; при нескольких процессах — в первом
+    if db.job_queue.shard == 0:
+        if crypto.has_old_keys() or await maintenance.has_legacy_messages():
+            application.create_task(maintenance.reencrypt_messages())
+        if os.getenv("CRYPTO_TRAIN_DICT") == "1" and crypto.active_dictionary() is None:
+            application.create_task(maintenance.train_dictionary())
+        # Индекс поиска для старых сообщений и после смены ключа индекса
+        if await db.search_index.check_key() or await db.search_index.has_unindexed():
+            application.create_task(maintenance.index_messages())
+    # Метрики Prometheus и профилировщик, см. metrics.serve
+    if os.getenv("METRICS_PORT"):
+        application.bot_data["metrics_server"] = await metrics.serve(
+            os.getenv("METRICS_HOST", "127.0.0.1"), int(os.getenv("METRICS_PORT"))
+        )
 
-def main() -> None:
-    db.init_db()
+async def post_shutdown(application):
+    """Дописывает буфер сообщений перед остановкой бота."""
+    server = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+    await digest_scheduler.stop()
+    await retention_worker.stop()
+    await command.sender.stop()
+    await db.message_buffer.stop()
+    db.pool.close()
+    crypto.shutdown()
+    await command.llm_client.aclose()
 
+def register_handlers(application) -> None:
     # Обработчики
-    app.add_handler(CommandHandler("digest", command.generate_digest))
-    app.add_handler(CommandHandler("schedule", command.schedule_menu))
-    app.add_handler(MessageHandler(filters.Regex("^(Ежедневно|Раз в три дня|Еженедельно)$"), command.set_digest_frequency))
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), db.collect_message))
-    app.add_handler(CommandHandler("start", command.start))
-    app.add_handler(ChatMemberHandler(command.bot_added, ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(CommandHandler("digest", command.generate_digest))
+    application.add_handler(CommandHandler("schedule", command.schedule_menu))
+    application.add_handler(CommandHandler("retention", command.set_retention))
+    application.add_handler(CommandHandler("usage", command.show_usage))
+    application.add_handler(CommandHandler("search", command.search_messages))
+    application.add_handler(MessageHandler(filters.Regex("^(Ежедневно|Раз в три дня|Еженедельно)$"), command.set_digest_frequency))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), db.collect_message))
+    application.add_handler(CommandHandler("start", command.start))
+    application.add_handler(ChatMemberHandler(command.bot_added, ChatMemberHandler.MY_CHAT_MEMBER))
+
+    # Указываем post_init для запуска планировщика
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
 
-    # Указываем post_init для запуска process_tasks
-    app.post_init = post_init
+def main() -> None:
+    db.init_db()
 
-    # Запуск планировщика в отдельном потоке
-    scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-    scheduler_thread.start()
+    if WEBHOOK_URL:
+        # Приём через webhook: обновления по chat_id расходятся по рабочим процессам
+        logging.info("Бот запущен в режиме webhook.")
+        webhook.Supervisor(
+            WEBHOOK_URL,
+            TELEGRAM_BOT_TOKEN,
+            workers=int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1))),
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            secret=os.getenv("WEBHOOK_SECRET"),
+            base_url=command.TELEGRAM_API_URL,
+        ).run()
+        return
 
+    register_handlers(app)
     logging.info("Бот запущен.")
     app.run_polling()
 
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import sqlite3
+from typing import List, Optional
+
+import crypto
+import db
+
+
+def _fetch_chunk(conn: sqlite3.Connection, after_id: int, limit: int) -> List[tuple]:
+    return conn.execute("""
+        SELECT id, message FROM messages
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (after_id, limit)).fetchall()
+
+def _update_chunk(conn: sqlite3.Connection, updates: List[tuple]) -> None:
+    # Условие на старое значение защищает от перезаписи строк,
+    # изменённых параллельно
+    conn.executemany("""
+        UPDATE messages SET message = ?
+        WHERE id = ? AND message = ?
+    """, updates)
+
+def _has_legacy_messages(conn: sqlite3.Connection) -> bool:
+    return conn.execute("""
+        SELECT EXISTS (SELECT 1 FROM messages WHERE typeof(message) = 'text')
+    """).fetchone()[0] == 1
+
+async def has_legacy_messages() -> bool:
+    """Остались ли сообщения в старом формате (base64-токен в TEXT)."""
+    return await db.pool.read(_has_legacy_messages)
+
+async def reencrypt_messages(chunk_size: int = 500, pause: float = 0.05) -> int:
+    """Перешифровывает таблицу messages основным ключом небольшими пачками.
+
+    Заодно переводит сообщения старого формата в сжатый двоичный.
+    Проход идёт по возрастанию id и не блокирует запись новых сообщений;
+    уже перешифрованные строки пропускаются, поэтому задачу можно
+    безопасно перезапускать.
+    """
+    await rotate_dictionaries()
+    last_id = 0
+    total = 0
+    while True:
+        rows = await db.pool.read(_fetch_chunk, last_id, chunk_size)
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        rotated = await asyncio.to_thread(crypto.rotate_many, [row[1] for row in rows])
+        updates = [
+            (new_message, row_id, old_message)
+            for (row_id, old_message), new_message in zip(rows, rotated)
+            if new_message is not None
+        ]
+        if updates:
+            await db.pool.write(_update_chunk, updates)
+            total += len(updates)
+        await asyncio.sleep(pause)
+    logging.info(f"Перешифровано сообщений: {total}")
+    return total
+
+async def index_messages(chunk_size: int = 500, pause: float = 0.05) -> int:
+    """Строит слепой индекс поиска для сообщений, записанных без него.
+
+    Это сообщения, сохранённые до появления индекса, и вся таблица после
+    смены ключа индекса (см. search.check_key). Сначала термы старого
+    ключа сбрасываются пачками по id, затем сообщения индексируются
+    пачками по возрастанию id; запись новых сообщений при этом не
+    блокируется. Каждая пачка фиксируется вместе со своим прогрессом,
+    поэтому прерванную задачу можно безопасно перезапустить.
+    """
+    while await db.search_index.reset_batch(chunk_size):
+        await asyncio.sleep(pause)
+    last_id = 0
+    total = 0
+    while True:
+        rows = await db.search_index.unindexed(last_id, chunk_size)
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        texts = await asyncio.to_thread(crypto.decrypt_many, [row[2] for row in rows])
+        terms = await asyncio.to_thread(lambda: [
+            db.search_index.terms(row[1], text) for row, text in zip(rows, texts)
+        ])
+        await db.search_index.index([
+            (row_id, chat_id, row_terms)
+            for (row_id, chat_id, _), row_terms in zip(rows, terms)
+        ])
+        total += len(rows)
+        await asyncio.sleep(pause)
+    logging.info(f"Проиндексировано сообщений для поиска: {total}")
+    return total
+
+def _get_dictionaries(conn: sqlite3.Connection) -> List[tuple]:
+    return conn.execute("SELECT id, data, active FROM compression_dicts").fetchall()
+
+def _save_dictionary(conn: sqlite3.Connection, dict_id: int, sealed: bytes) -> None:
+    conn.execute("UPDATE compression_dicts SET active = 0")
+    conn.execute("""
+        INSERT OR REPLACE INTO compression_dicts (id, data, active)
+        VALUES (?, ?, 1)
+    """, (dict_id, sealed))
+
+def _sample_messages(conn: sqlite3.Connection, limit: int) -> List[tuple]:
+    return conn.execute("""
+        SELECT message FROM messages ORDER BY id DESC LIMIT ?
+    """, (limit,)).fetchall()
+
+def _update_dictionaries(conn: sqlite3.Connection, updates: List[tuple]) -> None:
+    conn.executemany("UPDATE compression_dicts SET data = ? WHERE id = ?", updates)
+
+def _open_dictionaries(rows: List[tuple]) -> tuple:
+    active = next((row[0] for row in rows if row[2]), None)
+    return {row[0]: crypto.open_dictionary(row[1]) for row in rows}, active
+
+def _read_dictionaries() -> tuple:
+    """Словари из БД для дозагрузки в crypto (вызывается вне event loop).
+
+    Нужна, когда словарь обучил и применил другой процесс — например,
+    шард 0 при работе через webhook с несколькими процессами.
+    """
+    with db.pool.reader() as conn:
+        return _open_dictionaries(_get_dictionaries(conn))
+
+async def load_dictionaries() -> int:
+    """Подключает словари сжатия из БД; возвращает их число.
+
+    Заодно разрешает crypto дозагружать словари, появившиеся позже.
+    """
+    rows = await db.pool.read(_get_dictionaries)
+    if rows and crypto.zstandard is None:
+        logging.error("В БД есть словари zstd, но пакет zstandard не установлен")
+        return 0
+    crypto.install_dictionaries(*_open_dictionaries(rows))
+    if crypto.zstandard is not None:
+        crypto.set_dictionary_loader(_read_dictionaries)
+    return len(rows)
+
+async def rotate_dictionaries() -> None:
+    """Перешифровывает словари основным ключом до старых сообщений."""
+    rows = await db.pool.read(_get_dictionaries)
+    updates = []
+    for dict_id, sealed, _ in rows:
+        rotated = crypto.rotate_dictionary(sealed)
+        if rotated is not None:
+            updates.append((rotated, dict_id))
+    if updates:
+        await db.pool.write(_update_dictionaries, updates)
+
+async def train_dictionary(sample_size: int = 20000, dict_size: int = 16384,
+                           min_samples: int = 1000) -> Optional[int]:
+    """Обучает словарь zstd на последних сообщениях и делает его активным.
+
+    Словарь заметно улучшает сжатие коротких реплик, которые без него
+    почти не сжимаются. Старые словари остаются для распаковки уже
+    записанных сообщений. Возвращает dict_id или None, если обучать
+    не на чем.
+    """
+    if crypto.zstandard is None:
+        logging.warning("Пакет zstandard не установлен, словарь сжатия не обучается")
+        return None
+    rows = await db.pool.read(_sample_messages, sample_size)
+    if len(rows) < min_samples:
+        return None
+    texts = await asyncio.to_thread(crypto.decrypt_many, [row[0] for row in rows])
+    samples = [text.encode() for text in texts if text]
+    try:
+        trained = await asyncio.to_thread(crypto.zstandard.train_dictionary, dict_size, samples)
+    except crypto.zstandard.ZstdError as e:
+        logging.warning(f"Не удалось обучить словарь сжатия: {e}")
+        return None
+    dict_id = trained.dict_id()
+    await db.pool.write(_save_dictionary, dict_id, crypto.seal_dictionary(trained.as_bytes()))
+    await load_dictionaries()
+    logging.info(f"Обучен словарь сжатия {dict_id} на {len(samples)} сообщениях")
+    return dict_id
@@ -0,0 +1,313 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Границы гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Чат, для которого сейчас выполняется работа; по нему LLMClient
+# относит расход токенов и стоимость
+current_chat: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("current_chat", default=None)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик."""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Текущее значение; с func значение вычисляется при каждом сборе."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 func: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labels)
+        self.func = func
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self.func is not None:
+            try:
+                return [f"{self.name} {float(self.func())}"]
+            except Exception as e:
+                logging.warning(f"Не удалось получить значение метрики {self.name}: {e}")
+                return []
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам, обычно длительностей."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Счётчики корзин, затем сумма и количество
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[-1] if series else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        lines = []
+        for key, series in items:
+            for bound, count in zip(self.buckets, series):
+                labels = _format_labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса; метрики создаются при первом обращении."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self._collectors: List[Callable[[], Awaitable[None]]] = []
+
+    def _get(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Метрика {name} уже зарегистрирована как {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = (),
+              func: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._get(Gauge, name, help, labels, func)
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def on_collect(self, collector: Callable[[], Awaitable[None]]) -> None:
+        """Асинхронная функция, обновляющая метрики перед каждым сбором."""
+        self._collectors.append(collector)
+
+    async def collect(self) -> str:
+        for collector in self._collectors:
+            try:
+                await collector()
+            except Exception as e:
+                logging.warning(f"Ошибка сбора метрик: {e}")
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+
+def timed(metric: Histogram, **labels):
+    """Декоратор: время выполнения функции (обычной или async) в гистограмму."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with metric.time(**labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metric.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """Статистический профилировщик: раз в interval секунд снимает стеки
+    всех потоков и считает, сколько раз встретился каждый стек.
+
+    Результат — «свёрнутые» стеки (формат flamegraph.pl / speedscope).
+    Включается и выключается на лету, без перезапуска бота.
+    """
+
+    def __init__(self, interval: float = 0.01, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._stacks: _Tally = _Tally()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.samples = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stacks.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """Останавливает сбор и возвращает свёрнутые стеки."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self._stacks.most_common()) + "\n"
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = traceback.extract_stack(frame, limit=self.max_depth)
+                stack = ";".join(f"{f.name} ({f.filename.rsplit('/', 1)[-1]}:{f.lineno})" for f in frames)
+                self._stacks[f"{names.get(ident, ident)};{stack}"] += 1
+            self.samples += 1
+
+
+profiler = SamplingProfiler()
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line[1] if len(request_line) > 1 else "/"
+        status, content_type = "200 OK", "text/plain; charset=utf-8"
+        if path == "/metrics":
+            body = await registry.collect()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/debug/profile/start":
+            profiler.start()
+            body = "profiler started\n"
+        elif path == "/debug/profile/stop":
+            body = profiler.stop()
+        elif path == "/debug/profile":
+            body = profiler.collapsed()
+        else:
+            status, body = "404 Not Found", "not found\n"
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        logging.warning(f"Ошибка обработки запроса метрик: {e}")
+    finally:
+        writer.close()
+
+
+async def serve(host: str = "127.0.0.1", port: int = 9108) -> asyncio.AbstractServer:
+    """Запускает HTTP-сервер с /metrics и /debug/profile/{start,stop}."""
+    server = await asyncio.start_server(_handle, host, port)
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,339 @@
+import logging
+import sqlite3
+from typing import Callable, List, NamedTuple, Union
+
+Step = Union[str, Callable[[sqlite3.Connection], None]]
+
+
+class Migration(NamedTuple):
+    """Шаг миграции схемы: SQL-строки или функции, принимающие соединение."""
+    version: int
+    description: str
+    steps: List[Step]
+    transactional: bool = True
+
+
+def _enable_incremental_vacuum(conn: sqlite3.Connection) -> None:
+    # Режим auto_vacuum существующей базы меняется только полным VACUUM
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def _add_column(table: str, column: str, definition: str) -> Step:
+    """Шаг ADD COLUMN, пропускаемый, если столбец уже есть."""
+    def step(conn: sqlite3.Connection) -> None:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+# Миграции применяются строго по возрастанию версии.
+# Каждый шаг должен быть идемпотентным: базы, созданные до появления
+# schema_version, уже содержат часть таблиц.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Базовые таблицы", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            username TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY,
+            chat_title TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            frequency TEXT DEFAULT 'weekly', -- daily, every_three_days, weekly
+            next_run DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+    ]),
+    Migration(2, "Индекс messages(chat_id, timestamp)", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp ON messages (chat_id, timestamp)",
+    ]),
+    Migration(3, "Уникальный chat_id в schedules", [
+        # Старые версии могли создать несколько расписаний для одного чата
+        """
+        DELETE FROM schedules
+        WHERE id NOT IN (SELECT MAX(id) FROM schedules GROUP BY chat_id)
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_schedules_chat_id ON schedules (chat_id)",
+    ]),
+    Migration(4, "Индекс schedules(next_run)", [
+        "CREATE INDEX IF NOT EXISTS idx_schedules_next_run ON schedules (next_run)",
+    ]),
+    Migration(5, "Кэш частичных дайджестов summaries", [
+        """
+        CREATE TABLE IF NOT EXISTS summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            period TEXT NOT NULL, -- daily
+            period_start DATETIME NOT NULL,
+            period_end DATETIME NOT NULL,
+            first_message_id INTEGER NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            summary TEXT NOT NULL, -- зашифрованный конспект
+            cost REAL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (chat_id, period, period_start)
+        )
+        """,
+        # Конспект устаревает, как только меняется набор сообщений его периода
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_summaries_on_message_insert
+        AFTER INSERT ON messages
+        BEGIN
+            DELETE FROM summaries
+            WHERE chat_id = NEW.chat_id
+            AND NEW.timestamp >= period_start AND NEW.timestamp < period_end;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_summaries_on_message_delete
+        AFTER DELETE ON messages
+        BEGIN
+            DELETE FROM summaries
+            WHERE chat_id = OLD.chat_id
+            AND OLD.id BETWEEN first_message_id AND last_message_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_summaries_on_message_move
+        AFTER UPDATE OF chat_id, timestamp ON messages
+        BEGIN
+            DELETE FROM summaries
+            WHERE (chat_id = OLD.chat_id AND OLD.id BETWEEN first_message_id AND last_message_id)
+            OR (chat_id = NEW.chat_id AND NEW.timestamp >= period_start AND NEW.timestamp < period_end);
+        END
+        """,
+    ]),
+    Migration(6, "Очередь задач jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            chat_id INTEGER,
+            dedupe_key TEXT UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending', -- pending, running, done, dead
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            run_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            lease_owner TEXT,
+            lease_until DATETIME,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_lease_owner ON jobs (lease_owner)",
+    ]),
+    Migration(7, "Настройки хранения chat_settings и архив message_archives", [
+        """
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            retention_days INTEGER, -- NULL: срок хранения по умолчанию
+            archive INTEGER NOT NULL DEFAULT 0, -- сжимать старые сообщения в конспекты
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Отдельно от summaries: триггеры summaries удаляют конспекты
+        # вместе с сообщениями, а архив должен их пережить
+        """
+        CREATE TABLE IF NOT EXISTS message_archives (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            period_start DATETIME NOT NULL,
+            period_end DATETIME NOT NULL,
+            message_count INTEGER NOT NULL,
+            summary TEXT NOT NULL, -- зашифрованный конспект
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (chat_id, period_start)
+        )
+        """,
+    ]),
+    # VACUUM нельзя выполнить внутри транзакции
+    Migration(8, "auto_vacuum=INCREMENTAL", [_enable_incremental_vacuum], transactional=False),
+    Migration(9, "Словари сжатия сообщений compression_dicts", [
+        """
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            id INTEGER PRIMARY KEY, -- dict_id словаря zstd
+            data BLOB NOT NULL, -- словарь, зашифрованный основным ключом
+            active INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    Migration(10, "Журнал расхода нейросети usage_log, сводка usage_daily и бюджеты чатов", [
+        """
+        CREATE TABLE IF NOT EXISTS usage_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL, -- digest, scheduled, archive
+            model TEXT,
+            calls INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost REAL NOT NULL DEFAULT 0,
+            latency REAL NOT NULL DEFAULT 0, -- секунд на весь дайджест
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_usage_log_chat_created ON usage_log (chat_id, created_at)",
+        # Суточная сводка по чатам (сутки UTC) пополняется триггером, так что
+        # итоги за период читаются из нескольких строк без прохода по журналу
+        """
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            chat_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            digests INTEGER NOT NULL DEFAULT 0,
+            calls INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            cost REAL NOT NULL DEFAULT 0,
+            latency REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, day)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_usage_daily_day ON usage_daily (day)",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_usage_daily_on_insert
+        AFTER INSERT ON usage_log
+        BEGIN
+            INSERT INTO usage_daily
+                (chat_id, day, digests, calls, prompt_tokens, completion_tokens, cost, latency)
+            VALUES (NEW.chat_id, date(NEW.created_at), 1, NEW.calls, NEW.prompt_tokens,
+                    NEW.completion_tokens, NEW.cost, NEW.latency)
+            ON CONFLICT(chat_id, day) DO UPDATE SET
+                digests = digests + 1,
+                calls = calls + excluded.calls,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens,
+                cost = cost + excluded.cost,
+                latency = latency + excluded.latency;
+        END
+        """,
+        # NULL: лимит по умолчанию (CHAT_TOKEN_BUDGET), 0 — без ограничений
+        _add_column("chat_settings", "token_budget", "INTEGER"),
+    ]),
+    Migration(11, "Слепой индекс поиска message_terms", [
+        # term — HMAC-хэш чата и нормализованного слова (crypto.blind_terms),
+        # сами слова в БД не попадают
+        """
+        CREATE TABLE IF NOT EXISTS message_terms (
+            term INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (term, message_id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_message_terms_message ON message_terms (message_id)",
+        # Отпечаток ключа индекса: при его смене индекс строится заново
+        """
+        CREATE TABLE IF NOT EXISTS search_index_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            key_check BLOB NOT NULL
+        )
+        """,
+        # Существующие сообщения получают indexed = 0 и попадают в
+        # индекс фоновой задачей maintenance.index_messages
+        _add_column("messages", "indexed", "INTEGER NOT NULL DEFAULT 0"),
+        "CREATE INDEX IF NOT EXISTS idx_messages_unindexed ON messages (id) WHERE indexed = 0",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_message_terms_on_message_delete
+        AFTER DELETE ON messages
+        BEGIN
+            DELETE FROM message_terms WHERE message_id = OLD.id;
+        END
+        """,
+        # Термы зависят от чата: перенесённое сообщение индексируется заново
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_message_terms_on_message_move
+        AFTER UPDATE OF chat_id ON messages
+        BEGIN
+            DELETE FROM message_terms WHERE message_id = OLD.id;
+            UPDATE messages SET indexed = 0 WHERE id = NEW.id;
+        END
+        """,
+    ]),
+    Migration(12, "Пакетный сброс индекса поиска после смены ключа", [
+        # Сообщения с id <= stale_until ещё хранят термы старого ключа;
+        # maintenance.index_messages сбрасывает их пачками
+        _add_column("search_index_state", "stale_until", "INTEGER NOT NULL DEFAULT 0"),
+    ]),
+]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы базы данных."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def _apply(conn: sqlite3.Connection, migration: Migration) -> None:
+    for step in migration.steps:
+        if callable(step):
+            step(conn)
+        else:
+            conn.execute(step)
+    conn.execute(
+        "INSERT OR IGNORE INTO schema_version (version, description) VALUES (?, ?)",
+        (migration.version, migration.description)
+    )
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет все недостающие миграции, возвращает итоговую версию."""
+    conn.commit()
+    version = current_version(conn)
+    conn.commit()
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        if migration.transactional:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Другой процесс мог успеть применить миграцию раньше нас
+                if current_version(conn) >= migration.version:
+                    conn.rollback()
+                    continue
+                _apply(conn, migration)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        else:
+            _apply(conn, migration)
+            conn.commit()
+        logging.info(f"Применена миграция {migration.version}: {migration.description}")
+        version = migration.version
+    return version
@@ -0,0 +1,395 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+import metrics
+
+# Приоритеты отправки: чем меньше число, тем раньше уходит сообщение
+INTERACTIVE = 0
+SCHEDULED = 1
+PROGRESS = 2
+
+# Лимит Telegram — 4096 символов, оставляем запас на закрытие разметки
+MESSAGE_LIMIT = 4000
+
+_FENCE = "```"
+# Позиции внутри маркера ```: здесь резать нельзя
+_MARKER = "marker"
+# Сущности, которые не разрезаются (переносятся целиком)
+_UNBREAKABLE = ("\\", "[", _MARKER)
+
+TELEGRAM_SECONDS = metrics.histogram("telegram_request_seconds", "Время запроса к Bot API", ("result",))
+TELEGRAM_QUEUE_SECONDS = metrics.histogram("telegram_queue_wait_seconds", "Ожидание в очереди отправки", ("priority",))
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity подряд."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Запрещает отправку на seconds секунд (ответ 429 от Telegram)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+def _markup_states(text: str) -> List[Optional[str]]:
+    """Для каждой позиции текста — открытая перед ней сущность Markdown.
+
+    Разбирается разметка Telegram Markdown (legacy): *жирный*, _курсив_,
+    `код`, ```блок```, [ссылка](url). Сущности в ней не вкладываются.
+    """
+    states: List[Optional[str]] = [None] * (len(text) + 1)
+    state: Optional[str] = None
+    i = 0
+    while i < len(text):
+        states[i] = state
+        char = text[i]
+        if state in (None, _FENCE) and text.startswith(_FENCE, i):
+            state = None if state == _FENCE else _FENCE
+            states[i + 1] = states[i + 2] = _MARKER
+            i += 3
+            continue
+        if state == _FENCE:
+            pass
+        elif char == "\\" and state is None and i + 1 < len(text):
+            states[i + 1] = "\\"
+            i += 2
+            continue
+        elif char == "`" and state in (None, "`"):
+            state = None if state == "`" else "`"
+        elif state == "`":
+            pass
+        elif char in "*_" and state in (None, char):
+            state = None if state == char else char
+        elif char == "[" and state is None:
+            close = text.find("](", i)
+            end = text.find(")", close) if close != -1 else -1
+            if end != -1 and "\n" not in text[i:end]:
+                for j in range(i + 1, end + 1):
+                    states[j] = "["
+                i = end + 1
+                continue
+        i += 1
+    states[len(text)] = state
+    return states
+
+
+def _reopen(state: Optional[str]) -> str:
+    return _FENCE + "\n" if state == _FENCE else state or ""
+
+
+def _close(state: str) -> str:
+    return "\n" + _FENCE if state == _FENCE else state
+
+
+def _rfind_cut(text: str, states: List[Optional[str]], separator: str,
+               start: int, end: int, state: Optional[str]) -> Optional[int]:
+    """Последний separator в text[start + 1:end], перед которым открыта сущность state.
+
+    Внутри блока кода не режем строку, примыкающую к маркеру ```:
+    получился бы пустой блок.
+    """
+    position = text.rfind(separator, start + 1, end)
+    while position > start:
+        if states[position] == state and not (
+                state == _FENCE and (text.endswith(_FENCE, start, position)
+                                     or text.startswith(_FENCE, position + 1))):
+            return position
+        position = text.rfind(separator, start + 1, position)
+    return None
+
+
+def split_markdown(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Делит текст на части не длиннее limit, не разрывая разметку.
+
+    Разрез ищется по границе абзаца, затем строки, затем слова — только
+    вне сущностей. Если сущность сама длиннее limit (большой блок кода),
+    она закрывается в конце части и открывается заново в следующей;
+    блок кода при этом режется по границе строки.
+    """
+    states = _markup_states(text)
+    chunks: List[str] = []
+    start, carry = 0, ""
+    while len(carry) + len(text) - start > limit:
+        budget = limit - len(carry)
+        # Вне сущностей закрывать нечего; внутри — оставляем запас
+        # под закрывающий маркер
+        end = max(start + 1, start + budget - len(_FENCE) - 1)
+        cut = None
+        for separator in ("\n\n", "\n", " "):
+            cut = _rfind_cut(text, states, separator, start, start + budget + 1, None)
+            if cut is not None:
+                break
+        if cut is None:
+            cut = _rfind_cut(text, states, "\n", start, end, _FENCE)
+        if cut is None:
+            cut = next((p for p in range(end, start, -1) if states[p] in (None, _FENCE)), end)
+        if states[cut] in _UNBREAKABLE:
+            # Экранирование, ссылки и маркеры не разрезаются: переносим их целиком
+            cut = next((p for p in range(cut, start, -1) if states[p] not in _UNBREAKABLE), cut)
+        chunk, state = (carry + text[start:cut]).rstrip(), states[cut]
+        if state in _UNBREAKABLE:
+            # Ссылка длиннее части — режем как обычный текст
+            state = None
+        if state is not None:
+            chunk += _close(state)
+        chunks.append(chunk)
+        carry = _reopen(state)
+        start = cut
+        if state == _FENCE and text.startswith("\n", start):
+            # Перевод строки уже стоит после открывающего маркера
+            start += 1
+        while start < len(text) and text[start] in "\n " and not carry:
+            start += 1
+    chunks.append(carry + text[start:])
+    return [chunk for chunk in chunks if chunk.strip()] or [""]
+
+
+class _Outgoing:
+    __slots__ = ("priority", "seq", "chat_id", "call", "future", "attempts", "queued")
+
+    def __init__(self, priority: int, seq: int, chat_id: int,
+                 call: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.call = call
+        self.future = future
+        self.attempts = 0
+        self.queued = time.monotonic()
+
+    def __lt__(self, other: "_Outgoing") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Outbox:
+    """Очередь исходящих запросов к Telegram с ограничением скорости.
+
+    Каждый запрос (отправка или правка сообщения) занимает токен из общей
+    корзины бота и из корзины чата: в группах Telegram пропускает около
+    20 сообщений в минуту, в личных чатах — около одного в секунду, всего
+    — около 30 в секунду. Запросы уходят по приоритету, внутри чата —
+    строго по очереди. Ответ 429 приостанавливает чат на retry_after
+    секунд, после чего запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float = 30.0, group_rate: float = 20 / 60,
+                 group_burst: float = 5, private_rate: float = 1.0,
+                 private_burst: float = 3, concurrency: int = 8,
+                 max_retries: int = 5):
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._heap: List[_Outgoing] = []
+        self._busy: Dict[int, int] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Идущие отправки: цикл событий держит задачи только по слабой ссылке
+        self._sending: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Уже начатые запросы доводим до конца
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        for item in self._heap:
+            item.future.cancel()
+        self._heap = []
+
+    async def submit(self, chat_id: int, call: Callable[[], Awaitable[Any]],
+                     priority: int = SCHEDULED) -> Any:
+        """Выполняет call, когда лимиты чата и бота это позволят."""
+        if self._task is None:
+            raise RuntimeError("Очередь отправки не запущена")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, _Outgoing(priority, next(self._seq), chat_id, call, future))
+        self._wakeup.set()
+        return await future
+
+    async def send_text(self, bot: Bot, chat_id: int, text: str,
+                        priority: int = SCHEDULED, parse_mode: Optional[str] = "Markdown",
+                        limit: int = MESSAGE_LIMIT, **kwargs) -> List[Message]:
+        """Отправляет текст частями; при ошибке разметки — без неё."""
+        pages = split_markdown(text, limit) if parse_mode else [
+            text[i:i + limit] for i in range(0, len(text), limit)
+        ]
+        messages = []
+        for page in pages:
+            messages.append(await self.submit(
+                chat_id, lambda page=page: send_page(bot, chat_id, page, parse_mode, **kwargs), priority
+            ))
+        return messages
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные chat_id — группы и каналы
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _next_ready(self, now: float) -> tuple:
+        """Первый по приоритету запрос, который можно отправить сейчас.
+
+        Возвращает (запрос или None, через сколько секунд проверить снова).
+        """
+        wait = self._global.delay(now)
+        if wait > 0 or sum(self._busy.values()) >= self.concurrency:
+            return None, wait or None
+        skipped, seen, wait = [], set(self._busy), None
+        found = None
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            if item.future.done():
+                continue
+            if item.chat_id in seen:
+                skipped.append(item)
+                continue
+            seen.add(item.chat_id)
+            delay = self._bucket(item.chat_id).delay(now)
+            if delay > 0:
+                skipped.append(item)
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            found = item
+            break
+        for item in skipped:
+            heapq.heappush(self._heap, item)
+        return found, wait
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            item, wait = self._next_ready(now)
+            if item is not None:
+                self._global.take(now)
+                self._bucket(item.chat_id).take(now)
+                self._busy[item.chat_id] = 1
+                task = asyncio.create_task(self._execute(item))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+                continue
+            self._evict_idle(now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _evict_idle(self, now: float) -> None:
+        if len(self._chats) > 1000:
+            for chat_id in [c for c, b in self._chats.items() if c not in self._busy and b.idle(now)]:
+                del self._chats[chat_id]
+
+    async def _execute(self, item: _Outgoing) -> None:
+        if item.attempts == 0:
+            TELEGRAM_QUEUE_SECONDS.observe(time.monotonic() - item.queued, priority=item.priority)
+        started = time.monotonic()
+        outcome = "ok"
+        try:
+            result = await item.call()
+        except RetryAfter as e:
+            outcome = "retry_after"
+            delay = float(getattr(e.retry_after, "total_seconds", lambda: e.retry_after)())
+            logging.warning(f"Telegram ограничил отправку в чат {item.chat_id} на {delay:.0f} с")
+            self._bucket(item.chat_id).pause(delay)
+            self._retry(item, e)
+        except NetworkError as e:
+            outcome = "error"
+            # Ошибку запроса и тайм-аут не повторяем: сообщение могло уже уйти
+            if isinstance(e, (BadRequest, TimedOut)):
+                self._settle(item, error=e)
+            else:
+                self._bucket(item.chat_id).pause(min(30.0, 2 ** item.attempts))
+                self._retry(item, e)
+        except Exception as e:
+            outcome = "error"
+            self._settle(item, error=e)
+        else:
+            self._settle(item, result=result)
+        finally:
+            TELEGRAM_SECONDS.observe(time.monotonic() - started, result=outcome)
+            self._busy.pop(item.chat_id, None)
+            self._wakeup.set()
+
+    def _retry(self, item: _Outgoing, error: Exception) -> None:
+        item.attempts += 1
+        if item.attempts > self.max_retries or item.future.done():
+            self._settle(item, error=error)
+        else:
+            heapq.heappush(self._heap, item)
+
+    @staticmethod
+    def _settle(item: _Outgoing, result: Any = None, error: Optional[Exception] = None) -> None:
+        if item.future.done():
+            return
+        if error is not None:
+            item.future.set_exception(error)
+        else:
+            item.future.set_result(result)
+
+
+async def send_page(bot: Bot, chat_id: int, text: str,
+                    parse_mode: Optional[str] = "Markdown", **kwargs) -> Message:
+    """Отправляет одно сообщение; если Telegram не принял разметку — без неё."""
+    try:
+        return await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, **kwargs)
+    except BadRequest as e:
+        if parse_mode is None or "parse" not in str(e).lower():
+            raise
+        logging.warning(f"Разметка не принята Telegram ({e}), отправляем без неё")
+        return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
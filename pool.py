@@ -0,0 +1,123 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+import metrics
+
+# Настройки, которые применяются к каждому новому соединению
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+)
+
+DB_SECONDS = metrics.histogram("db_call_seconds", "Время выполнения функции БД", ("op", "func"))
+DB_WAIT_SECONDS = metrics.histogram("db_queue_wait_seconds", "Ожидание потока БД", ("op",))
+
+
+class ConnectionPool:
+    """Одно пишущее соединение и пул читающих соединений к SQLite.
+
+    Запись выполняется в выделенном потоке, чтение — в небольшом пуле
+    потоков, поэтому асинхронные обработчики не блокируют event loop.
+    Синхронные контекстные менеджеры writer()/reader() доступны для кода,
+    который уже работает вне event loop.
+    """
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.max_readers = readers
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Пишущее соединение; транзакция фиксируется при выходе из блока."""
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Соединение только для чтения из пула."""
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._reader_lock:
+                can_open = self._reader_count < self.max_readers
+                if can_open:
+                    self._reader_count += 1
+            conn = self._connect(readonly=True) if can_open else self._readers.get()
+        try:
+            yield conn
+        finally:
+            # Завершаем неявную транзакцию чтения, чтобы не держать снимок WAL
+            conn.rollback()
+            self._readers.put(conn)
+
+    def _run_write(self, func: Callable, args: tuple, queued: float) -> Any:
+        DB_WAIT_SECONDS.observe(time.perf_counter() - queued, op="write")
+        with DB_SECONDS.time(op="write", func=func.__name__), self.writer() as conn:
+            return func(conn, *args)
+
+    def _run_read(self, func: Callable, args: tuple, queued: float) -> Any:
+        DB_WAIT_SECONDS.observe(time.perf_counter() - queued, op="read")
+        with DB_SECONDS.time(op="read", func=func.__name__), self.reader() as conn:
+            return func(conn, *args)
+
+    async def write(self, func: Callable, *args) -> Any:
+        """Выполняет func(conn, *args) в потоке записи одной транзакцией."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._write_executor, self._run_write, func, args, time.perf_counter()
+        )
+
+    async def read(self, func: Callable, *args) -> Any:
+        """Выполняет func(conn, *args) на читающем соединении."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._read_executor, self._run_read, func, args, time.perf_counter()
+        )
+
+    def close(self) -> None:
+        """Закрывает все соединения и потоки пула."""
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        self._reader_count = 0
@@ -0,0 +1,247 @@
+import re
+import zlib
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from summarizer import estimate_tokens
+
+# Параметры MinHash/LSH для поиска почти одинаковых сообщений
+SHINGLE_SIZE = 5
+NUM_PERM = 64
+BANDS = 16
+DUPLICATE_THRESHOLD = 0.8
+
+# Сообщения короче этого порога (в буквах и цифрах) считаются шумом
+MIN_ALNUM = 3
+# Одно слово короче этого порога («ок», «спасибо», «ага») — тоже шум
+MIN_SINGLE_WORD = 12
+# Длинные простыни обрезаются до этой длины
+MAX_MESSAGE_CHARS = 600
+
+# Размерность хэшированных TF-IDF векторов и число итераций k-means
+VECTOR_DIM = 1024
+KMEANS_ITERATIONS = 10
+MAX_TOPICS = 12
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_rng = np.random.default_rng(20240601)
+_PERM_A = _rng.integers(1, 2 ** 63, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_PERM_B = _rng.integers(0, 2 ** 63, size=NUM_PERM, dtype=np.uint64)
+_SHINGLE_BASE = np.uint64(1099511628211)
+
+
+class PrefilterStats(NamedTuple):
+    """Сколько сообщений и токенов убрал каждый этап."""
+    total: int
+    duplicates: int
+    noise: int
+    truncated: int
+    dropped_by_budget: int
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def selected(self) -> int:
+        return self.total - self.duplicates - self.noise - self.dropped_by_budget
+
+    def __str__(self) -> str:
+        saved = 1 - self.tokens_after / self.tokens_before if self.tokens_before else 0
+        return (
+            f"сообщений {self.total} -> {self.selected} "
+            f"(дубликаты {self.duplicates}, шум {self.noise}, "
+            f"вне бюджета {self.dropped_by_budget}, обрезано {self.truncated}); "
+            f"токенов {self.tokens_before} -> {self.tokens_after} ({saved:.0%} экономии)"
+        )
+
+
+def _normalize(text: str) -> str:
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def _shingles(text: str) -> np.ndarray:
+    """Хэши символьных k-грамм нормализованного текста."""
+    data = np.frombuffer(_normalize(text).encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+    if len(data) < SHINGLE_SIZE:
+        return np.array([zlib.crc32(data.tobytes())], dtype=np.uint64)
+    count = len(data) - SHINGLE_SIZE + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        hashes = hashes * _SHINGLE_BASE + data[offset:offset + count]
+    return np.unique(hashes)
+
+
+def _minhash(shingles: np.ndarray) -> np.ndarray:
+    # Универсальное хэширование multiply-shift, переполнение uint64 ожидаемо
+    with np.errstate(over="ignore"):
+        mixed = np.outer(_PERM_A, shingles) + _PERM_B[:, None]
+    return (mixed >> np.uint64(32)).min(axis=1)
+
+
+def find_duplicates(messages: List[str]) -> List[int]:
+    """Номера представителей групп почти одинаковых сообщений.
+
+    Для каждого сообщения возвращает индекс первого сообщения его группы.
+    """
+    count = len(messages)
+    parent = list(range(count))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if count < 2:
+        return parent
+    signatures = np.stack([_minhash(_shingles(message)) for message in messages])
+    rows = NUM_PERM // BANDS
+    for band in range(BANDS):
+        buckets = {}
+        for i, key in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets.setdefault(key.tobytes(), []).append(i)
+        for members in buckets.values():
+            first = members[0]
+            for other in members[1:]:
+                root_a, root_b = find(first), find(other)
+                if root_a == root_b:
+                    continue
+                similarity = np.mean(signatures[first] == signatures[other])
+                if similarity >= DUPLICATE_THRESHOLD:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+    return [find(i) for i in range(count)]
+
+
+def is_noise(message: str) -> bool:
+    """Короткие реплики без содержания: «+», «ок», смайлики и т. п."""
+    words = _WORD_RE.findall(message)
+    alnum = sum(len(word) for word in words)
+    if alnum < MIN_ALNUM:
+        return True
+    return len(words) == 1 and len(message.strip()) < MIN_SINGLE_WORD
+
+
+def _vectorize(messages: List[str]) -> np.ndarray:
+    """Хэшированные TF-IDF векторы единичной длины."""
+    matrix = np.zeros((len(messages), VECTOR_DIM), dtype=np.float32)
+    for row, message in enumerate(messages):
+        words = [word for word in _WORD_RE.findall(message.lower()) if len(word) > 2]
+        if words:
+            columns = [zlib.crc32(word.encode("utf-8")) % VECTOR_DIM for word in words]
+            np.add.at(matrix[row], columns, 1.0)
+    document_frequency = (matrix > 0).sum(axis=0)
+    idf = np.log((1 + len(messages)) / (1 + document_frequency)) + 1
+    matrix = np.log1p(matrix) * idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def cluster(vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Сферический k-means: метки кластеров и сходство с центроидом."""
+    rng = np.random.default_rng(0)
+    count = len(vectors)
+    # Инициализация k-means++: следующий центр выбирается вдали от уже выбранных
+    centers = [int(rng.integers(count))]
+    distance = 1 - vectors @ vectors[centers[0]]
+    for _ in range(1, k):
+        weights = np.clip(distance, 0, None)
+        total = weights.sum()
+        if total <= 0:
+            break
+        centers.append(int(rng.choice(count, p=weights / total)))
+        distance = np.minimum(distance, 1 - vectors @ vectors[centers[-1]])
+    centroids = vectors[centers]
+
+    for _ in range(KMEANS_ITERATIONS):
+        similarity = vectors @ centroids.T
+        labels = similarity.argmax(axis=1)
+        updated = np.zeros_like(centroids)
+        np.add.at(updated, labels, vectors)
+        norms = np.linalg.norm(updated, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        updated[empty] = centroids[empty]
+        norms[empty] = 1
+        updated /= norms
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    similarity = vectors @ centroids.T
+    labels = similarity.argmax(axis=1)
+    return labels, similarity[np.arange(count), labels]
+
+
+def select_representatives(messages: List[str], budget: int) -> List[int]:
+    """Выбирает сообщения по темам так, чтобы уложиться в budget токенов.
+
+    Темы обходятся по кругу, от самых больших к самым маленьким; внутри
+    темы сначала берутся сообщения, ближайшие к её центру.
+    """
+    k = min(len(messages), MAX_TOPICS, max(1, int(np.sqrt(len(messages) / 2))))
+    labels, similarity = cluster(_vectorize(messages), k)
+    queues = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        queues.append(list(members[np.argsort(-similarity[members])]))
+    queues.sort(key=len, reverse=True)
+
+    selected, used = [], 0
+    while any(queues):
+        for queue in queues:
+            if not queue:
+                continue
+            index = int(queue.pop(0))
+            tokens = estimate_tokens(messages[index])
+            if used + tokens > budget:
+                continue
+            selected.append(index)
+            used += tokens
+    return sorted(selected)
+
+
+def prefilter(messages: List[str], budget: int) -> Tuple[List[str], PrefilterStats]:
+    """Удаляет дубликаты и шум и ужимает переписку до budget токенов.
+
+    Порядок сообщений сохраняется; повторы помечаются числом повторений.
+    """
+    tokens_before = sum(estimate_tokens(message) for message in messages)
+
+    kept, noise = [], 0
+    for message in messages:
+        if is_noise(message):
+            noise += 1
+        else:
+            kept.append(message)
+
+    groups = find_duplicates(kept)
+    repeats = {}
+    for root in groups:
+        repeats[root] = repeats.get(root, 0) + 1
+    unique, truncated = [], 0
+    for index, message in enumerate(kept):
+        if groups[index] != index:
+            continue
+        if len(message) > MAX_MESSAGE_CHARS:
+            message = message[:MAX_MESSAGE_CHARS] + "…"
+            truncated += 1
+        if repeats[index] > 1:
+            message = f"{message} (×{repeats[index]})"
+        unique.append(message)
+    duplicates = len(kept) - len(unique)
+
+    dropped = 0
+    if unique and sum(estimate_tokens(message) for message in unique) > budget:
+        indexes = select_representatives(unique, budget)
+        dropped = len(unique) - len(indexes)
+        unique = [unique[index] for index in indexes]
+
+    stats = PrefilterStats(
+        total=len(messages),
+        duplicates=duplicates,
+        noise=noise,
+        truncated=truncated,
+        dropped_by_budget=dropped,
+        tokens_before=tokens_before,
+        tokens_after=sum(estimate_tokens(message) for message in unique),
+    )
+    return unique, stats
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Tuple
+
+import crypto
+import db
+import jobs
+import rolling
+import summarizer
+from pool import ConnectionPool
+
+# Срок хранения сообщений, если для чата он не задан
+DEFAULT_RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "30"))
+# Самое длинное окно дайджеста — неделя, плюс неполные сутки на краю
+MIN_RETENTION_DAYS = 8
+
+DAY = timedelta(days=1)
+
+
+class RetentionStats(NamedTuple):
+    """Итоги прохода очистки."""
+    chats: int = 0
+    rows_deleted: int = 0
+    bytes_deleted: int = 0
+    days_archived: int = 0
+    jobs_purged: int = 0
+    bytes_vacuumed: int = 0
+    duration: float = 0.0
+
+    def __add__(self, other: "RetentionStats") -> "RetentionStats":
+        return RetentionStats(*(a + b for a, b in zip(self, other)))
+
+    def __str__(self) -> str:
+        return (
+            f"чатов {self.chats}, удалено сообщений {self.rows_deleted} "
+            f"({self.bytes_deleted / 1024:.0f} КБ), заархивировано суток {self.days_archived}, "
+            f"задач {self.jobs_purged}, файл уменьшен на {self.bytes_vacuumed / 1024:.0f} КБ "
+            f"за {self.duration:.1f} с"
+        )
+
+
+def effective_days(retention_days: Optional[int], default: int = DEFAULT_RETENTION_DAYS) -> int:
+    """Срок хранения с учётом значения по умолчанию и нижней границы."""
+    return max(MIN_RETENTION_DAYS, retention_days or default)
+
+
+def _chat_policies(conn: sqlite3.Connection) -> List[tuple]:
+    return conn.execute("""
+        SELECT c.id, s.retention_days, COALESCE(s.archive, 0)
+        FROM chats c
+        LEFT JOIN chat_settings s ON s.chat_id = c.id
+    """).fetchall()
+
+def _days_to_archive(conn: sqlite3.Connection, chat_id: int, cutoff: datetime) -> List[str]:
+    return [row[0] for row in conn.execute("""
+        SELECT date(m.timestamp) AS day FROM messages m
+        WHERE m.chat_id = ? AND m.timestamp < ?
+        GROUP BY day
+        HAVING NOT EXISTS (
+            SELECT 1 FROM message_archives a
+            WHERE a.chat_id = ? AND date(a.period_start) = day
+        )
+        ORDER BY day
+    """, (chat_id, cutoff, chat_id)).fetchall()]
+
+def _save_archive(conn: sqlite3.Connection, chat_id: int, start: datetime,
+                  end: datetime, message_count: int, summary: str) -> None:
+    conn.execute("""
+        INSERT OR IGNORE INTO message_archives
+            (chat_id, period_start, period_end, message_count, summary)
+        VALUES (?, ?, ?, ?, ?)
+    """, (chat_id, start, end, message_count, summary))
+
+def _delete_batch(conn: sqlite3.Connection, chat_id: int, cutoff: datetime,
+                  limit: int) -> Tuple[int, int]:
+    sizes = conn.execute("""
+        DELETE FROM messages
+        WHERE id IN (
+            SELECT id FROM messages
+            WHERE chat_id = ? AND timestamp < ?
+            ORDER BY timestamp
+            LIMIT ?
+        )
+        RETURNING length(message)
+    """, (chat_id, cutoff, limit)).fetchall()
+    return len(sizes), sum(size[0] or 0 for size in sizes)
+
+def _incremental_vacuum(conn: sqlite3.Connection, pages: int) -> Tuple[int, int]:
+    """Возвращает страницы из freelist файлу; (освобождено байт, осталось страниц)."""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if before:
+        # execute() делает один шаг прагмы и освобождает одну страницу;
+        # executescript доводит её до конца
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return (before - after) * page_size, after
+
+
+class RetentionWorker:
+    """Фоновая очистка старых сообщений.
+
+    Раз в interval секунд удаляет сообщения старше срока хранения чата
+    (целыми сутками, пачками по batch_size в отдельных транзакциях, чтобы
+    не задерживать запись новых сообщений), затем небольшими шагами
+    возвращает освободившиеся страницы файлу через incremental_vacuum.
+    Для чатов с включённым архивом сутки перед удалением сжимаются в
+    конспект message_archives; если конспект построить не удалось,
+    сообщения чата остаются до следующего прохода.
+    """
+
+    def __init__(self, pool: ConnectionPool, queue: jobs.JobQueue,
+                 engine: Optional[summarizer.DigestEngine] = None,
+                 default_days: int = DEFAULT_RETENTION_DAYS,
+                 interval: float = 6 * 3600, batch_size: int = 1000,
+                 pause: float = 0.05, vacuum_pages: int = 2000,
+                 jobs_days: int = 7, dead_jobs_days: int = 30):
+        self.pool = pool
+        self.queue = queue
+        self.engine = engine
+        self.default_days = default_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.jobs_days = jobs_days
+        self.dead_jobs_days = dead_jobs_days
+        self.last: Optional[RetentionStats] = None
+        self.totals = RetentionStats()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Ошибка очистки старых сообщений: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self, now: Optional[datetime] = None) -> RetentionStats:
+        """Один полный проход очистки."""
+        started = time.monotonic()
+        today = (now or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Каждый процесс чистит чаты своего шарда: иначе кэш последних
+        # сообщений в процессе-владельце чата не узнает об удалении
+        policies = [row for row in await self.pool.read(_chat_policies) if self.queue.owns(row[0])]
+        rows = size = archived = 0
+        for chat_id, retention_days, archive in policies:
+            cutoff = today - effective_days(retention_days, self.default_days) * DAY
+            if archive and self.engine is not None:
+                try:
+                    archived += await self._archive(chat_id, cutoff)
+                except Exception as e:
+                    logging.error(f"Не удалось заархивировать сообщения чата {chat_id}: {e}")
+                    continue
+            deleted, deleted_size = await self._delete(chat_id, cutoff)
+            db.hot_cache.trim(chat_id, cutoff)
+            rows += deleted
+            size += deleted_size
+        purged = vacuumed = 0
+        # Общие для всей БД операции выполняет только первый шард
+        if self.queue.shard == 0:
+            purged = await self.queue.purge(self.jobs_days, self.dead_jobs_days)
+            vacuumed = await self._vacuum()
+        stats = RetentionStats(
+            chats=len(policies),
+            rows_deleted=rows,
+            bytes_deleted=size,
+            days_archived=archived,
+            jobs_purged=purged,
+            bytes_vacuumed=vacuumed,
+            duration=time.monotonic() - started,
+        )
+        self.last = stats
+        self.totals += stats
+        logging.info(f"Очистка завершена: {stats}")
+        return stats
+
+    async def _delete(self, chat_id: int, cutoff: datetime) -> Tuple[int, int]:
+        rows = size = 0
+        while True:
+            deleted, deleted_size = await self.pool.write(_delete_batch, chat_id, cutoff, self.batch_size)
+            rows += deleted
+            size += deleted_size
+            if deleted < self.batch_size:
+                return rows, size
+            await asyncio.sleep(self.pause)
+
+    async def _archive(self, chat_id: int, cutoff: datetime) -> int:
+        count = 0
+        for day in await self.pool.read(_days_to_archive, chat_id, cutoff):
+            start = datetime.fromisoformat(day)
+            end = start + DAY
+            rows = await db.get_message_rows(chat_id, start, end)
+            if not rows:
+                continue
+            # Суточный конспект мог остаться в кэше дайджестов
+            cached = await db.get_summaries(chat_id, rolling.PERIOD, start, end)
+            if cached:
+                summary = cached[0][1]
+            else:
+                texts = await asyncio.to_thread(crypto.decrypt_many, [row[1] for row in rows])
+                # Архив не ограничивается лимитом чата, но учитывается в расходе
+                result = await db.usage_ledger.track(
+                    chat_id, "archive", lambda: self.engine.summarize_partial(texts)
+                )
+                summary = await asyncio.to_thread(crypto.encrypt_message, result.text)
+            await self.pool.write(_save_archive, chat_id, start, end, len(rows), summary)
+            count += 1
+        return count
+
+    async def _vacuum(self) -> int:
+        freed = 0
+        while True:
+            step, remaining = await self.pool.write(_incremental_vacuum, self.vacuum_pages)
+            freed += step
+            if not remaining or not step:
+                return freed
+            await asyncio.sleep(self.pause)
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import crypto
+import db
+import summarizer
+
+PERIOD = "daily"
+DAY = timedelta(days=1)
+
+
+def _start_of_day(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def _load_messages(chat_id: int, start: datetime, end: datetime) -> List[tuple]:
+    """Расшифрованные сообщения полуинтервала в виде пар (id, текст)."""
+    cached = db.hot_cache.range(chat_id, start, end)
+    if cached is not None:
+        return cached
+    rows = await db.get_message_rows(chat_id, start, end)
+    texts = await asyncio.to_thread(crypto.decrypt_many, [row[1] for row in rows])
+    return [(row[0], text) for row, text in zip(rows, texts)]
+
+
+async def _daily_partial(engine: summarizer.DigestEngine, chat_id: int,
+                         day: datetime) -> Optional[summarizer.DigestResult]:
+    """Строит конспект за сутки и кладёт его в кэш summaries."""
+    rows = await _load_messages(chat_id, day, day + DAY)
+    if not rows:
+        return None
+    result = await engine.summarize_partial([text for _, text in rows])
+    saved = await db.save_summary(
+        chat_id, PERIOD, day, day + DAY,
+        min(row[0] for row in rows), max(row[0] for row in rows), len(rows),
+        await asyncio.to_thread(crypto.encrypt_message, result.text), result.cost
+    )
+    if not saved:
+        logging.info(f"Конспект чата {chat_id} за {day:%Y-%m-%d} устарел до сохранения")
+    return result
+
+
+async def _segment_partial(engine: summarizer.DigestEngine, chat_id: int,
+                           start: datetime, end: datetime) -> Optional[summarizer.DigestResult]:
+    """Конспект неполных суток в начале или конце окна, без кэширования."""
+    if start >= end:
+        return None
+    rows = await _load_messages(chat_id, start, end)
+    if not rows:
+        return None
+    return await engine.summarize_partial([text for _, text in rows])
+
+
+async def build_window_digest(engine: summarizer.DigestEngine, chat_id: int,
+                              since: datetime, now: Optional[datetime] = None,
+                              on_progress: Optional[summarizer.ProgressCallback] = None) -> summarizer.DigestResult:
+    """Дайджест за окно [since, now], собранный из суточных конспектов.
+
+    Полные сутки внутри окна берутся из кэша summaries (и докладываются
+    туда при промахе), к ним добавляются конспекты неполных суток на
+    краях окна. Если полных суток в окне нет, дайджест строится напрямую.
+    """
+    now = now or datetime.now()
+    first_day = _start_of_day(since)
+    if first_day < since:
+        first_day += DAY
+    today = _start_of_day(now)
+
+    days = []
+    day = first_day
+    while day + DAY <= today:
+        days.append(day)
+        day += DAY
+
+    if not days:
+        rows = await _load_messages(chat_id, since, now + timedelta(seconds=1))
+        return await engine.summarize([text for _, text in rows], on_progress=on_progress)
+
+    cached = {
+        row[0]: row[1]
+        for row in await db.get_summaries(chat_id, PERIOD, first_day, today)
+    }
+    cached_texts = {}
+    if cached:
+        decrypted = await asyncio.to_thread(crypto.decrypt_many, list(cached.values()))
+        cached_texts = dict(zip(cached.keys(), decrypted))
+
+    async def partial_for(day: datetime) -> Optional[summarizer.DigestResult]:
+        key = str(day)
+        if key in cached_texts:
+            return summarizer.DigestResult(cached_texts[key], 0.0, 0)
+        return await _daily_partial(engine, chat_id, day)
+
+    results = await asyncio.gather(
+        _segment_partial(engine, chat_id, since, first_day),
+        *[partial_for(day) for day in days],
+        _segment_partial(engine, chat_id, today, now + timedelta(seconds=1)),
+    )
+    partials = [result for result in results if result is not None and result.text]
+    logging.info(
+        f"Дайджест чата {chat_id}: суток в окне {len(days)}, "
+        f"из кэша {sum(1 for day in days if str(day) in cached_texts)}"
+    )
+    if not partials:
+        return summarizer.DigestResult("", 0.0, 0)
+    return await engine.reduce(
+        [result.text for result in partials],
+        cost=sum(result.cost for result in partials),
+        calls=sum(result.calls for result in partials),
+        on_progress=on_progress,
+    )
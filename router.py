@@ -0,0 +1,342 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+import llm
+import metrics
+from summarizer import estimate_tokens
+
+ROUTER_REQUESTS = metrics.counter("llm_router_requests_total", "Запросы через маршрутизатор", ("provider", "result"))
+ROUTER_HEDGES = metrics.counter("llm_router_hedges_total", "Запущенные страхующие запросы", ("provider",))
+
+# Уровни провайдеров: основной и дешёвый (быстрый) для небольших запросов
+MAIN = "main"
+CHEAP = "cheap"
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """Виноват ли в ошибке провайдер.
+
+    Ответы 4xx (кроме 408 и 429) — ошибка самого запроса: слишком
+    длинный контекст, неверный токен. Другой провайдер её не исправит,
+    и на автомат защиты она не влияет.
+    """
+    status = getattr(error, "status_code", None)
+    return status is None or not 400 <= status < 500 or status in (408, 429)
+
+
+class LatencyTracker:
+    """EWMA задержки и доли ошибок плюс окно последних задержек для p95."""
+
+    def __init__(self, alpha: float = 0.2, window: int = 100, initial: float = 10.0):
+        self.alpha = alpha
+        self.latency = initial
+        self.error_rate = 0.0
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def success(self, latency: float) -> None:
+        if self._samples:
+            self.latency += self.alpha * (latency - self.latency)
+        else:
+            self.latency = latency
+        self._samples.append(latency)
+        self.error_rate *= 1 - self.alpha
+
+    def failure(self) -> None:
+        self.error_rate += self.alpha * (1 - self.error_rate)
+
+    def percentile(self, q: float, min_samples: int = 10) -> Optional[float]:
+        """q-квантиль по окну или None, пока данных слишком мало."""
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Автомат защиты провайдера.
+
+    После failure_threshold ошибок подряд провайдер выключается на
+    reset_timeout секунд, затем пропускается один пробный запрос:
+    при успехе провайдер снова доступен, при ошибке пауза удваивается
+    (но не больше max_timeout).
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0,
+                 max_timeout: float = 600.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.timeout = reset_timeout
+        self._opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.timeout:
+            # Пробный запрос; остальные ждут его результата
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self.timeout = self.reset_timeout
+
+    def failure(self) -> bool:
+        """Учитывает ошибку; True, если провайдер только что выключен."""
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.timeout = min(self.timeout * 2, self.max_timeout)
+        elif self.state == self.OPEN or self.failures < self.failure_threshold:
+            return False
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        return True
+
+    def release(self) -> None:
+        """Пробный запрос отменён, не дойдя до результата."""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+
+class Provider:
+    """Один OpenAI-совместимый endpoint с моделью и своей статистикой."""
+
+    def __init__(self, name: str, client: llm.LLMClient, tier: str = MAIN,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.client = client
+        self.tier = tier
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        # Для потоковых ответов важна задержка до первого фрагмента
+        self.first_token = LatencyTracker()
+
+    def score(self, stream: bool) -> float:
+        """Ожидаемая «цена» запроса: задержка с поправкой на долю ошибок."""
+        tracker = self.first_token if stream else self.latency
+        return tracker.latency * (1 + 4 * tracker.error_rate)
+
+
+class Router:
+    """Маршрутизатор запросов к нескольким провайдерам нейросети.
+
+    Интерфейс совпадает с llm.LLMClient (complete, balance, aclose).
+    Провайдеры упорядочиваются по EWMA задержки с поправкой на ошибки;
+    выключенные автоматом защиты пропускаются. Если ответ основного
+    провайдера не пришёл за его p95 (но не дольше hedge_max), параллельно
+    отправляется страхующий запрос следующему, первый успешный ответ
+    побеждает, второй запрос отменяется. Ошибка провайдера (сеть, 5xx,
+    429) сразу передаёт запрос следующему; ошибка самого запроса (4xx)
+    возвращается вызывающему без повторов и не учитывается автоматом.
+
+    Небольшие запросы (до small_tokens) сначала идут дешёвым
+    провайдерам уровня CHEAP; они же — запасной вариант, когда все
+    основные недоступны.
+    """
+
+    def __init__(self, providers: List[Provider], small_tokens: int = 2000,
+                 hedge_quantile: float = 0.95, hedge_default: float = 20.0,
+                 hedge_min: float = 1.0, hedge_max: float = 60.0, max_hedges: int = 1):
+        if not providers:
+            raise ValueError("Нужен хотя бы один провайдер")
+        self.providers = providers
+        self.small_tokens = small_tokens
+        self.hedge_quantile = hedge_quantile
+        self.hedge_default = hedge_default
+        self.hedge_min = hedge_min
+        self.hedge_max = hedge_max
+        self.max_hedges = max_hedges
+        self._latency_gauge = metrics.gauge("llm_provider_latency_ewma_seconds", "EWMA задержки провайдера", ("provider",))
+        self._breaker_gauge = metrics.gauge("llm_provider_open", "Провайдер выключен автоматом защиты", ("provider",))
+
+    def _order(self, small: bool, stream: bool) -> List[Provider]:
+        preferred = CHEAP if small else MAIN
+        # Провайдер с идущим пробным запросом пропускаем; выключенный
+        # остаётся в списке — allow() решит, пора ли его проверить
+        available = [provider for provider in self.providers
+                     if provider.breaker.state != CircuitBreaker.HALF_OPEN]
+        return sorted(
+            available,
+            key=lambda provider: (provider.tier != preferred, provider.score(stream)),
+        )
+
+    def _hedge_delay(self, provider: Provider, stream: bool) -> float:
+        tracker = provider.first_token if stream else provider.latency
+        delay = tracker.percentile(self.hedge_quantile)
+        if delay is None:
+            delay = self.hedge_default
+        return min(self.hedge_max, max(self.hedge_min, delay))
+
+    def _record(self, provider: Provider, stream: bool, started: float,
+                first_token: Optional[float], error: Optional[BaseException]) -> None:
+        if error is None:
+            provider.latency.success(time.monotonic() - started)
+            if stream and first_token is not None:
+                provider.first_token.success(first_token - started)
+            provider.breaker.success()
+            result = "ok"
+        else:
+            provider.latency.failure()
+            if stream:
+                provider.first_token.failure()
+            if provider.breaker.failure():
+                logging.warning(f"Провайдер {provider.name} выключен на {provider.breaker.timeout:g} с "
+                                f"после {provider.breaker.failures} ошибок подряд")
+            result = "error"
+        ROUTER_REQUESTS.inc(provider=provider.name, result=result)
+        self._latency_gauge.set(provider.latency.latency, provider=provider.name)
+        self._breaker_gauge.set(int(provider.breaker.state == CircuitBreaker.OPEN), provider=provider.name)
+
+    async def complete(self, context: str, prompt: str, max_tokens: int = 7500,
+                       temperature: float = 0.6,
+                       on_progress: Optional[Callable[[str], Awaitable[None]]] = None) -> llm.Completion:
+        stream = on_progress is not None
+        small = estimate_tokens(context) + estimate_tokens(prompt) <= self.small_tokens
+        candidates = iter(self._order(small, stream))
+        attempts: Dict[asyncio.Task, Provider] = {}
+        # Поток отдаёт в on_progress только один провайдер — тот, чей
+        # фрагмент пришёл первым; остальные запросы при этом отменяются
+        leader: List[Optional[asyncio.Task]] = [None]
+        hedges = 0
+        last_error: Optional[BaseException] = None
+
+        def start(provider: Provider) -> Provider:
+            started = time.monotonic()
+            first_token: List[Optional[float]] = [None]
+            task: Optional[asyncio.Task] = None
+
+            async def progress(text: str) -> None:
+                if first_token[0] is None:
+                    first_token[0] = time.monotonic()
+                if leader[0] is None:
+                    leader[0] = task
+                    for other in attempts:
+                        if other is not task:
+                            other.cancel()
+                if leader[0] is task:
+                    await on_progress(text)
+
+            async def attempt() -> llm.Completion:
+                try:
+                    completion = await provider.client.complete(
+                        context, prompt, max_tokens=max_tokens, temperature=temperature,
+                        on_progress=progress if stream else None,
+                    )
+                except asyncio.CancelledError:
+                    provider.breaker.release()
+                    raise
+                except Exception as e:
+                    if is_provider_failure(e):
+                        self._record(provider, stream, started, first_token[0], e)
+                    else:
+                        provider.breaker.release()
+                        ROUTER_REQUESTS.inc(provider=provider.name, result="rejected")
+                    raise
+                self._record(provider, stream, started, first_token[0], None)
+                return completion
+
+            task = asyncio.create_task(attempt())
+            attempts[task] = provider
+            return provider
+
+        def start_next() -> Optional[Provider]:
+            for provider in candidates:
+                if provider.breaker.allow():
+                    return start(provider)
+            return None
+
+        if not start_next():
+            raise llm.LLMError("Все провайдеры нейросети временно недоступны")
+        try:
+            while attempts:
+                timeout = None
+                if hedges < self.max_hedges and leader[0] is None and len(attempts) == 1:
+                    timeout = self._hedge_delay(next(iter(attempts.values())), stream)
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Основной запрос дольше обычного — страхуемся следующим провайдером
+                    backup = start_next()
+                    if backup is None:
+                        hedges = self.max_hedges
+                    else:
+                        hedges += 1
+                        ROUTER_HEDGES.inc(provider=backup.name)
+                    continue
+                for task in done:
+                    provider = attempts.pop(task)
+                    if task.cancelled():
+                        continue
+                    error = task.exception()
+                    if error is None:
+                        return task.result()
+                    if not is_provider_failure(error):
+                        raise error
+                    last_error = error
+                    logging.warning(f"Провайдер {provider.name} не ответил: {error}")
+                    if leader[0] is task:
+                        leader[0] = None
+                # Все запущенные запросы завершились ошибкой — пробуем следующего
+                if not attempts and start_next() is None:
+                    break
+        finally:
+            for task in attempts:
+                task.cancel()
+            if attempts:
+                await asyncio.gather(*attempts, return_exceptions=True)
+        if isinstance(last_error, llm.LLMError):
+            raise last_error
+        raise llm.LLMError(f"Ни один провайдер не ответил: {last_error!r}")
+
+    async def balance(self) -> float:
+        """Баланс аккаунта первого доступного основного провайдера."""
+        last_error: Optional[llm.LLMError] = None
+        for provider in self._order(small=False, stream=False):
+            try:
+                return await provider.client.balance()
+            except llm.LLMError as e:
+                last_error = e
+        raise last_error or llm.LLMError("Нет доступных провайдеров")
+
+    async def aclose(self) -> None:
+        for provider in self.providers:
+            await provider.client.aclose()
+
+
+def from_config(config: str, default_url: str, default_token: Optional[str],
+                default_model: str, cheap_model: Optional[str] = None,
+                max_concurrency: int = 8, timeout: float = 120.0,
+                max_retries: int = 1, **router_kwargs) -> Router:
+    """Маршрутизатор по JSON-описанию провайдеров.
+
+    config — список объектов {"name", "url", "model", "tier", "token_env"},
+    где token_env — имя переменной окружения с токеном; пропущенные url
+    и токен берутся по умолчанию. Пустой config даёт
+    основной провайдер default_model и, если задан cheap_model,
+    дешёвый провайдер на том же endpoint.
+    """
+    if config:
+        entries = json.loads(config)
+    else:
+        entries = [{"name": default_model, "model": default_model, "tier": MAIN}]
+        if cheap_model:
+            entries.append({"name": cheap_model, "model": cheap_model, "tier": CHEAP})
+    providers = []
+    for entry in entries:
+        token = os.getenv(entry["token_env"]) if entry.get("token_env") else default_token
+        client = llm.LLMClient(
+            entry.get("url", default_url), token, entry["model"],
+            max_concurrency=max_concurrency, timeout=timeout, max_retries=max_retries,
+        )
+        providers.append(Provider(entry.get("name", entry["model"]), client, entry.get("tier", MAIN)))
+    return Router(providers, **router_kwargs)
@@ -0,0 +1,195 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import db
+import jobs
+import metrics
+
+SCHEDULER_LAG = metrics.histogram("scheduler_lag_seconds", "Задержка постановки дайджеста относительно next_run")
+JOB_SECONDS = metrics.histogram("digest_job_seconds", "Время обработки задачи дайджеста", ("result",))
+
+
+def utcnow() -> datetime:
+    """Текущее время в UTC без tzinfo — в таком виде SQLite хранит next_run."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def parse_next_run(value) -> Optional[datetime]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        logging.error(f"Некорректное значение next_run: {value!r}")
+        return None
+
+
+class DigestScheduler:
+    """Планировщик дайджестов на основе min-кучи по next_run.
+
+    Цикл спит ровно до ближайшего запуска и просыпается сразу, когда
+    расписание какого-либо чата меняется (см. notify). Наступивший
+    дайджест ставится в постоянную очередь jobs, откуда его забирают
+    workers обработчиков — в этом или в любом другом процессе бота.
+    Обработчик получает (chat_id, final_attempt) и возвращает True
+    при успехе; неудачные задачи повторяются с задержкой.
+    """
+
+    def __init__(self, handler: Callable[[int, bool], Awaitable[bool]],
+                 queue: jobs.JobQueue, workers: int = 4,
+                 poll_interval: float = 30.0):
+        self.handler = handler
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._heap: List[Tuple[datetime, int]] = []
+        self._due_at: Dict[int, Tuple[datetime, str]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._jobs_ready: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.running = 0
+
+    async def start(self) -> None:
+        """Восстанавливает брошенные задачи, загружает расписания и запускает обработчики."""
+        self._wakeup = asyncio.Event()
+        self._jobs_ready = asyncio.Event()
+        await self.queue.recover()
+        await self.queue.purge()
+        for chat_id, next_run in await db.get_all_schedules():
+            self._push(chat_id, next_run)
+        self._tasks.append(asyncio.create_task(self._loop()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        logging.info(f"Планировщик запущен, расписаний: {len(self._due_at)}")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _push(self, chat_id: int, raw_next_run: Optional[str]) -> None:
+        # Расписаниями чатов чужого шарда занимаются другие процессы
+        if not self.queue.owns(chat_id):
+            return
+        next_run = parse_next_run(raw_next_run)
+        if next_run is None:
+            self._due_at.pop(chat_id, None)
+            return
+        self._due_at[chat_id] = (next_run, str(raw_next_run))
+        heapq.heappush(self._heap, (next_run, chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def notify(self, chat_id: int, next_run=None) -> None:
+        """Сообщает об изменении расписания чата.
+
+        Если next_run не передан, актуальное значение читается из БД.
+        """
+        if next_run is not None:
+            self._push(chat_id, next_run)
+        elif self._tasks:
+            asyncio.get_running_loop().create_task(self.reload(chat_id))
+
+    async def reload(self, chat_id: int) -> None:
+        """Перечитывает next_run чата из БД."""
+        self._push(chat_id, await db.get_next_run(chat_id))
+
+    async def _loop(self) -> None:
+        while True:
+            now = utcnow()
+            while self._heap and self._heap[0][0] <= now:
+                next_run, chat_id = heapq.heappop(self._heap)
+                entry = self._due_at.get(chat_id)
+                # Запись устарела: расписание чата с тех пор менялось
+                if entry is None or entry[0] != next_run:
+                    continue
+                del self._due_at[chat_id]
+                SCHEDULER_LAG.observe((utcnow() - next_run).total_seconds())
+                await self._enqueue(chat_id, entry[1])
+
+            timeout = None
+            if self._heap:
+                timeout = (self._heap[0][0] - utcnow()).total_seconds()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _enqueue(self, chat_id: int, due: str) -> None:
+        try:
+            job_id, next_run = await db.enqueue_due_digest(chat_id, due)
+        except Exception as e:
+            logging.error(f"Не удалось поставить дайджест чата {chat_id} в очередь: {e}")
+            asyncio.get_running_loop().call_later(self.poll_interval, self.notify, chat_id)
+            return
+        self._push(chat_id, next_run)
+        if job_id is not None:
+            self._jobs_ready.set()
+
+    async def _wait_for_jobs(self) -> None:
+        timeout = self.poll_interval
+        try:
+            pending = await self.queue.seconds_until_next()
+        except Exception:
+            pending = None
+        if pending is not None:
+            timeout = min(timeout, max(pending, 1.0))
+        try:
+            await asyncio.wait_for(self._jobs_ready.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._jobs_ready.clear()
+
+    async def _keep_lease(self, job: jobs.Job) -> None:
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            if not await self.queue.extend(job):
+                logging.warning(f"Аренда задачи {job.id} потеряна")
+                return
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                job = await self.queue.claim()
+            except Exception as e:
+                logging.error(f"Не удалось получить задачу из очереди: {e}")
+                job = None
+            if job is None:
+                await self._wait_for_jobs()
+                continue
+            # Другие обработчики могут забрать следующую задачу
+            self._jobs_ready.set()
+            await self._run(job)
+
+    async def _run(self, job: jobs.Job) -> None:
+        self.running += 1
+        heartbeat = asyncio.create_task(self._keep_lease(job))
+        started = time.monotonic()
+        # Отмена при остановке прерывает обработчик до присваивания
+        ok = False
+        try:
+            ok = await self.handler(job.chat_id, job.attempts >= job.max_attempts)
+            error = "" if ok else "Обработчик вернул ошибку"
+        except Exception as e:
+            ok, error = False, str(e)
+            logging.error(f"Ошибка дайджеста для чата {job.chat_id}: {e}")
+        finally:
+            heartbeat.cancel()
+            self.running -= 1
+            JOB_SECONDS.observe(time.monotonic() - started, result="ok" if ok else "error")
+        try:
+            if ok:
+                await self.queue.complete(job)
+            else:
+                await self.queue.fail(job, error)
+        except Exception as e:
+            # Аренда истечёт, и задачу подберут повторно
+            logging.error(f"Не удалось обновить статус задачи {job.id}: {e}")
@@ -0,0 +1,176 @@
+import re
+import sqlite3
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import crypto
+from pool import ConnectionPool
+
+WORD = re.compile(r"\w+")
+# Более короткие слова (предлоги, союзы) не индексируются
+MIN_WORD = 3
+# Окончания, которые отбрасываются, чтобы «релиз», «релиза» и «релизы»
+# попали в один терм; основа не короче MIN_STEM символов
+ENDINGS = (
+    "иями", "ием", "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ов", "ев", "ей", "ой",
+    "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ом", "ем", "ам", "ям", "ах", "ях",
+    "ия", "ии", "ию", "ую", "юю", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь",
+    "ing", "ed", "es", "s", "e",
+)
+MIN_STEM = 3
+# Окончания по длине, от длинных к коротким
+_ENDINGS_BY_LENGTH = [
+    (length, frozenset(ending for ending in ENDINGS if len(ending) == length))
+    for length in sorted({len(ending) for ending in ENDINGS}, reverse=True)
+]
+
+
+@lru_cache(maxsize=65536)
+def normalize(word: str) -> Optional[str]:
+    """Нормализованная форма слова или None, если слово не индексируется."""
+    word = word.lower().replace("ё", "е")
+    if len(word) < MIN_WORD:
+        return None
+    for length, endings in _ENDINGS_BY_LENGTH:
+        if len(word) - length >= MIN_STEM and word[-length:] in endings:
+            return word[:-length]
+    return word
+
+
+def words(text: str) -> List[str]:
+    """Различные нормализованные слова текста в порядке появления."""
+    return list(dict.fromkeys(
+        normalized for normalized in map(normalize, WORD.findall(text)) if normalized
+    ))
+
+
+def matches(text: str, query_words: List[str]) -> bool:
+    """Содержит ли текст все слова запроса (проверка после расшифровки)."""
+    found = set(words(text))
+    return all(word in found for word in query_words)
+
+
+def index_messages(conn: sqlite3.Connection, entries: List[Tuple[int, int, List[int]]]) -> None:
+    """Записывает термы сообщений (message_id, chat_id, термы) и помечает их проиндексированными.
+
+    Сообщения, удалённые или перенесённые в другой чат за время
+    построения термов, пропускаются.
+    """
+    conn.executemany("""
+        INSERT OR IGNORE INTO message_terms (term, message_id)
+        SELECT ?, ? WHERE EXISTS (SELECT 1 FROM messages WHERE id = ? AND chat_id = ?)
+    """, [
+        (term, message_id, message_id, chat_id)
+        for message_id, chat_id, terms in entries
+        for term in terms
+    ])
+    conn.executemany(
+        "UPDATE messages SET indexed = 1 WHERE id = ? AND chat_id = ?",
+        [(message_id, chat_id) for message_id, chat_id, _ in entries],
+    )
+
+
+def unindexed(conn: sqlite3.Connection, after_id: int, limit: int) -> List[tuple]:
+    """Следующие непроиндексированные сообщения: (id, chat_id, зашифрованный текст)."""
+    return conn.execute("""
+        SELECT id, chat_id, message FROM messages
+        WHERE indexed = 0 AND id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (after_id, limit)).fetchall()
+
+
+def has_unindexed(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT EXISTS (SELECT 1 FROM messages WHERE indexed = 0)").fetchone()[0] == 1
+
+
+def find(conn: sqlite3.Connection, terms: List[int], limit: int) -> List[int]:
+    """id последних сообщений, содержащих все термы, от новых к старым.
+
+    Термы уже привязаны к чату (см. crypto.blind_terms).
+    """
+    placeholders = ", ".join("?" * len(terms))
+    return [row[0] for row in conn.execute(f"""
+        SELECT message_id FROM message_terms
+        WHERE term IN ({placeholders})
+        GROUP BY message_id
+        HAVING COUNT(*) = ?
+        ORDER BY message_id DESC
+        LIMIT ?
+    """, (*terms, len(terms), limit)).fetchall()]
+
+
+def check_key(conn: sqlite3.Connection, key_check: bytes) -> bool:
+    """Сверяет отпечаток ключа индекса; при смене ключа помечает индекс устаревшим.
+
+    Сам индекс здесь не трогается: термы старого ключа сбрасываются
+    пачками (reset_batch), чтобы не держать запись в БД. Возвращает True,
+    если такой сброс нужен, в том числе прерванный при прошлом запуске.
+    """
+    row = conn.execute("SELECT key_check, stale_until FROM search_index_state WHERE id = 1").fetchone()
+    if row is not None and row[0] == key_check:
+        return row[1] > 0
+    # Новые сообщения (id больше текущего) сразу индексируются новым ключом
+    stale_until = 0 if row is None else conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    conn.execute("""
+        INSERT OR REPLACE INTO search_index_state (id, key_check, stale_until) VALUES (1, ?, ?)
+    """, (key_check, stale_until))
+    return stale_until > 0
+
+
+def reset_batch(conn: sqlite3.Connection, limit: int) -> int:
+    """Сбрасывает индекс последних limit устаревших сообщений (от больших id к меньшим).
+
+    Их термы удаляются, а сами сообщения снова ждут индексации.
+    Возвращает, сколько id ещё осталось сбросить (0 — сброс закончен).
+    """
+    stale_until = conn.execute("SELECT stale_until FROM search_index_state WHERE id = 1").fetchone()[0]
+    if stale_until <= 0:
+        return 0
+    row = conn.execute("""
+        SELECT MIN(id) FROM (
+            SELECT id FROM messages WHERE id <= ? ORDER BY id DESC LIMIT ?
+        )
+    """, (stale_until, limit)).fetchone()
+    low = row[0] if row[0] is not None else 1
+    conn.execute("DELETE FROM message_terms WHERE message_id BETWEEN ? AND ?", (low, stale_until))
+    conn.execute("UPDATE messages SET indexed = 0 WHERE id BETWEEN ? AND ? AND indexed = 1", (low, stale_until))
+    conn.execute("UPDATE search_index_state SET stale_until = ? WHERE id = 1", (low - 1,))
+    return low - 1
+
+
+class BlindIndex:
+    """Слепой индекс для поиска по зашифрованной переписке.
+
+    Для каждого сообщения хранятся HMAC-хэши его нормализованных слов
+    вместе с id чата (crypto.blind_terms), так что поиск по ключевым словам идёт по
+    индексу message_terms, а расшифровываются только найденные
+    сообщения. Ключ HMAC в БД не хранится.
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+
+    @staticmethod
+    def terms(chat_id: int, text: str) -> List[int]:
+        return crypto.blind_terms(chat_id, words(text))
+
+    async def find(self, chat_id: int, query_words: List[str], limit: int = 20) -> List[int]:
+        if not query_words:
+            return []
+        return await self.pool.read(find, crypto.blind_terms(chat_id, query_words), limit)
+
+    async def index(self, entries: List[Tuple[int, int, List[int]]]) -> None:
+        await self.pool.write(index_messages, entries)
+
+    async def unindexed(self, after_id: int, limit: int) -> List[tuple]:
+        return await self.pool.read(unindexed, after_id, limit)
+
+    async def has_unindexed(self) -> bool:
+        return await self.pool.read(has_unindexed)
+
+    async def check_key(self) -> bool:
+        return await self.pool.write(check_key, crypto.index_key_check())
+
+    async def reset_batch(self, limit: int) -> int:
+        return await self.pool.write(reset_batch, limit)
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, TelegramError
+
+import outbox
+from outbox import MESSAGE_LIMIT, Outbox, split_markdown
+
+
+def split_pages(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    return [text[i:i + limit] for i in range(0, len(text), limit)] or [""]
+
+
+async def edit_page(message: Message, text: str, parse_mode: Optional[str] = None) -> Message:
+    """Правит сообщение; повторная правка тем же текстом не считается ошибкой."""
+    try:
+        return await message.edit_text(text, parse_mode=parse_mode)
+    except BadRequest as e:
+        error = str(e).lower()
+        if "not modified" in error:
+            return message
+        if parse_mode is None or "parse" not in error:
+            raise
+        logging.warning(f"Разметка не принята Telegram ({e}), отправляем без неё")
+        return await message.edit_text(text)
+
+
+class ProgressiveReply:
+    """Показывает генерируемый текст, редактируя сообщение по мере поступления.
+
+    Все запросы к Telegram идут через очередь отправки. Промежуточные
+    правки уходят с низшим приоритетом, не чаще раза в interval секунд, и
+    в очереди всегда не больше одной: пока она ждёт, текст просто
+    дописывается. Когда текст перерастает лимит Telegram, продолжение
+    отправляется новым сообщением. Ошибки промежуточных правок только
+    логируются, чтобы не прерывать генерацию.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, sender: Outbox,
+                 priority: int = outbox.SCHEDULED, interval: float = 1.5,
+                 limit: int = MESSAGE_LIMIT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.sender = sender
+        self.priority = priority
+        self.interval = interval
+        self.limit = limit
+        self._messages: List[Message] = []
+        self._rendered: List[str] = []
+        self._latest = ""
+        self._last_edit = 0.0
+        self._pending: Optional[asyncio.Task] = None
+
+    async def begin(self, text: str, **kwargs) -> None:
+        """Отправляет сообщение-заглушку, которое потом будет заменено текстом."""
+        message = await self.sender.submit(
+            self.chat_id,
+            lambda: self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs),
+            self.priority,
+        )
+        self._messages, self._rendered = [message], [text]
+
+    async def update(self, text: str) -> None:
+        """Колбэк для LLMClient.complete(on_progress=...)."""
+        self._latest = text
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.create_task(self._push_progress())
+
+    async def _push_progress(self) -> None:
+        delay = self._last_edit + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._last_edit = time.monotonic()
+        try:
+            await self._render(split_pages(self._latest, self.limit), None, outbox.PROGRESS, cursor=" …")
+        except TelegramError as e:
+            logging.warning(f"Не удалось обновить сообщение с дайджестом: {e}")
+
+    async def _cancel_progress(self) -> None:
+        if self._pending is not None:
+            self._pending.cancel()
+            await asyncio.gather(self._pending, return_exceptions=True)
+            self._pending = None
+
+    async def finish(self, text: str, parse_mode: Optional[str] = "Markdown") -> None:
+        """Выводит окончательный текст, разбитый по границам разметки."""
+        await self._cancel_progress()
+        pages = split_markdown(text, self.limit) if parse_mode else split_pages(text, self.limit)
+        await self._render(pages, parse_mode, self.priority, force=True)
+        await self._delete(self._messages[len(pages):])
+        del self._messages[len(pages):], self._rendered[len(pages):]
+
+    async def fail(self, text: str) -> None:
+        """Заменяет заглушку сообщением об ошибке."""
+        await self.finish(text, parse_mode=None)
+
+    async def discard(self) -> None:
+        """Удаляет отправленные сообщения, например перед повторной попыткой."""
+        await self._cancel_progress()
+        await self._delete(self._messages)
+        self._messages, self._rendered = [], []
+
+    async def _delete(self, messages: List[Message]) -> None:
+        for message in messages:
+            try:
+                await self.sender.submit(self.chat_id, message.delete, self.priority)
+            except TelegramError as e:
+                logging.warning(f"Не удалось удалить сообщение: {e}")
+
+    async def _render(self, pages: List[str], parse_mode: Optional[str], priority: int,
+                      cursor: str = "", force: bool = False) -> None:
+        for index, page in enumerate(pages):
+            is_last = index == len(pages) - 1
+            body = page + cursor if is_last else page
+            if index < len(self._messages):
+                if not force and index < len(self._rendered) and self._rendered[index] == body:
+                    continue
+                message = self._messages[index]
+                await self.sender.submit(
+                    self.chat_id, lambda: edit_page(message, body, parse_mode), priority
+                )
+            else:
+                message = await self.sender.submit(
+                    self.chat_id,
+                    lambda: outbox.send_page(self.bot, self.chat_id, body, parse_mode),
+                    priority,
+                )
+                self._messages.append(message)
+            if index < len(self._rendered):
+                self._rendered[index] = body
+            else:
+                self._rendered.append(body)
@@ -0,0 +1,218 @@
+import asyncio
+import copy
+import logging
+from typing import Any, Awaitable, Callable, List, NamedTuple, Optional, Tuple
+
+import llm
+
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+SYSTEM_MESSAGE = (
+    "Ты ассистент для создания дайджестов чата. Проанализируй сообщения и создай структурированный дайджест:\n"
+    "1. Выдели основные темы и обсуждения\n"
+    "2. Кратко суммируй важные моменты\n"
+    "3. Сохрани нейтральный тон\n"
+    "4. Не добавляй информацию, которой нет в сообщениях\n"
+    "5. Используй markdown для форматирования, не используй # для заголовков\n"
+    "6. Используй эмодзи для визуала"
+)
+
+# Промпт для конспекта одной части переписки (шаг map)
+CHUNK_SYSTEM_MESSAGE = (
+    "Ты ассистент для создания дайджестов чата. Перед тобой часть переписки.\n"
+    "Составь краткий конспект: основные темы, решения, договорённости и важные факты.\n"
+    "Не добавляй информацию, которой нет в сообщениях, и не пиши вступлений.\n"
+    "Используй простой список без markdown."
+)
+
+# Промпт для объединения конспектов в итоговый дайджест (шаг reduce)
+REDUCE_SYSTEM_MESSAGE = (
+    "Ты ассистент для создания дайджестов чата. Перед тобой конспекты последовательных частей переписки.\n"
+    "Объедини их в один структурированный дайджест:\n"
+    "1. Выдели основные темы и обсуждения, объединяя повторы\n"
+    "2. Кратко суммируй важные моменты\n"
+    "3. Сохрани нейтральный тон\n"
+    "4. Не добавляй информацию, которой нет в конспектах\n"
+    "5. Используй markdown для форматирования, не используй # для заголовков\n"
+    "6. Используй эмодзи для визуала"
+)
+
+# Ответ, когда после предфильтрации не осталось ни одного сообщения
+EMPTY_DIGEST_TEXT = "За этот период не нашлось содержательных сообщений для дайджеста."
+
+
+def focus_header(topic: Optional[str]) -> str:
+    """Начало промпта для дайджеста по одной теме."""
+    if not topic:
+        return ""
+    return f"Тема дайджеста: {topic}. Опиши только то, что относится к этой теме.\n\n"
+
+
+class DigestResult(NamedTuple):
+    """Итоговый дайджест и суммарная стоимость всех запросов к модели."""
+    text: str
+    cost: float
+    calls: int
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: для смеси русского и английского ~3 символа на токен."""
+    return len(text) // 3 + 1
+
+
+def split_into_chunks(lines: List[str], budget: int) -> List[List[str]]:
+    """Жадно раскладывает строки по частям, каждая не больше budget токенов."""
+    chunks: List[List[str]] = []
+    current: List[str] = []
+    used = 0
+    for line in lines:
+        tokens = estimate_tokens(line)
+        if tokens > budget:
+            # Одна строка не влезает целиком — обрезаем её
+            line = line[:budget * 3]
+            tokens = budget
+        if current and used + tokens > budget:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(line)
+        used += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class DigestEngine:
+    """Иерархическое (map-reduce) суммаризирование длинной переписки.
+
+    Если сообщения помещаются в chunk_tokens, дайджест строится одним
+    запросом. Иначе переписка делится на части, части конспектируются
+    параллельно (не больше parallelism запросов одновременно), а
+    конспекты сводятся в итоговый дайджест — при необходимости в
+    несколько уровней.
+
+    prefilter, если задан, вызывается в отдельном потоке перед построением
+    промпта как prefilter(сообщения, input_tokens) и должен вернуть
+    (отобранные сообщения, статистику).
+    """
+
+    def __init__(self, client: llm.LLMClient, chunk_tokens: int = 6000,
+                 parallelism: int = 4, max_tokens: int = 7500,
+                 partial_max_tokens: int = 1500, input_tokens: int = 24000,
+                 prefilter: Optional[Callable[[List[str], int], Tuple[List[str], Any]]] = None):
+        self.client = client
+        self.prefilter = prefilter
+        self.chunk_tokens = chunk_tokens
+        self.parallelism = parallelism
+        self.max_tokens = max_tokens
+        self.partial_max_tokens = partial_max_tokens
+        self.input_tokens = input_tokens
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def sized(self, max_tokens: int, input_tokens: int) -> "DigestEngine":
+        """Копия с другими лимитами ответа и входа (см. usage.Sizing).
+
+        Клиент и ограничение параллельности у копии общие с исходным движком.
+        """
+        self._limit()
+        engine = copy.copy(self)
+        engine.max_tokens = max_tokens
+        engine.partial_max_tokens = min(self.partial_max_tokens, max_tokens)
+        engine.input_tokens = input_tokens
+        return engine
+
+    def _limit(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.parallelism)
+        return self._semaphore
+
+    async def _call(self, context: str, prompt: str, max_tokens: int,
+                    on_progress: Optional[ProgressCallback] = None) -> llm.Completion:
+        async with self._limit():
+            return await self.client.complete(
+                context, prompt, max_tokens=max_tokens, on_progress=on_progress
+            )
+
+    async def _map(self, chunks: List[List[str]], header: str) -> List[llm.Completion]:
+        return await asyncio.gather(*[
+            self._call(CHUNK_SYSTEM_MESSAGE, header + "\n".join(chunk), self.partial_max_tokens)
+            for chunk in chunks
+        ])
+
+    async def _prepare(self, messages: List[str]) -> List[str]:
+        if self.prefilter is None or not messages:
+            return messages
+        selected, stats = await asyncio.to_thread(self.prefilter, messages, self.input_tokens)
+        logging.info(f"Предфильтрация: {stats}")
+        return selected
+
+    async def summarize(self, messages: List[str],
+                        on_progress: Optional[ProgressCallback] = None,
+                        topic: Optional[str] = None) -> DigestResult:
+        """Строит дайджест по списку расшифрованных сообщений.
+
+        on_progress получает текст итогового дайджеста по мере генерации;
+        topic, если задан, сужает дайджест до одной темы.
+        """
+        messages = await self._prepare(messages)
+        if not messages:
+            # Предфильтр отбросил всё (одни «+» и стикеры) — модель не нужна
+            return DigestResult(EMPTY_DIGEST_TEXT, 0.0, 0)
+        lines = [f"{i+1}. {msg}" for i, msg in enumerate(messages)]
+        chunks = split_into_chunks(lines, self.chunk_tokens)
+        header = focus_header(topic)
+        if len(chunks) <= 1:
+            completion = await self._call(
+                SYSTEM_MESSAGE, header + "Сообщения:\n" + "\n".join(lines), self.max_tokens, on_progress
+            )
+            return DigestResult(completion.content, completion.cost or 0.0, 1)
+
+        logging.info(f"Дайджест по {len(messages)} сообщениям разбит на {len(chunks)} частей")
+        partials = await self._map(chunks, header + "Сообщения:\n")
+        return await self.reduce(
+            [completion.content for completion in partials],
+            cost=sum(completion.cost or 0.0 for completion in partials),
+            calls=len(partials),
+            on_progress=on_progress,
+            topic=topic,
+        )
+
+    async def summarize_partial(self, messages: List[str]) -> DigestResult:
+        """Конспект части переписки для последующего объединения через reduce."""
+        messages = await self._prepare(messages)
+        lines = [f"{i+1}. {msg}" for i, msg in enumerate(messages)]
+        partials = await self._map(split_into_chunks(lines, self.chunk_tokens), "Сообщения:\n")
+        return DigestResult(
+            "\n".join(completion.content for completion in partials),
+            sum(completion.cost or 0.0 for completion in partials),
+            len(partials),
+        )
+
+    async def reduce(self, summaries: List[str], cost: float = 0.0, calls: int = 0,
+                     on_progress: Optional[ProgressCallback] = None,
+                     topic: Optional[str] = None) -> DigestResult:
+        """Сводит конспекты частей в итоговый дайджест."""
+        header = focus_header(topic)
+        while True:
+            lines = [f"Часть {i+1}:\n{summary}" for i, summary in enumerate(summaries)]
+            chunks = split_into_chunks(lines, self.chunk_tokens)
+            if len(chunks) <= 1:
+                # Всё помещается в одну часть (слишком длинный конспект в ней уже обрезан)
+                lines = chunks[0] if chunks else lines
+                break
+            if len(chunks) >= len(summaries):
+                # Свернуть дальше не получается: каждый конспект занимает
+                # почти целую часть — урезаем их поровну, чтобы итоговый
+                # запрос тоже уложился в chunk_tokens
+                share = self.chunk_tokens // len(lines)
+                lines = [line[:share * 3] for line in lines]
+                break
+            # Конспекты всё ещё не помещаются — сворачиваем ещё на уровень
+            partials = await self._map(chunks, header + "Конспекты частей переписки:\n")
+            summaries = [completion.content for completion in partials]
+            cost += sum(completion.cost or 0.0 for completion in partials)
+            calls += len(partials)
+
+        completion = await self._call(
+            REDUCE_SYSTEM_MESSAGE, header + "Конспекты:\n" + "\n\n".join(lines), self.max_tokens, on_progress
+        )
+        return DigestResult(completion.content, cost + (completion.cost or 0.0), calls + 1)
@@ -0,0 +1,36 @@
+import pytest
+from cryptography.fernet import Fernet
+
+import crypto
+
+zstandard = pytest.importorskip("zstandard")
+
+
+@pytest.fixture(autouse=True)
+def key(monkeypatch):
+    monkeypatch.setenv("ENCRYPTION_KEY", Fernet.generate_key().decode())
+    crypto.reset_cipher()
+    yield
+    crypto.set_dictionary_loader(None)
+    crypto.install_dictionaries({}, None)
+    crypto.reset_cipher()
+
+
+def _dictionary() -> tuple:
+    samples = [f"релиз {i} перенесли на пятницу, тесты зелёные".encode() for i in range(2000)]
+    trained = zstandard.train_dictionary(4096, samples)
+    return trained.dict_id(), trained.as_bytes()
+
+
+def test_unknown_dictionary_is_loaded_on_demand():
+    dict_id, data = _dictionary()
+    crypto.install_dictionaries({dict_id: data}, dict_id)
+    stored = crypto.encrypt_many(["релиз 7 перенесли на пятницу"])
+    # Словарь обучил другой процесс: этот о нём ещё не знает
+    crypto.install_dictionaries({}, None)
+    with pytest.raises(crypto.UnknownDictionary):
+        crypto.decrypt_many(stored)
+
+    crypto.set_dictionary_loader(lambda: ({dict_id: data}, dict_id))
+    assert crypto.decrypt_many(stored) == ["релиз 7 перенесли на пятницу"]
+    assert crypto.active_dictionary() == dict_id
@@ -0,0 +1,46 @@
+import asyncio
+from datetime import datetime
+
+from ingest import MessageBuffer, PendingMessage
+
+
+def _message(i: int) -> PendingMessage:
+    return PendingMessage(-1, "chat", 1, "Анна", None, None, f"сообщение {i}", datetime.now())
+
+
+def test_stop_during_background_flush_keeps_messages():
+    written = []
+
+    async def slow_flush(batch):
+        await asyncio.sleep(0.2)
+        written.extend(batch)
+
+    async def main():
+        buffer = MessageBuffer(slow_flush, max_size=100, max_delay=0.01)
+        await buffer.start()
+        for i in range(3):
+            await buffer.put(_message(i))
+        # Фоновый сброс уже начался и ждёт записи
+        await asyncio.sleep(0.05)
+        await buffer.stop()
+        return len(buffer)
+
+    assert asyncio.run(main()) == 0
+    assert [m.text for m in written] == [f"сообщение {i}" for i in range(3)]
+
+
+def test_stop_drains_items_added_after_last_flush():
+    written = []
+
+    async def flush(batch):
+        written.extend(batch)
+
+    async def main():
+        buffer = MessageBuffer(flush, max_size=100, max_delay=60)
+        await buffer.start()
+        for i in range(5):
+            await buffer.put(_message(i))
+        await buffer.stop()
+
+    asyncio.run(main())
+    assert len(written) == 5
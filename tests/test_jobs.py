@@ -0,0 +1,36 @@
+import sqlite3
+
+import pytest
+
+import jobs
+import migrations
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def test_claim_skips_other_shard(conn):
+    jobs.enqueue(conn, "digest", chat_id=3)
+    assert jobs.claim(conn, "w", 60, shards=2, shard=0) is None
+    job = jobs.claim(conn, "w", 60, shards=2, shard=1)
+    assert job is not None and job.chat_id == 3
+
+
+def test_claim_skips_chat_with_running_job(conn):
+    jobs.enqueue(conn, "digest", chat_id=5, dedupe_key="a")
+    jobs.enqueue(conn, "digest", chat_id=5, dedupe_key="b")
+    assert jobs.claim(conn, "w1", 60) is not None
+    assert jobs.claim(conn, "w2", 60) is None
+
+
+def test_seconds_until_next_ignores_other_shard(conn):
+    jobs.enqueue(conn, "digest", chat_id=3, delay=1)
+    jobs.enqueue(conn, "digest", chat_id=4, delay=600)
+    assert jobs.seconds_until_next(conn, shards=2, shard=0) > 500
+    assert jobs.seconds_until_next(conn, shards=2, shard=1) < 5
+    assert jobs.seconds_until_next(conn, shards=3, shard=2) is None
@@ -0,0 +1,45 @@
+import sqlite3
+
+import migrations
+
+# Схема базы, созданной ботом до появления schema_version
+LEGACY_SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, username TEXT);
+CREATE TABLE chats (id INTEGER PRIMARY KEY, chat_title TEXT);
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER,
+    user_id INTEGER,
+    message TEXT,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE schedules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    chat_id INTEGER,
+    frequency TEXT DEFAULT 'weekly',
+    next_run DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO messages (chat_id, user_id, message) VALUES (-1, 1, 'gAAAAA-token');
+INSERT INTO schedules (user_id, chat_id) VALUES (1, -1);
+"""
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_legacy_database_migrates_to_latest(tmp_path):
+    conn = sqlite3.connect(tmp_path / "legacy.db", isolation_level=None)
+    conn.executescript(LEGACY_SCHEMA)
+
+    latest = migrations.MIGRATIONS[-1].version
+    assert migrations.migrate(conn) == latest
+    # Повторный запуск ничего не меняет
+    assert migrations.migrate(conn) == latest
+
+    assert conn.execute("SELECT message, indexed FROM messages").fetchall() == [("gAAAAA-token", 0)]
+    assert conn.execute("SELECT COUNT(*) FROM schedules").fetchone()[0] == 1
+    assert "token_budget" in _columns(conn, "chat_settings")
+    assert "stale_until" in _columns(conn, "search_index_state")
+    conn.close()
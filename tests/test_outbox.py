@@ -0,0 +1,18 @@
+from outbox import split_markdown
+
+
+def test_fence_closing_marker_is_not_cut():
+    text = "Intro\n\n```\n" + "x" * 3990 + "\n```\nafter"
+    chunks = split_markdown(text, 4000)
+    assert chunks == ["Intro", "```\n" + "x" * 3990 + "\n```", "after"]
+
+
+def test_long_code_block_is_cut_between_lines():
+    text = "```\n" + "line\n" * 2000 + "```"
+    chunks = split_markdown(text, 4000)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(chunk) <= 4000
+        assert chunk.startswith("```\n") and chunk.endswith("\n```")
+        assert set(chunk[4:-4].split("\n")) == {"line"}
+    assert sum(chunk.count("line") for chunk in chunks) == 2000
@@ -0,0 +1,26 @@
+from usage import Sizing, UsageLedger
+
+
+def _ledger() -> UsageLedger:
+    return UsageLedger(None, max_tokens=7500, min_tokens=500, input_tokens=24000)
+
+
+def test_size_without_budget_keeps_full_input():
+    assert _ledger().size(1000, None) == Sizing(500, 24000)
+
+
+def test_size_keeps_full_input_when_budget_allows():
+    # Оценка по числу сообщений мала, но остатка хватает на полный вход
+    assert _ledger().size(60 * 25, 1_000_000) == Sizing(500, 24000)
+
+
+def test_size_lowers_input_to_affordable():
+    sizing = _ledger().size(1000, 10500)
+    assert sizing.max_tokens == 500
+    assert sizing.input_tokens == int((10500 - 500) / 1.2)
+
+
+def test_size_scales_down_or_refuses_when_over_budget():
+    sizing = _ledger().size(20000, 20000)
+    assert sizing is not None and sizing.max_tokens < 5000 and sizing.input_tokens < 20000
+    assert _ledger().size(20000, 1000) is None
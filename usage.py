@@ -0,0 +1,200 @@
+import logging
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, NamedTuple, Optional, TypeVar
+
+import llm
+import metrics
+from pool import ConnectionPool
+
+T = TypeVar("T")
+
+# Грубая оценка размера сообщения чата, когда сами тексты ещё не загружены
+MESSAGE_TOKENS = 25
+
+OVER_BUDGET = metrics.counter("digest_over_budget_total", "Дайджесты, отклонённые из-за лимита токенов", ("kind",))
+
+
+class BudgetExceeded(Exception):
+    """Лимит токенов чата исчерпан."""
+
+
+class Totals(NamedTuple):
+    """Расход за период по сводке usage_daily."""
+    digests: int = 0
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    latency: float = 0.0
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+class Sizing(NamedTuple):
+    """Размер дайджеста: лимит ответа модели и объём переписки на входе."""
+    max_tokens: int
+    input_tokens: int
+
+
+def _day(days_ago: int = 0) -> str:
+    """Дата в формате usage_daily.day; сутки считаются по UTC, как CURRENT_TIMESTAMP."""
+    return (datetime.now(timezone.utc) - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+
+
+def record(conn: sqlite3.Connection, chat_id: int, kind: str,
+           tally: llm.UsageTally, latency: float) -> None:
+    """Записывает расход одного дайджеста; сводку обновляет триггер."""
+    conn.execute("""
+        INSERT INTO usage_log
+            (chat_id, kind, model, calls, prompt_tokens, completion_tokens, cost, latency)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (chat_id, kind, tally.model, tally.calls, tally.prompt_tokens,
+          tally.completion_tokens, tally.cost, latency))
+
+
+def totals(conn: sqlite3.Connection, since_day: str, chat_id: Optional[int] = None) -> Totals:
+    """Итоги с since_day включительно — по чату или по всем чатам."""
+    query = """
+        SELECT COALESCE(SUM(digests), 0), COALESCE(SUM(calls), 0),
+               COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0),
+               COALESCE(SUM(cost), 0), COALESCE(SUM(latency), 0)
+        FROM usage_daily WHERE day >= ?
+    """
+    params = [since_day]
+    if chat_id is not None:
+        query += " AND chat_id = ?"
+        params.append(chat_id)
+    return Totals(*conn.execute(query, params).fetchone())
+
+
+def top_chats(conn: sqlite3.Connection, since_day: str, limit: int = 10) -> List[tuple]:
+    """Чаты с наибольшим расходом токенов: (chat_id, токены, стоимость)."""
+    return conn.execute("""
+        SELECT chat_id, SUM(prompt_tokens + completion_tokens) AS tokens, SUM(cost)
+        FROM usage_daily WHERE day >= ?
+        GROUP BY chat_id
+        ORDER BY tokens DESC
+        LIMIT ?
+    """, (since_day, limit)).fetchall()
+
+
+def get_budget(conn: sqlite3.Connection, chat_id: int) -> Optional[int]:
+    row = conn.execute("SELECT token_budget FROM chat_settings WHERE chat_id = ?", (chat_id,)).fetchone()
+    return row[0] if row else None
+
+
+def set_budget(conn: sqlite3.Connection, chat_id: int, tokens: Optional[int]) -> None:
+    conn.execute("""
+        INSERT INTO chat_settings (chat_id, token_budget)
+        VALUES (?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            token_budget = excluded.token_budget,
+            updated_at = CURRENT_TIMESTAMP
+    """, (chat_id, tokens))
+
+
+class UsageLedger:
+    """Учёт расхода нейросети и лимиты токенов чатов.
+
+    Каждый дайджест (и архивный конспект) записывается в usage_log с
+    токенами, стоимостью, временем генерации и моделью; суточная
+    сводка usage_daily поддерживается триггером. Лимит чата — токенов
+    за последние window_days суток: token_budget из chat_settings или
+    default_budget (0 — без ограничений).
+
+    plan подбирает размер дайджеста до обращения к модели: лимит ответа
+    растёт с объёмом переписки (output_ratio от входа, от min_tokens до
+    max_tokens), а если оценка расхода не помещается в остаток лимита,
+    вход и ответ пропорционально ужимаются.
+    """
+
+    def __init__(self, pool: ConnectionPool, default_budget: int = 0, window_days: int = 30,
+                 max_tokens: int = 7500, min_tokens: int = 500, input_tokens: int = 24000,
+                 output_ratio: float = 0.25, overhead: float = 1.2):
+        self.pool = pool
+        self.default_budget = default_budget
+        self.window_days = window_days
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.input_tokens = input_tokens
+        self.output_ratio = output_ratio
+        # Запас на промпты и конспекты частей при map-reduce
+        self.overhead = overhead
+
+    async def record(self, chat_id: int, kind: str, tally: llm.UsageTally, latency: float) -> None:
+        await self.pool.write(record, chat_id, kind, tally, latency)
+
+    async def track(self, chat_id: int, kind: str, func: Callable[[], Awaitable[T]]) -> T:
+        """Выполняет func() и записывает расход всех её запросов к модели.
+
+        Расход записывается и при ошибке: токены уже потрачены.
+        """
+        tally = llm.UsageTally()
+        token = llm.current_usage.set(tally)
+        started = time.monotonic()
+        try:
+            return await func()
+        finally:
+            llm.current_usage.reset(token)
+            if tally.calls:
+                try:
+                    await self.record(chat_id, kind, tally, time.monotonic() - started)
+                except Exception as e:
+                    logging.error(f"Не удалось записать расход чата {chat_id}: {e}")
+
+    async def totals(self, chat_id: Optional[int] = None, days: Optional[int] = None) -> Totals:
+        """Расход чата (или всех чатов) за days суток, включая сегодня."""
+        since = _day((days or self.window_days) - 1)
+        return await self.pool.read(totals, since, chat_id)
+
+    async def top_chats(self, days: Optional[int] = None, limit: int = 10) -> List[tuple]:
+        return await self.pool.read(top_chats, _day((days or self.window_days) - 1), limit)
+
+    async def budget(self, chat_id: int) -> int:
+        """Лимит токенов чата за окно; 0 — без ограничений."""
+        budget = await self.pool.read(get_budget, chat_id)
+        return self.default_budget if budget is None else budget
+
+    async def set_budget(self, chat_id: int, tokens: Optional[int]) -> None:
+        """Задаёт лимит чата; None — лимит по умолчанию, 0 — без ограничений."""
+        await self.pool.write(set_budget, chat_id, tokens)
+
+    async def remaining(self, chat_id: int) -> Optional[int]:
+        """Остаток лимита за окно или None, если лимита нет."""
+        budget = await self.budget(chat_id)
+        if not budget:
+            return None
+        return max(0, budget - (await self.totals(chat_id)).tokens)
+
+    def size(self, input_tokens: int, remaining: Optional[int]) -> Optional[Sizing]:
+        """Размер дайджеста по объёму переписки и остатку лимита; None — не хватает лимита.
+
+        input_tokens — лишь оценка объёма: лимит входа остаётся полным
+        (self.input_tokens) и уменьшается, только если на него не хватает
+        остатка лимита.
+        """
+        estimate = max(1, min(input_tokens, self.input_tokens))
+        max_tokens = min(self.max_tokens, max(self.min_tokens, int(estimate * self.output_ratio)))
+        if remaining is None:
+            return Sizing(max_tokens, self.input_tokens)
+        expected = int(estimate * self.overhead) + max_tokens
+        if expected <= remaining:
+            affordable = int((remaining - max_tokens) / self.overhead)
+            return Sizing(max_tokens, min(self.input_tokens, affordable))
+        scale = remaining / expected
+        max_tokens = int(max_tokens * scale)
+        if max_tokens < self.min_tokens:
+            return None
+        return Sizing(max_tokens, int(estimate * scale))
+
+    async def plan(self, chat_id: int, input_tokens: int, kind: str = "digest") -> Sizing:
+        """Размер дайджеста чата; BudgetExceeded, если лимит исчерпан."""
+        sizing = self.size(input_tokens, await self.remaining(chat_id))
+        if sizing is None:
+            OVER_BUDGET.inc(kind=kind)
+            raise BudgetExceeded(f"Лимит токенов чата {chat_id} исчерпан")
+        return sizing
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from telegram import Bot, Update
+
+import jobs
+
+# Кадр между процессами: длина (4 байта, big-endian) и JSON обновления
+_FRAME = struct.Struct(">I")
+
+# Поля обновления, в которых лежит чат
+_CHAT_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "business_message", "edited_business_message", "my_chat_member",
+    "chat_member", "chat_join_request", "message_reaction",
+    "message_reaction_count", "chat_boost", "removed_chat_boost",
+)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+
+def update_chat_id(update: dict) -> int:
+    """Чат, к которому относится обновление; для обновлений без чата — пользователь."""
+    for field in _CHAT_FIELDS:
+        value = update.get(field)
+        if isinstance(value, dict) and isinstance(value.get("chat"), dict):
+            return value["chat"]["id"]
+    callback = update.get("callback_query")
+    if isinstance(callback, dict) and isinstance(callback.get("message"), dict):
+        return callback["message"]["chat"]["id"]
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"]["id"]
+    return 0
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Optional[bytes]:
+    try:
+        header = await reader.readexactly(_FRAME.size)
+        return await reader.readexactly(_FRAME.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    """Читает один HTTP-запрос: (метод, путь, заголовки, тело) или None при закрытии."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+def _response(status: str, body: bytes = b"", keep_alive: bool = True) -> bytes:
+    connection = "keep-alive" if keep_alive else "close"
+    return (
+        f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: {connection}\r\n\r\n"
+    ).encode() + body
+
+
+class ChatDispatcher:
+    """Выполняет обработку обновлений по порядку внутри чата и
+    параллельно между чатами.
+
+    У каждого чата с необработанными обновлениями своя очередь и своя
+    задача, которая разбирает её по одному обновлению. Одновременно
+    обрабатывается не больше concurrency обновлений; при max_pending
+    ожидающих обновлениях put притормаживает чтение входящего потока.
+    """
+
+    def __init__(self, process: Callable[[Update], Awaitable[None]],
+                 concurrency: int = 64, max_pending: int = 10000):
+        self.process = process
+        self.max_pending = max_pending
+        self.pending = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chats: Dict[int, asyncio.Queue] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._room = asyncio.Event()
+        self._room.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def put(self, chat_id: int, update: Update) -> None:
+        while self.pending >= self.max_pending:
+            self._room.clear()
+            await self._room.wait()
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = asyncio.Queue()
+            self._tasks[chat_id] = asyncio.create_task(self._drain(chat_id, queue))
+        queue.put_nowait(update)
+        self.pending += 1
+        self._idle.clear()
+
+    async def _drain(self, chat_id: int, queue: asyncio.Queue) -> None:
+        try:
+            while not queue.empty():
+                update = queue.get_nowait()
+                try:
+                    async with self._semaphore:
+                        await self.process(update)
+                except Exception as e:
+                    logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+                finally:
+                    self.pending -= 1
+                    if self.pending < self.max_pending:
+                        self._room.set()
+        finally:
+            del self._chats[chat_id]
+            del self._tasks[chat_id]
+            if not self._chats:
+                self._idle.set()
+
+    async def join(self) -> None:
+        """Дожидается обработки всех принятых обновлений."""
+        await self._idle.wait()
+
+
+class Supervisor:
+    """Приём обновлений Telegram через webhook и N рабочих процессов.
+
+    Supervisor слушает HTTP, проверяет секрет и по chat_id отправляет
+    обновление процессу своего шарда (jobs.shard_of) по unix-сокету.
+    Обновления одного чата всегда попадают в один процесс и приходят
+    туда в порядке получения; там же выполняются дайджесты этого чата
+    по расписанию. Упавший процесс перезапускается; пока его нет,
+    Telegram получает 503 и повторяет доставку позже. Обновления,
+    которые процесс принял, но не успел обработать до падения,
+    теряются — как и несброшенный буфер записи в режиме polling.
+    """
+
+    def __init__(self, url: str, token: str, workers: int = 1,
+                 listen: str = "0.0.0.0", port: int = 8443,
+                 secret: Optional[str] = None, base_url: Optional[str] = None,
+                 max_connections: int = 40, connect_timeout: float = 30.0):
+        self.url = url
+        self.path = urlparse(url).path or "/"
+        self.token = token
+        self.workers = workers
+        self.listen = listen
+        self.port = port
+        self.secret = secret
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self._socket_dir = ""
+        self._processes: List[Optional[asyncio.subprocess.Process]] = [None] * workers
+        self._writers: List[Optional[asyncio.StreamWriter]] = [None] * workers
+        self._ready: List[asyncio.Event] = []
+        self._locks: List[asyncio.Lock] = []
+        self._stopping = False
+
+    def run(self) -> None:
+        asyncio.run(self._main())
+
+    def _socket_path(self, index: int) -> str:
+        return os.path.join(self._socket_dir, f"worker-{index}.sock")
+
+    def _worker_env(self, index: int) -> Dict[str, str]:
+        env = dict(os.environ)
+        # Рабочий процесс запускается как python -m webhook из любого каталога
+        here = os.path.dirname(os.path.abspath(__file__))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [here, env.get("PYTHONPATH")]))
+        env["SHARD_INDEX"] = str(index)
+        env["SHARD_COUNT"] = str(self.workers)
+        # Лимит Bot API общий на бота: делим его между процессами
+        env["SEND_GLOBAL_RATE"] = str(float(os.getenv("SEND_GLOBAL_RATE", "30")) / self.workers)
+        if os.getenv("METRICS_PORT"):
+            env["METRICS_PORT"] = str(int(os.getenv("METRICS_PORT")) + 1 + index)
+        return env
+
+    async def _main(self) -> None:
+        self._socket_dir = tempfile.mkdtemp(prefix="digest-webhook-")
+        self._ready = [asyncio.Event() for _ in range(self.workers)]
+        self._locks = [asyncio.Lock() for _ in range(self.workers)]
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        monitors = [asyncio.create_task(self._keep_worker(index)) for index in range(self.workers)]
+        server = await asyncio.start_server(self._serve, self.listen, self.port, backlog=1024)
+        try:
+            await self._set_webhook()
+            logging.info(f"Webhook слушает {self.listen}:{self.port}{self.path}, процессов: {self.workers}")
+            await stop.wait()
+        finally:
+            logging.info("Остановка webhook")
+            self._stopping = True
+            server.close()
+            await server.wait_closed()
+            for monitor in monitors:
+                monitor.cancel()
+            await asyncio.gather(*monitors, return_exceptions=True)
+            await self._stop_workers()
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+    async def _set_webhook(self) -> None:
+        kwargs = {"base_url": self.base_url} if self.base_url else {}
+        async with Bot(self.token, **kwargs) as bot:
+            await bot.set_webhook(
+                self.url, secret_token=self.secret, max_connections=self.max_connections,
+                allowed_updates=Update.ALL_TYPES,
+            )
+
+    async def _keep_worker(self, index: int) -> None:
+        """Запускает рабочий процесс и перезапускает его после падения."""
+        delay = 1.0
+        while True:
+            path = self._socket_path(index)
+            if os.path.exists(path):
+                os.unlink(path)
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "webhook", str(index), path,
+                env=self._worker_env(index),
+            )
+            self._processes[index] = process
+            try:
+                await self._connect(index, path, process)
+                delay = 1.0
+            except Exception as e:
+                logging.error(f"Рабочий процесс {index} не запустился: {e}")
+            code = await process.wait()
+            self._disconnect(index)
+            logging.error(f"Рабочий процесс {index} завершился с кодом {code}, перезапуск через {delay:.0f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+    async def _connect(self, index: int, path: str, process: asyncio.subprocess.Process) -> None:
+        while True:
+            if process.returncode is not None:
+                raise RuntimeError(f"процесс завершился с кодом {process.returncode}")
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        self._writers[index] = writer
+        self._ready[index].set()
+        logging.info(f"Рабочий процесс {index} готов (pid {process.pid})")
+
+    def _disconnect(self, index: int) -> None:
+        self._ready[index].clear()
+        writer, self._writers[index] = self._writers[index], None
+        if writer is not None:
+            writer.close()
+
+    async def _stop_workers(self, timeout: float = 60.0) -> None:
+        # Закрытие сокета — сигнал дообработать принятое и завершиться
+        for index in range(self.workers):
+            self._disconnect(index)
+        running = [process for process in self._processes if process is not None and process.returncode is None]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in running)), timeout)
+        except asyncio.TimeoutError:
+            for process in running:
+                if process.returncode is None:
+                    process.kill()
+
+    async def _dispatch(self, body: bytes) -> bool:
+        """Передаёт обновление процессу его шарда; False, если процесс недоступен."""
+        try:
+            chat_id = update_chat_id(json.loads(body))
+        except (ValueError, AttributeError, TypeError):
+            logging.warning("Получено некорректное обновление")
+            return True
+        index = jobs.shard_of(chat_id, self.workers)
+        try:
+            await asyncio.wait_for(self._ready[index].wait(), self.connect_timeout)
+        except asyncio.TimeoutError:
+            return False
+        # Запись кадра целиком под блокировкой сохраняет порядок обновлений чата
+        async with self._locks[index]:
+            writer = self._writers[index]
+            if writer is None:
+                return False
+            try:
+                writer.write(_FRAME.pack(len(body)) + body)
+                await writer.drain()
+            except ConnectionError:
+                return False
+        return True
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while not self._stopping:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if method != "POST" or path != self.path:
+                    writer.write(_response("404 Not Found"))
+                elif self.secret and headers.get(SECRET_HEADER) != self.secret:
+                    writer.write(_response("403 Forbidden"))
+                elif await self._dispatch(body):
+                    writer.write(_response("200 OK"))
+                else:
+                    writer.write(_response("503 Service Unavailable"))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _run_worker(application, socket_path: str) -> None:
+    import main
+
+    dispatcher = ChatDispatcher(
+        application.process_update,
+        concurrency=int(os.getenv("WEBHOOK_CONCURRENCY", "64")),
+    )
+    closed = asyncio.Event()
+    connections = set()
+
+    async def receive(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connections.add(asyncio.current_task())
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                if frame is None:
+                    break
+                update = Update.de_json(json.loads(frame), application.bot)
+                chat = update.effective_chat or update.effective_user
+                await dispatcher.put(chat.id if chat else 0, update)
+        finally:
+            connections.discard(asyncio.current_task())
+            writer.close()
+            closed.set()
+
+    await application.initialize()
+    await main.post_init(application)
+    server = await asyncio.start_unix_server(receive, socket_path)
+    loop = asyncio.get_running_loop()
+    # Останавливаемся, когда supervisor закроет сокет; сигналы от терминала
+    # приходят всей группе процессов, порядок остановки задаёт supervisor
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+    loop.add_signal_handler(signal.SIGTERM, closed.set)
+    try:
+        await closed.wait()
+    finally:
+        server.close()
+        for task in list(connections):
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        await dispatcher.join()
+        await main.post_shutdown(application)
+        await application.shutdown()
+
+
+def run_worker(index: int, socket_path: str) -> None:
+    """Точка входа рабочего процесса: python -m webhook <index> <socket>."""
+    import main
+
+    logging.info(f"Рабочий процесс {index} из {os.getenv('SHARD_COUNT')} запускается")
+    main.register_handlers(main.app)
+    asyncio.run(_run_worker(main.app, socket_path))
+
+
+if __name__ == "__main__":
+    run_worker(int(sys.argv[1]), sys.argv[2])